@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+INBOUND = 'inbound'  # someone outside the team
+OUTBOUND = 'outbound'  # me
+TEAMMATE = 'teammate'
+
+STALE = 'stale'
+UNANSWERED = 'unanswered'
+
+
+class ChatActivity:
+    """Last inbound, outbound and teammate activity per group chat, with alerts.
+
+    Fed from the message events the client already receives and kept in the
+    ``chat_activity`` table, so nothing is ever fetched from Telegram. Two
+    kinds of alert come off one deadline heap:
+
+    - ``unanswered``: someone has been waiting ``unanswered_after`` seconds
+      since their message and neither I nor a teammate has written since.
+    - ``stale``: a high-value chat has been silent for ``stale_after``
+      seconds; repeated every ``stale_after`` while it stays silent.
+
+    ``on_alert(kind, chat)`` is awaited for each alert.
+    """
+
+    def __init__(self, storage: Storage, on_alert: Callable[[str, dict], Awaitable[None]],
+                 stale_after: float = 24 * 3600, unanswered_after: float = 4 * 3600,
+                 is_high_value: Callable[[int, str], bool] = None):
+        self.storage = storage
+        self.on_alert = on_alert
+        self.stale_after = stale_after
+        self.unanswered_after = unanswered_after
+        self.is_high_value = is_high_value or (lambda chat_id, title: False)
+        self.logger = logger
+        self.chats: Dict[int, dict] = {}
+        # (due in loop time, n, chat_id, kind); entries whose due no longer matches _due are stale
+        self._heap: List[Tuple[float, int, int, str]] = []
+        self._due: Dict[Tuple[int, str], float] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def init(self):
+        await self.storage.execute_schema([
+            '''
+                CREATE TABLE IF NOT EXISTS chat_activity (
+                    chat_id INTEGER PRIMARY KEY,
+                    title TEXT NULL,
+                    last_inbound REAL NULL,
+                    last_outbound REAL NULL,
+                    last_teammate REAL NULL,
+                    stale_alerted_at REAL NULL,
+                    unanswered_alerted_at REAL NULL
+                )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_chat_activity_inbound ON chat_activity(last_inbound)',
+        ])
+        rows = await self.storage.fetchall('''
+            SELECT chat_id, title, last_inbound, last_outbound, last_teammate, stale_alerted_at, unanswered_alerted_at
+            FROM chat_activity
+        ''')
+        for chat_id, title, inbound, outbound, teammate, stale_alerted, unanswered_alerted in rows:
+            self.chats[chat_id] = {
+                'chat_id': chat_id, 'title': title, INBOUND: inbound, OUTBOUND: outbound, TEAMMATE: teammate,
+                'stale_alerted_at': stale_alerted, 'unanswered_alerted_at': unanswered_alerted,
+            }
+            self._reschedule(chat_id)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def observe(self, chat_id: int, title: str, kind: str, at: float = None):
+        """Record a message of ``kind`` (inbound, outbound or teammate) in a chat"""
+        at = time.time() if at is None else at
+        chat = self.chats.setdefault(chat_id, {
+            'chat_id': chat_id, 'title': title, INBOUND: None, OUTBOUND: None, TEAMMATE: None,
+            'stale_alerted_at': None, 'unanswered_alerted_at': None,
+        })
+        chat['title'] = title or chat['title']
+        if chat[kind] is not None and chat[kind] >= at:
+            return
+        chat[kind] = at
+        self.storage.submit(f'''
+            INSERT INTO chat_activity (chat_id, title, last_{kind}) VALUES (?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET title = excluded.title, last_{kind} = excluded.last_{kind}
+        ''', (chat_id, chat['title'], at))
+        self._reschedule(chat_id)
+
+    def answered_at(self, chat: dict) -> float:
+        return max(chat[OUTBOUND] or 0, chat[TEAMMATE] or 0)
+
+    def last_activity(self, chat: dict) -> float:
+        return max(chat[INBOUND] or 0, self.answered_at(chat))
+
+    def unanswered(self, limit: int = 10) -> List[dict]:
+        """Chats waiting on our side, longest waiting first"""
+        waiting = [chat for chat in self.chats.values()
+                   if chat[INBOUND] and chat[INBOUND] > self.answered_at(chat)]
+        return sorted(waiting, key=lambda chat: chat[INBOUND])[:limit]
+
+    def _deadlines(self, chat: dict) -> Dict[str, Optional[float]]:
+        """Unix times the chat's alerts are due, None when nothing is pending"""
+        due: Dict[str, Optional[float]] = {STALE: None, UNANSWERED: None}
+        inbound = chat[INBOUND]
+        if inbound and inbound > self.answered_at(chat) and (chat['unanswered_alerted_at'] or 0) < inbound:
+            due[UNANSWERED] = inbound + self.unanswered_after
+        if self.is_high_value(chat['chat_id'], chat['title'] or ''):
+            # Repeats every stale_after while the chat stays silent
+            base = max(self.last_activity(chat), chat['stale_alerted_at'] or 0)
+            if base:
+                due[STALE] = base + self.stale_after
+        return due
+
+    def _reschedule(self, chat_id: int):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        # Deadlines are wall clock times; the heap runs on the loop's clock
+        offset = loop.time() - time.time()
+        for kind, due in self._deadlines(self.chats[chat_id]).items():
+            if due is None:
+                self._due.pop((chat_id, kind), None)
+                continue
+            due += offset
+            if self._due.get((chat_id, kind)) == due:
+                continue
+            self._due[(chat_id, kind)] = due
+            heapq.heappush(self._heap, (due, next(self._counter), chat_id, kind))
+            if self._heap[0][2:] == (chat_id, kind):
+                self._wakeup.set()
+
+    def refresh(self):
+        """Re-check every chat, e.g. after the high-value list changed"""
+        for chat_id in list(self.chats):
+            self._reschedule(chat_id)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, _, chat_id, kind = self._heap[0]
+            if self._due.get((chat_id, kind)) != due:
+                heapq.heappop(self._heap)
+                continue
+            delay = due - loop.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            del self._due[(chat_id, kind)]
+            await self._alert(chat_id, kind)
+
+    async def _alert(self, chat_id: int, kind: str):
+        chat = self.chats[chat_id]
+        now = time.time()
+        chat[f'{kind}_alerted_at'] = now
+        self.storage.submit(f'UPDATE chat_activity SET {kind}_alerted_at = ? WHERE chat_id = ?', (now, chat_id))
+        self._reschedule(chat_id)
+        try:
+            await self.on_alert(kind, dict(chat))
+        except Exception as e:
+            self.logger.error(f"Error sending {kind} alert for chat {chat_id}: {str(e)}")
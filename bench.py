@@ -0,0 +1,815 @@
+"""Offline replay and load-test harness for MessageMonitor.
+
+Drives the real MessageMonitor (handle_new_message, _delayed_processing,
+_call_gpt, _handle_button_press) with a recorded or synthetic message stream,
+against in-process stand-ins for TelegramClient and AsyncOpenAI, on an event
+loop with a virtual clock so a day of traffic replays in seconds.
+
+    python bench.py --chats 50 --messages 2000
+    python bench.py --replay stream.jsonl --gpt-latency 3 --output bench_output.txt
+
+A recorded stream is JSONL, one event per line:
+
+    {"t": 12.5, "chat_id": 1, "title": "Absinthe <> Foo", "sender_id": 42,
+     "username": "alice", "text": "is the api down?", "mentioned": false, "out": false}
+    {"t": 14.0, "chat_id": 1, "sender_id": 42, "typing": true}
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import jiter
+from telethon import errors, events
+
+OWNER_ID = 1000
+OWNER_USERNAME = "owner"
+BOT_ID = 2000
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock jumps straight to the next timer when idle.
+
+    Before jumping it briefly polls for real I/O so results from worker
+    threads (aiosqlite) are not overtaken by virtual time.
+    """
+
+    def __init__(self, real_poll_seconds: float = 0.001):
+        super().__init__()
+        self.real_poll_seconds = real_poll_seconds
+        self._virtual_time = 0.0
+
+    def time(self) -> float:
+        return self._virtual_time
+
+    def _run_once(self):
+        if not self._ready and not self._stopping and self._scheduled:
+            event_list = self._selector.select(self.real_poll_seconds)
+            self._process_events(event_list)
+            if not self._ready:
+                live = [handle._when for handle in self._scheduled if not handle._cancelled]
+                if live:
+                    self._virtual_time = max(self._virtual_time, min(live))
+        super()._run_once()
+
+
+class Latency:
+    """Uniformly jittered latency in seconds"""
+
+    def __init__(self, mean: float, jitter: float = 0.3, rng: random.Random = None):
+        self.mean = mean
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+
+    async def wait(self):
+        if self.mean > 0:
+            await asyncio.sleep(self.mean * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class Recorder:
+    """Per-stage latency samples and API call counters"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.calls: Counter = Counter()
+
+    def add(self, stage: str, seconds: float):
+        self.samples[stage].append(seconds)
+
+    def wrap(self, stage: str, func):
+        async def wrapper(*args, **kwargs):
+            started = asyncio.get_running_loop().time()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage, asyncio.get_running_loop().time() - started)
+        return wrapper
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+# --- Telegram stand-ins ---------------------------------------------------
+
+class FakeUser:
+    def __init__(self, id: int, username: Optional[str], first_name: str = None):
+        self.id = id
+        self.username = username
+        self.first_name = first_name or (username or str(id))
+        self.bot = False
+
+
+class FakeChat:
+    def __init__(self, id: int, title: str):
+        self.id = id
+        self.title = title
+
+
+class FakeMessage:
+    def __init__(self, id: int, chat: Optional[FakeChat], sender: Optional[FakeUser], text: str, date: datetime,
+                 out: bool = False, mentioned: bool = False):
+        self.id = id
+        self.chat = chat
+        self.sender = sender
+        self.sender_id = sender.id if sender else None
+        self.text = text
+        self.raw_text = text
+        self.message = text
+        self.date = date
+        self.out = out
+        self.mentioned = mentioned
+
+    async def get_sender(self):
+        return self.sender
+
+
+class FakeNewMessageEvent:
+    def __init__(self, client: "FakeTelegramClient", message: FakeMessage, chat_id: int):
+        self._client = client
+        self.message = message
+        self.text = message.text
+        self.raw_text = message.text
+        self.sender_id = message.sender_id
+        self.chat_id = chat_id
+        self.out = message.out
+        self.is_group = message.chat is not None
+        self.is_private = message.chat is None
+        self.is_channel = False
+        # Telethon does not always have the chat entity at hand
+        self.chat = message.chat if client.rng.random() < 0.5 else None
+
+    async def get_sender(self):
+        await self._client.api("get_sender")
+        return self.message.sender
+
+    async def get_chat(self):
+        await self._client.api("get_chat")
+        return self.message.chat
+
+    async def reply(self, text: str, **kwargs):
+        return await self._client.send_message(self.chat_id, text, **kwargs)
+
+    async def respond(self, text: str, **kwargs):
+        return await self._client.send_message(self.chat_id, text, **kwargs)
+
+    async def delete(self):
+        await self._client.api("delete_messages")
+
+
+class FakeTypingEvent:
+    def __init__(self, chat_id: int, user_id: int):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.typing = True
+
+
+class FakeCallbackEvent:
+    def __init__(self, bot: "FakeTelegramClient", sender_id: int, data: bytes, message_id: int):
+        self._bot = bot
+        self.sender_id = sender_id
+        self.data = data
+        self.message_id = message_id
+        self.chat_id = sender_id
+
+    async def answer(self, message: str = None, alert: bool = False):
+        await self._bot.api("answer_callback")
+
+    async def edit(self, text: str = None, **kwargs):
+        await self._bot.api("edit_message")
+        self._bot.edits.append((self.message_id, text, kwargs))
+
+
+class FakeTelegramClient:
+    """In-process TelegramClient: records handlers, serves history and counts API calls"""
+
+    def __init__(self, name: str, me: FakeUser, recorder: Recorder, latency: Latency, rng: random.Random,
+                 start: datetime):
+        self.name = name
+        self.me = me
+        self.recorder = recorder
+        self.latency = latency
+        self.rng = rng
+        self.start_time = start
+        self.handlers = []
+        self.history: Dict[int, List[FakeMessage]] = defaultdict(list)
+        self.sent: List[dict] = []
+        self.edits: List[tuple] = []
+        self._next_id = 1
+        # Share of sends answered with a FloodWait, and the longest wait asked for
+        self.flood_rate = 0.0
+        self.flood_seconds = 30
+        self.dialogs: List[FakeChat] = []
+
+    def now(self) -> datetime:
+        return self.start_time + timedelta(seconds=asyncio.get_running_loop().time())
+
+    def next_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    async def api(self, method: str):
+        self.recorder.calls[f"{self.name}.{method}"] += 1
+        await self.latency.wait()
+
+    # Client lifecycle
+    async def start(self, *args, **kwargs):
+        await self.api("start")
+        return self
+
+    async def connect(self):
+        await self.api("connect")
+
+    async def disconnect(self):
+        pass
+
+    async def run_until_disconnected(self):
+        await asyncio.Event().wait()
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def get_me(self, input_peer: bool = False):
+        await self.api("get_me")
+        return self.me
+
+    # Handlers
+    def on(self, event):
+        def decorator(callback):
+            self.add_event_handler(callback, event)
+            return callback
+        return decorator
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((event, callback))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [(e, c) for e, c in self.handlers if c is not callback]
+
+    async def dispatch(self, kind: type, event):
+        """Run every handler registered for ``kind`` (events.NewMessage, ...)"""
+        for builder, callback in list(self.handlers):
+            builder_type = builder if isinstance(builder, type) else type(builder)
+            if builder_type is kind:
+                await callback(event)
+
+    # Requests
+    async def iter_dialogs(self, **kwargs):
+        for index, chat in enumerate(self.dialogs):
+            # Telethon fetches dialogs 100 per GetDialogsRequest
+            if index % 100 == 0:
+                await self.api("iter_dialogs")
+            yield _Obj(id=-1_000_000_000_000 - chat.id, title=chat.title, is_group=True, input_entity=chat,
+                       dialog=_Obj(notify_settings=_Obj(mute_until=None)))
+
+    async def get_input_entity(self, peer):
+        return peer
+
+    async def iter_messages(self, entity, limit: int = None, **kwargs):
+        await self.api("iter_messages")
+        chat_id = entity.id if hasattr(entity, 'id') else entity
+        messages = self.history.get(chat_id, [])
+        selected = messages[-limit:] if limit else messages
+        for message in reversed(selected):
+            yield message
+
+    async def send_message(self, entity, message: str = "", buttons=None, **kwargs):
+        await self.api("send_message")
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.recorder.calls[f"{self.name}.flood_wait"] += 1
+            raise errors.FloodWaitError(request=None, capture=self.rng.randint(1, self.flood_seconds))
+        sent = FakeMessage(self.next_id(), None, self.me, message, self.now(), out=True)
+        self.sent.append({'to': entity, 'text': message, 'buttons': buttons, 'id': sent.id,
+                          'at': asyncio.get_running_loop().time()})
+        return sent
+
+    async def edit_message(self, entity, message=None, text: str = None, buttons=None, **kwargs):
+        await self.api("edit_message")
+        self.edits.append((message, text, buttons))
+        return message
+
+    async def __call__(self, request, *args, **kwargs):
+        await self.api(type(request).__name__)
+        return None
+
+
+# --- OpenAI stand-in ------------------------------------------------------
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeRawResponse:
+    def __init__(self, completion, headers: dict):
+        self._completion = completion
+        self.headers = headers
+
+    def parse(self):
+        return self._completion
+
+
+class FakeStream:
+    """beta.chat.completions.stream(): the triage JSON in small chunks, parsed partially"""
+
+    def __init__(self, completions: "FakeCompletions", kwargs: dict):
+        self._completions = completions
+        self._kwargs = kwargs
+        self._content = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        owner = self._completions._owner
+        owner.recorder.calls["openai.stream"] += 1
+        owner.in_flight += 1
+        owner.max_in_flight = max(owner.max_in_flight, owner.in_flight)
+        try:
+            content = owner.decide(self._kwargs.get('messages', []), self._kwargs.get('response_format'))
+            chunks = [content[i:i + 8] for i in range(0, len(content), 8)]
+            # A quarter of the latency to the first token, the rest spread over the chunks
+            total = owner.latency.mean * owner.speed(self._kwargs.get('model')) * owner.rng.uniform(0.7, 1.3)
+            await asyncio.sleep(total / 4)
+            snapshot = ""
+            for chunk in chunks:
+                await asyncio.sleep(total * 3 / 4 / len(chunks))
+                snapshot += chunk
+                # As the SDK builds event.parsed: an unfinished trailing string is left out
+                parsed = jiter.from_json(snapshot.encode(), partial_mode=True)
+                yield _Obj(type="content.delta", delta=chunk, snapshot=snapshot, parsed=parsed)
+            self._content = content
+        finally:
+            owner.in_flight -= 1
+
+    async def get_final_completion(self):
+        if self._content is None:
+            async for _ in self:
+                pass
+        return self._completions._completion(self._content, self._kwargs)
+
+
+class FakeCompletions:
+    def __init__(self, owner: "FakeOpenAI"):
+        self._owner = owner
+        self.with_raw_response = _Obj(parse=self._raw_parse)
+
+    async def parse(self, **kwargs):
+        return (await self._raw_parse(**kwargs)).parse()
+
+    def stream(self, **kwargs):
+        return FakeStream(self, kwargs)
+
+    async def _raw_parse(self, **kwargs):
+        owner = self._owner
+        owner.recorder.calls["openai.parse"] += 1
+        owner.in_flight += 1
+        owner.max_in_flight = max(owner.max_in_flight, owner.in_flight)
+        try:
+            await asyncio.sleep(owner.latency.mean * owner.speed(kwargs.get('model')) * owner.rng.uniform(0.7, 1.3))
+        finally:
+            owner.in_flight -= 1
+        content = owner.decide(kwargs.get('messages', []), kwargs.get('response_format'))
+        completion = self._completion(content, kwargs)
+        prompt_tokens = completion.usage.prompt_tokens
+        completion_tokens = completion.usage.completion_tokens
+        headers = {
+            'x-ratelimit-limit-requests': '500',
+            'x-ratelimit-remaining-requests': '499',
+            'x-ratelimit-reset-requests': '120ms',
+            'x-ratelimit-limit-tokens': '30000',
+            'x-ratelimit-remaining-tokens': str(max(0, 30000 - prompt_tokens - completion_tokens)),
+            'x-ratelimit-reset-tokens': '1s',
+        }
+        return FakeRawResponse(completion, headers)
+
+    @staticmethod
+    def _completion(content: str, kwargs: dict):
+        prompt_tokens = sum(len(m.get('content') or '') for m in kwargs.get('messages', [])) // 4
+        completion_tokens = len(content) // 4
+        return _Obj(
+            choices=[_Obj(message=_Obj(content=content, parsed=None, refusal=None), finish_reason="stop")],
+            usage=_Obj(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                       total_tokens=prompt_tokens + completion_tokens,
+                       prompt_tokens_details=_Obj(cached_tokens=0)),
+            model=kwargs.get('model'),
+        )
+
+
+class FakeOpenAI:
+    """In-process AsyncOpenAI answering with deterministic triage results"""
+
+    def __init__(self, recorder: Recorder, latency: Latency, rng: random.Random):
+        self.recorder = recorder
+        self.latency = latency
+        self.rng = rng
+        self.in_flight = 0
+        self.max_in_flight = 0
+        completions = FakeCompletions(self)
+        self.beta = _Obj(chat=_Obj(completions=completions))
+        self.chat = _Obj(completions=completions)
+
+    @staticmethod
+    def speed(model: str) -> float:
+        """Latency factor per model: the small ones answer in about a third of the time"""
+        return 0.35 if model and 'mini' in model else 1.0
+
+    def decide(self, messages: List[dict], response_format=None) -> str:
+        text = " ".join((m.get('content') or '') for m in messages if m.get('role') != 'system').lower()
+        should_respond = '?' in text or f"@{OWNER_USERNAME}" in text
+        urgency = 'high' if any(word in text for word in ('down', 'broken', 'urgent')) else \
+            'medium' if should_respond else 'low'
+        result = {
+            'should_respond': should_respond,
+            'reason': 'question asked' if should_respond else 'casual chatter',
+            'confidence': 80,
+            'urgency': urgency,
+            'response': "Hey thanks for flagging, looking into it now" if should_respond else "",
+        }
+        fields = getattr(response_format, 'model_fields', None)
+        if fields is not None:
+            # Only what the schema asks for, e.g. no response from the triage model
+            result = {key: value for key, value in result.items() if key in fields}
+        return json.dumps(result)
+
+
+# --- Streams --------------------------------------------------------------
+
+def synthetic_stream(chats: int, messages: int, rng: random.Random, mention_rate: float = 0.05,
+                     question_rate: float = 0.3, owner_rate: float = 0.05, typing_rate: float = 0.2) -> List[dict]:
+    """Bursty group traffic: short bursts per chat separated by exponential gaps"""
+    stream = []
+    titles = {chat_id: f"Absinthe <> Customer {chat_id}" for chat_id in range(1, chats + 1)}
+    senders = {chat_id: [10_000 + chat_id * 10 + i for i in range(rng.randint(2, 5))] for chat_id in titles}
+    t = 0.0
+    while len(stream) < messages:
+        chat_id = rng.randint(1, chats)
+        t += rng.expovariate(1 / 20)
+        burst_t = t
+        for _ in range(rng.randint(1, 6)):
+            if len(stream) >= messages:
+                break
+            burst_t += rng.uniform(5, 40)
+            out = rng.random() < owner_rate
+            sender_id = OWNER_ID if out else rng.choice(senders[chat_id])
+            mentioned = not out and rng.random() < mention_rate
+            text = rng.choice(["gm", "thanks", "sounds good", "let me check", "the dashboard is broken",
+                               "points look off", "ok", "nice"])
+            if not out and rng.random() < question_rate:
+                text += " any update?"
+            if mentioned:
+                text = f"@{OWNER_USERNAME} {text}"
+            if not out and rng.random() < typing_rate:
+                stream.append({'t': burst_t - 3, 'chat_id': chat_id, 'sender_id': sender_id, 'typing': True})
+            stream.append({
+                't': burst_t, 'chat_id': chat_id, 'title': titles[chat_id], 'sender_id': sender_id,
+                'username': OWNER_USERNAME if out else f"user{sender_id}", 'text': text,
+                'mentioned': mentioned, 'out': out,
+            })
+    stream.sort(key=lambda event: event['t'])
+    return stream
+
+
+def load_stream(path: str) -> List[dict]:
+    with open(path) as f:
+        stream = [json.loads(line) for line in f if line.strip()]
+    stream.sort(key=lambda event: event['t'])
+    return stream
+
+
+# --- Harness --------------------------------------------------------------
+
+def button_data(button) -> bytes:
+    """Callback payload of an inline button across Telethon layer versions"""
+    data = getattr(button, 'data', None)
+    if data is None:
+        data = button.type.data
+    return data
+
+
+class Harness:
+    def __init__(self, stream: List[dict], args: argparse.Namespace):
+        self.stream = stream
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.recorder = Recorder()
+        self.start = datetime(2025, 1, 6, 9, 0, tzinfo=timezone.utc)
+        self.chats: Dict[int, FakeChat] = {}
+        self.users: Dict[int, FakeUser] = {}
+        self.last_inbound: Dict[int, float] = {}
+        self.reviewed = Counter()
+        self._review_tasks = set()
+        self._seen_cards = 0
+        # Drafts a review is already scheduled for
+        self._reviewing = set()
+
+    def _user(self, user_id: int, username: str = None) -> FakeUser:
+        if user_id not in self.users:
+            self.users[user_id] = FakeUser(user_id, username)
+        return self.users[user_id]
+
+    async def run(self) -> dict:
+        # Imported here so the caller can configure logging first
+        from main import MessageMonitor
+        from jobs import LoopClock
+
+        args = self.args
+        owner = FakeUser(OWNER_ID, OWNER_USERNAME, "Owner")
+        self.users[OWNER_ID] = owner
+        tg_latency = Latency(args.tg_latency, rng=self.rng)
+        self.client = FakeTelegramClient("user", owner, self.recorder, tg_latency, self.rng, self.start)
+        self.bot = FakeTelegramClient("bot", FakeUser(BOT_ID, "review_bot"), self.recorder, tg_latency, self.rng,
+                                      self.start)
+        self.openai = FakeOpenAI(self.recorder, Latency(args.gpt_latency, rng=self.rng), self.rng)
+
+        workdir = tempfile.mkdtemp(prefix="tg-persona-bench-")
+        db_path = os.path.join(workdir, "bench.db")
+
+        def new_monitor():
+            monitor = MessageMonitor(
+                api_id="0", api_hash="bench", phone="+0", bot_token="bench", openai_api_key="bench",
+                client=self.client, bot=self.bot, openai_client=self.openai, db_path=db_path,
+                clock=LoopClock(),
+            )
+            monitor.delay_time_seconds = args.delay
+            monitor.debouncer.delay = args.delay
+            monitor.metrics_server = None
+            monitor.tracer.path = os.path.join(workdir, "traces.jsonl")
+            monitor.stream_drafts = not args.no_stream
+            if args.single_tier:
+                monitor.triage_model = None
+            return monitor
+
+        self.monitor = new_monitor()
+        self.client.flood_rate = self.bot.flood_rate = args.flood_rate
+        self._instrument_bot()
+        self._instrument()
+        # Every chat in the stream is one of my dialogs from the start
+        for event in self.stream:
+            if not event.get('typing') and event['chat_id'] not in self.chats:
+                self.chats[event['chat_id']] = FakeChat(event['chat_id'], event.get('title')
+                                                        or f"Absinthe <> Chat {event['chat_id']}")
+        self.client.dialogs = list(self.chats.values())
+
+        wall_started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            await self.monitor.start()
+            await asyncio.sleep(0.1)
+            t0 = loop.time()
+            restart_at = args.restart_at
+            for event in self.stream:
+                delay = t0 + event['t'] - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if restart_at is not None and event['t'] >= restart_at:
+                    # Simulated restart: chats in their quiet window must come back from the journal
+                    restart_at = None
+                    await self.monitor.stop()
+                    self.client.handlers = []
+                    self.bot.handlers = []
+                    self.monitor = new_monitor()
+                    self._instrument()
+                    await self.monitor.start()
+                await self._inject(event)
+            await self._drain()
+            virtual_seconds = loop.time() - t0
+        finally:
+            await self._shutdown()
+            shutil.rmtree(workdir, ignore_errors=True)
+        wall_seconds = time.perf_counter() - wall_started
+        return self._report(virtual_seconds, wall_seconds)
+
+    def _instrument(self):
+        monitor = self.monitor
+        recorder = self.recorder
+        original_fire = monitor.debouncer.callback
+
+        async def fire(chat_id):
+            last = self.last_inbound.get(chat_id)
+            if last is not None:
+                recorder.add("debounce_wait", asyncio.get_running_loop().time() - last)
+            return await original_fire(chat_id)
+
+        monitor.debouncer.callback = recorder.wrap("delayed_processing", fire)
+        monitor.history.recent_unique_senders = recorder.wrap("context_fetch", monitor.history.recent_unique_senders)
+        monitor._call_gpt = recorder.wrap("call_gpt", monitor._call_gpt)
+        monitor._handle_button_press = recorder.wrap("button_press", monitor._handle_button_press)
+
+    def _instrument_bot(self):
+        original_send = self.bot.send_message
+
+        async def bot_send(entity, message="", buttons=None, **kwargs):
+            sent = await original_send(entity, message, buttons=buttons, **kwargs)
+            if buttons:
+                self._on_review_card(message, buttons)
+            return sent
+
+        original_edit = self.bot.edit_message
+
+        async def bot_edit(entity, message=None, text=None, buttons=None, **kwargs):
+            edited = await original_edit(entity, message, text, buttons=buttons, **kwargs)
+            # A streamed card gets its buttons on the final edit
+            if buttons:
+                posted = next((sent['at'] for sent in self.bot.sent if sent['id'] == getattr(message, 'id', None)),
+                              None)
+                self._on_review_card(text, buttons, posted)
+            return edited
+
+        self.bot.send_message = bot_send
+        self.bot.edit_message = bot_edit
+
+    async def _inject(self, event: dict):
+        chat_id = event['chat_id']
+        if event.get('typing'):
+            await self.client.dispatch(events.UserUpdate, FakeTypingEvent(-1_000_000_000_000 - chat_id,
+                                                                          event['sender_id']))
+            return
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = FakeChat(chat_id, event.get('title') or f"Absinthe <> Chat {chat_id}")
+        out = bool(event.get('out'))
+        sender = self.users[OWNER_ID] if out else self._user(event['sender_id'], event.get('username'))
+        message = FakeMessage(self.client.next_id(), chat, sender, event['text'], self.client.now(),
+                              out=out, mentioned=bool(event.get('mentioned')))
+        self.client.history[chat_id].append(message)
+        loop = asyncio.get_running_loop()
+        if not out:
+            self.last_inbound[chat_id] = loop.time()
+        started = loop.time()
+        await self.client.dispatch(events.NewMessage,
+                                   FakeNewMessageEvent(self.client, message, -1_000_000_000_000 - chat_id))
+        self.recorder.add("handle_new_message", loop.time() - started)
+
+    def _on_review_card(self, text: str, buttons, posted_at: float = None):
+        data = button_data(buttons[0][0]).decode()
+        message_id = data.split('_', 1)[1]
+        # The preview after an edit and a history suggestion's model draft come with buttons again
+        if message_id in self._reviewing:
+            return
+        self._reviewing.add(message_id)
+        self._seen_cards += 1
+        chat_id = int(message_id.split('_', 1)[0])
+        last = self.last_inbound.get(chat_id)
+        now = asyncio.get_running_loop().time()
+        if last is not None:
+            # First review: the card is on screen; review: the buttons are there too
+            self.recorder.add("time_to_first_review", (posted_at if posted_at is not None else now) - last)
+            self.recorder.add("time_to_review", now - last)
+        task = asyncio.create_task(self._review(message_id))
+        self._review_tasks.add(task)
+        task.add_done_callback(self._review_tasks.discard)
+
+    async def _review(self, message_id: str):
+        await asyncio.sleep(self.args.review_delay * self.rng.uniform(0.5, 1.5))
+        roll = self.rng.random()
+        action = "approve" if roll < self.args.approve_rate else \
+            "edit" if roll < self.args.approve_rate + self.args.edit_rate else "reject"
+        self.reviewed[action] += 1
+        card_id = self.bot.next_id()
+        await self.bot.dispatch(events.CallbackQuery,
+                                FakeCallbackEvent(self.bot, OWNER_ID, f"{action}_{message_id}".encode(), card_id))
+        if action == "edit":
+            await asyncio.sleep(self.args.review_delay / 4)
+            reply = FakeMessage(self.bot.next_id(), None, self.users[OWNER_ID], "EDIT: Sure, checking now",
+                                self.client.now())
+            await self.bot.dispatch(events.NewMessage, FakeNewMessageEvent(self.bot, reply, OWNER_ID))
+            await asyncio.sleep(self.args.review_delay / 4)
+            await self.bot.dispatch(events.CallbackQuery,
+                                    FakeCallbackEvent(self.bot, OWNER_ID, f"approve_{message_id}".encode(),
+                                                      self.bot.next_id()))
+
+    async def _drain(self):
+        """Let every queued chat fire and every review card get handled"""
+        monitor = self.monitor
+        while True:
+            await asyncio.sleep(1)
+            busy = (len(monitor.debouncer) or monitor.debouncer.firing or monitor.llm.queue_depth
+                    or monitor.llm.in_flight or self._review_tasks
+                    or monitor.user_outbox.backlog or monitor.bot_outbox.backlog)
+            if not busy:
+                return
+
+    async def _shutdown(self):
+        await self.monitor.stop()
+        # Whatever the harness itself still has running (review simulations) goes too
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is not current:
+                task.cancel()
+        await asyncio.sleep(0)
+
+    def _report(self, virtual_seconds: float, wall_seconds: float) -> dict:
+        inbound = sum(1 for event in self.stream if not event.get('typing'))
+        stages = {}
+        for stage, samples in sorted(self.recorder.samples.items()):
+            stages[stage] = {
+                'count': len(samples),
+                'p50': percentile(samples, 50),
+                'p90': percentile(samples, 90),
+                'p99': percentile(samples, 99),
+                'max': max(samples),
+            }
+        return {
+            'messages': inbound,
+            'chats': len(self.chats),
+            'virtual_seconds': virtual_seconds,
+            'wall_seconds': wall_seconds,
+            'throughput_per_virtual_second': inbound / virtual_seconds if virtual_seconds else 0.0,
+            'throughput_per_wall_second': inbound / wall_seconds if wall_seconds else 0.0,
+            'review_cards': self._seen_cards,
+            'reviewed': dict(self.reviewed),
+            'approved_sends': sum(1 for sent in self.client.sent),
+            'max_concurrent_gpt_calls': self.openai.max_in_flight,
+            'gpt_cost_usd': {tier: self.monitor.metrics.gpt_cost.value(tier=tier) for tier in ('triage', 'draft')},
+            'stages': stages,
+            'api_calls': dict(sorted(self.recorder.calls.items())),
+        }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        "=== tg-persona offline benchmark ===",
+        f"Messages: {report['messages']} across {report['chats']} chats",
+        f"Virtual time: {report['virtual_seconds']:.0f}s  Wall time: {report['wall_seconds']:.2f}s",
+        f"Throughput: {report['throughput_per_virtual_second']:.3f} msg/virtual s, "
+        f"{report['throughput_per_wall_second']:.0f} msg/wall s",
+        f"Review cards: {report['review_cards']}  Reviewed: {report['reviewed']}  "
+        f"Sent to chats: {report['approved_sends']}",
+        f"Max concurrent GPT calls: {report['max_concurrent_gpt_calls']}",
+        f"GPT spend: ${sum(report['gpt_cost_usd'].values()):.4f} (triage ${report['gpt_cost_usd']['triage']:.4f}, "
+        f"draft ${report['gpt_cost_usd']['draft']:.4f})",
+        "",
+        f"{'stage':<22}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}",
+    ]
+    for stage, row in report['stages'].items():
+        lines.append(f"{stage:<22}{row['count']:>8}{row['p50']:>10.3f}{row['p90']:>10.3f}"
+                     f"{row['p99']:>10.3f}{row['max']:>10.3f}")
+    lines.append("")
+    lines.append("API calls:")
+    for name, count in report['api_calls'].items():
+        lines.append(f"  {name:<32}{count:>8}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--replay", help="JSONL message stream to replay instead of synthetic traffic")
+    parser.add_argument("--chats", type=int, default=50, help="synthetic: number of group chats")
+    parser.add_argument("--messages", type=int, default=1000, help="synthetic: number of messages")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--delay", type=float, default=120, help="debounce quiet window in seconds")
+    parser.add_argument("--tg-latency", type=float, default=0.15, help="mean Telegram API latency (s)")
+    parser.add_argument("--gpt-latency", type=float, default=2.5, help="mean OpenAI latency (s)")
+    parser.add_argument("--review-delay", type=float, default=300, help="mean owner review time (s)")
+    parser.add_argument("--approve-rate", type=float, default=0.6)
+    parser.add_argument("--edit-rate", type=float, default=0.2)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of sends hit by a FloodWait")
+    parser.add_argument("--no-stream", action="store_true", help="wait for full drafts instead of streaming them")
+    parser.add_argument("--single-tier", action="store_true", help="one GPT_DRAFT_MODEL call per chat, no triage pass")
+    parser.add_argument("--restart-at", type=float, help="stop and restart the monitor at this stream time (s)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep MessageMonitor's INFO logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    rng = random.Random(args.seed)
+    stream = load_stream(args.replay) if args.replay else synthetic_stream(args.chats, args.messages, rng)
+
+    loop = VirtualClockEventLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        report = loop.run_until_complete(Harness(stream, args).run())
+    finally:
+        loop.close()
+
+    text = json.dumps(report, indent=2) if args.json else format_report(report)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from telethon import TelegramClient
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after ``ttl`` seconds"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class EntityCache:
+    """Caches the owner identity plus user and chat entities.
+
+    Entries expire after a TTL, the least recently used ones are evicted first,
+    and username/title change events invalidate them explicitly.
+    """
+
+    def __init__(self, client: TelegramClient, maxsize: int = 2048, ttl: float = 6 * 3600):
+        self.client = client
+        self.logger = logger
+        self.users = TTLCache(maxsize, ttl)
+        self.chats = TTLCache(maxsize, ttl)
+        self._me = None
+
+    async def get_me(self):
+        """The logged-in account, fetched once"""
+        if self._me is None:
+            self._me = await self.client.get_me()
+        return self._me
+
+    @property
+    def me(self):
+        """The cached owner identity, or None before the first get_me()"""
+        return self._me
+
+    async def get_sender(self, event):
+        """Sender entity for an event, fetching it only on a cache miss"""
+        sender_id = event.sender_id
+        if sender_id is None:
+            return await event.get_sender()
+        sender = self.users.get(sender_id)
+        if sender is None:
+            sender = await event.get_sender()
+            if sender is not None:
+                self.users.set(sender_id, sender)
+        return sender
+
+    async def get_chat(self, event):
+        """Chat entity for an event, fetching it only on a cache miss"""
+        chat_id = event.chat_id
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = event.chat if event.chat else (await event.get_chat())
+            if chat is not None:
+                self.chats.set(chat_id, chat)
+        return chat
+
+    def invalidate_user(self, user_id: int):
+        self.users.pop(user_id)
+        if self._me is not None and self._me.id == user_id:
+            self._me = None
+
+    def invalidate_chat(self, chat_id: int):
+        self.chats.pop(chat_id)
+
+    def stats(self) -> dict:
+        return {
+            'user_hits': self.users.hits,
+            'user_misses': self.users.misses,
+            'chat_hits': self.chats.hits,
+            'chat_misses': self.chats.misses,
+        }
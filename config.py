@@ -2,6 +2,115 @@ from pydantic import BaseModel
 
 GPT_MODEL = "gpt-4o"
 
+# Two-tier routing: GPT_TRIAGE_MODEL only decides should_respond and urgency, and GPT_DRAFT_MODEL writes the
+# reply for the chats that pass (set GPT_TRIAGE_MODEL to None for a single call doing both). A "no" with
+# confidence under TRIAGE_MIN_CONFIDENCE still goes to the drafting model. When the triage call fails,
+# TRIAGE_ON_ERROR = "draft" hands the chat to the drafting model and "skip" drops it.
+GPT_TRIAGE_MODEL = "gpt-4o-mini"
+GPT_DRAFT_MODEL = GPT_MODEL
+TRIAGE_MIN_CONFIDENCE = 60
+TRIAGE_ON_ERROR = "draft"
+
+# USD per 1M tokens as (input, cached input, output), for the spend metrics
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+# LLM dispatch: worker pool size, rate limits (corrected at runtime from response headers) and retries
+LLM_WORKERS = 4
+LLM_REQUESTS_PER_MINUTE = 500
+LLM_TOKENS_PER_MINUTE = 30000
+LLM_MAX_RETRIES = 5
+
+# Prompt token budget per triage call (system prompt included) and cap for a single message.
+# Counted with tiktoken when installed, otherwise estimated from text length.
+GPT_CONTEXT_TOKEN_BUDGET = 3000
+GPT_MAX_MESSAGE_TOKENS = 400
+
+# Stream drafts into the review card as they are generated; edits at most every REVIEW_EDIT_INTERVAL seconds
+GPT_STREAM_DRAFTS = True
+REVIEW_EDIT_INTERVAL = 1.5
+
+# Outbound send queues: messages per second per client, minimum gap between messages to one chat,
+# and how many queued review cards get folded into a single digest
+OUTBOX_USER_PER_SECOND = 1
+OUTBOX_BOT_PER_SECOND = 20
+OUTBOX_PER_CHAT_INTERVAL = 1.0
+OUTBOX_DIGEST_THRESHOLD = 5
+# How long the Approve button waits for the reply to go out before saying it is queued
+APPROVE_SEND_WAIT = 5
+
+# Keep chats matching the filters muted: each mute lasts MUTE_DURATION_SECONDS and is renewed shortly
+# before it runs out, so the chats unmute by themselves once the bot stops. Off by default, it changes
+# the notification settings of the whole account
+MUTE_MATCHING_CHATS = False
+MUTE_DURATION_SECONDS = 30 * 60
+MUTE_RENEW_BEFORE_SECONDS = 5 * 60
+MUTE_REQUEST_SPACING_SECONDS = 2
+
+# Events that arrive while the bot is still starting are held (up to EARLY_EVENT_BUFFER) and handled once
+# it is ready. On shutdown in-flight drafts get to finish and state is flushed within SHUTDOWN_TIMEOUT_SECONDS
+EARLY_EVENT_BUFFER = 1000
+SHUTDOWN_TIMEOUT_SECONDS = 20
+
+# Queued chats are journaled and picked up again after a restart, unless their messages are older than this
+DEBOUNCE_RECOVERY_MAX_AGE_SECONDS = 24 * 3600
+
+# Multi-account mode (python supervisor.py): one worker process per account name, all sharing the database.
+# Each account needs tg_phone_<name> and tg_bot_token_<name> in .env. A group several accounts are in is
+# triaged by whichever worker holds its lease, renewed every third of CHAT_LEASE_SECONDS.
+ACCOUNTS = []
+CHAT_LEASE_SECONDS = 300
+WORKER_RESTART_MAX_BACKOFF_SECONDS = 60
+
+# Local classifier in front of the GPT triage call (needs numpy). "shadow" only logs its verdict next to
+# GPT's, "enforce" skips the call when the chance of a reply being needed is under PREFILTER_SKIP_THRESHOLD,
+# as long as that threshold missed at most PREFILTER_MAX_MISS_RATE of needed replies on held-out data.
+# Mentions always go to GPT. Check it with: python prefilter.py
+PREFILTER_MODE = "shadow"
+PREFILTER_SKIP_THRESHOLD = 0.05
+PREFILTER_MAX_MISS_RATE = 0.02
+PREFILTER_MIN_SAMPLES = 200
+PREFILTER_RETRAIN_SECONDS = 6 * 3600
+
+# Recurring jobs (jobs.py) as cron expressions: minute hour day month weekday. The pending drafts summary
+# goes out at 1 AM and 1 PM UTC; one missed while the bot was down is sent right after start ("catch_up")
+# or dropped ("skip"). The daily stats are logged at local midnight.
+PENDING_SUMMARY_CRON = "0 1,13 * * *"
+PENDING_SUMMARY_TIMEZONE = "UTC"
+PENDING_SUMMARY_MISSED = "catch_up"
+DAILY_STATS_CRON = "0 0 * * *"
+
+# Replies I approved or edited are indexed (SQLite FTS5) and searched before each model call. A past reply
+# to a conversation at least HISTORY_SUGGEST_MIN_SIMILARITY alike (word overlap of the latest messages) is
+# posted at once as a "suggested from history" card, which the model's draft then refines (None: off).
+# Up to HISTORY_FEW_SHOT_EXAMPLES past replies at least HISTORY_EXAMPLE_MIN_SIMILARITY alike are shown to
+# the drafting model as examples.
+HISTORY_SUGGEST_MIN_SIMILARITY = 0.5
+HISTORY_FEW_SHOT_EXAMPLES = 2
+HISTORY_EXAMPLE_MIN_SIMILARITY = 0.2
+
+# Activity alerts, tracked from the message events of eligible groups. "Unanswered": someone outside the team
+# (me and TEAMMATES_USERNAME_LIST) has waited UNANSWERED_ALERT_SECONDS for a reply from our side. "Stale": one
+# of STALE_WATCH_CHATS (chat ids or exact titles; none by default) has been silent for STALE_CHAT_SECONDS.
+UNANSWERED_ALERT_SECONDS = 4 * 3600
+STALE_CHAT_SECONDS = 24 * 3600
+STALE_WATCH_CHATS = []
+
+# Per-message lifecycle spans appended to traces.jsonl (traces_<account>.jsonl per worker); the file moves to
+# traces.jsonl.1 once over TRACE_MAX_BYTES. Show the slowest traces and a per-stage breakdown: python tracing.py
+TRACING_ENABLED = True
+TRACE_MAX_BYTES = 20 * 1024 * 1024
+
+# Cache of triage results keyed on model + prompt + context
+LLM_CACHE_TTL_SECONDS = 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 5000
+
+# Prometheus text endpoint at http://METRICS_HOST:METRICS_PORT/metrics (set the port to None to disable)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
 CHAT_NAME_FILTER = r"absinthe"
 
 # chat title blacklist
@@ -13,6 +122,9 @@ CHAT_TITLE_BLACKLIST = [
     "Absinthe x R40"
 ]
 
+# chat id blacklist (bare or -100 prefixed ids), survives chat renames
+CHAT_ID_BLACKLIST = []
+
 SYSTEM_TONE = """
 Draft responses as Andrew, the the cofounder and CTO of Absinthe. You are providing responses as a customer success assistant at Absinthe, ensuring alignment with company tone and style, for communication to the client.
 All messages are written in the first person, as if you are Andrew. They are also all over SMS so maintain a casual tone.
@@ -117,4 +229,37 @@ class GPT_JSON_SCHEMA(BaseModel):
     urgency: str
     response: str
 
-SYSTEM_PROMPT = "\n\n".join([SYSTEM_TONE, SYSTEM_JSON_SCHEMA_INSTRUCTIONS])
\ No newline at end of file
+SYSTEM_PROMPT = "\n\n".join([SYSTEM_TONE, SYSTEM_JSON_SCHEMA_INSTRUCTIONS])
+
+SYSTEM_TRIAGE_INSTRUCTIONS = """
+You screen group chats for @gama266, cofounder and CTO of Absinthe, and decide whether he needs to reply.
+You do not write the reply.
+
+ You must respond in the following JSON format:
+            {
+                "should_respond": boolean,  // true if the conversation requires a response from @gama266
+                "reason": string,          // brief explanation of why he should respond or not
+                "confidence": integer,      // confidence level from 0-100 in this decision
+                "urgency": string          // urgency level: "low", "medium", or "high"
+            }
+
+            Set should_respond to true if:
+            1. The message explicitly tags or mentions @gama266
+            2. The conversation is directly relevant and requires his input
+            3. The conversation is related to technical questions, debugging, or other issues that require the expertise of a cofounder and CTO
+
+            Set should_respond to false if the conversation is casual chatter, is irrelevant, or is related to marketing activities.
+
+            Set urgency based on:
+            - "high": Critical issues, system outages, or blocking problems
+            - "medium": Important questions or issues that need attention soon
+            - "low": General inquiries or non-time-sensitive matters
+"""
+
+class TRIAGE_JSON_SCHEMA(BaseModel):
+    should_respond: bool
+    reason: str
+    confidence: int
+    urgency: str
+
+TRIAGE_PROMPT = SYSTEM_TRIAGE_INSTRUCTIONS
\ No newline at end of file
@@ -0,0 +1,131 @@
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # optional, falls back to a character based estimate
+    tiktoken = None
+
+# Chat format overhead per message and for priming the reply (OpenAI cookbook numbers)
+TOKENS_PER_MESSAGE = 3
+TOKENS_FOR_REPLY = 3
+
+# Roughly how many characters a token covers when no tokenizer is installed
+CHARS_PER_TOKEN = 4
+
+TRUNCATION_MARK = " …[{} tokens cut]… "
+
+
+def _load_encoder(model: str) -> Optional[Callable[[str], List[int]]]:
+    if tiktoken is None:
+        return None
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return encoding.encode
+
+
+class ContextBuilder:
+    """Fits a chat's recent messages into a prompt token budget.
+
+    The system prompt always goes first and unchanged so the provider can reuse
+    its cached prefix. Single messages longer than ``max_message_tokens`` keep
+    their head and tail, and the oldest turns that no longer fit are folded into
+    one short note about who said what before.
+    """
+
+    def __init__(self, model: str, budget: int = 3000, max_message_tokens: int = 400,
+                 summary_tokens: int = 120):
+        self.model = model
+        self.budget = budget
+        self.max_message_tokens = max_message_tokens
+        self.summary_tokens = summary_tokens
+        self.logger = logger
+        self._encode = _load_encoder(model)
+        self.exact = self._encode is not None
+        if not self.exact:
+            self.logger.info("tiktoken not installed, estimating prompt tokens from text length")
+
+    def count(self, text: str) -> int:
+        if self._encode is not None:
+            return len(self._encode(text))
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(TOKENS_PER_MESSAGE + self.count(m["content"]) for m in messages) + TOKENS_FOR_REPLY
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Keep the start and end of ``text`` within ``max_tokens``"""
+        tokens = self.count(text)
+        if tokens <= max_tokens:
+            return text
+        keep = max(max_tokens - self.count(TRUNCATION_MARK.format(tokens)), 2)
+        # Work in characters scaled by the measured ratio; exact enough for a budget
+        ratio = len(text) / tokens
+        head = int(keep * 2 / 3 * ratio)
+        tail = int(keep / 3 * ratio)
+        return text[:head] + TRUNCATION_MARK.format(tokens - keep) + (text[-tail:] if tail else "")
+
+    def build(self, system_prompt: str, turns: List[Tuple[str, str, str]],
+              preamble: str = None) -> Tuple[List[Dict[str, str]], dict]:
+        """Messages for the API from (role, sender, content) turns, oldest first.
+
+        ``preamble`` is a second system message (e.g. past replies) placed after
+        the system prompt; its tokens are taken off the budget before the turns
+        are fitted. Returns the messages and a dict with the estimated prompt
+        tokens and how many turns were truncated or folded into the summary.
+        """
+        system = [{"role": "system", "content": system_prompt}]
+        if preamble:
+            system.append({"role": "system", "content": preamble})
+        remaining = self.budget - self.count_messages(system)
+        info = {'prompt_tokens': 0, 'truncated': 0, 'summarized': 0, 'turns': len(turns)}
+
+        kept: List[Dict[str, str]] = []
+        older: List[Tuple[str, str, str]] = []
+        # Walk newest to oldest so the latest messages are always the ones kept
+        for index in range(len(turns) - 1, -1, -1):
+            role, sender, content = turns[index]
+            clipped = self.truncate(content, self.max_message_tokens)
+            cost = TOKENS_PER_MESSAGE + self.count(clipped)
+            # Always keep the newest turn, clipped to whatever is left
+            if not kept and cost > remaining:
+                clipped = self.truncate(content, max(remaining - TOKENS_PER_MESSAGE, 1))
+                cost = TOKENS_PER_MESSAGE + self.count(clipped)
+            if kept and cost > remaining - self.summary_tokens:
+                older = turns[:index + 1]
+                break
+            if clipped is not content:
+                info['truncated'] += 1
+            kept.append({"role": role, "content": clipped})
+            remaining -= cost
+        kept.reverse()
+
+        if older:
+            info['summarized'] = len(older)
+            kept.insert(0, {"role": "user", "content": self._summarize(older)})
+
+        messages = system + kept
+        info['prompt_tokens'] = self.count_messages(messages)
+        return messages, info
+
+    def _summarize(self, turns: List[Tuple[str, str, str]]) -> str:
+        """One line per sender with their message count and latest words"""
+        latest: Dict[str, str] = {}
+        counts: Dict[str, int] = {}
+        for _, sender, content in turns:
+            counts[sender] = counts.get(sender, 0) + 1
+            latest[sender] = content
+        lines = [f"[{len(turns)} earlier messages condensed]"]
+        budget = self.summary_tokens - self.count(lines[0]) - TOKENS_PER_MESSAGE
+        per_sender = max(budget // max(len(counts), 1), 8)
+        for sender, count in counts.items():
+            line = self.truncate(f"{sender} ({count}): {' '.join(latest[sender].split())}", per_sender)
+            if self.count(line) > budget:
+                break
+            lines.append(line)
+            budget -= self.count(line) + 1
+        return "\n".join(lines)
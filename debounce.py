@@ -0,0 +1,125 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class DebounceScheduler:
+    """Fires a callback once a key has been quiet for ``delay`` seconds.
+
+    All deadlines live in one min-heap served by a single runner task, so
+    resetting a key is an O(log n) push instead of a cancelled and re-created
+    task. Superseded heap entries are skipped lazily when they surface.
+    """
+
+    def __init__(self, delay: float, callback: Callable[[Hashable], Awaitable[None]]):
+        self.delay = delay
+        self.callback = callback
+        self.logger = logger
+        self._deadlines: Dict[Hashable, float] = {}
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+    def _now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    def start(self):
+        """Start the runner task"""
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the runner; callbacks already firing are left to finish"""
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    def touch(self, key: Hashable, delay: float = None, extend_only: bool = False):
+        """(Re)arm the deadline for ``key``
+
+        With ``extend_only`` the deadline is only ever pushed later, never
+        pulled earlier, and keys that are not pending are left alone.
+        """
+        deadline = self._now() + (self.delay if delay is None else delay)
+        current = self._deadlines.get(key)
+        if extend_only and (current is None or current >= deadline):
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if self._heap[0][2] == key:
+            # New earliest deadline, the runner may be sleeping on a later one
+            self._wakeup.set()
+        if len(self._heap) > 64 and len(self._heap) > 4 * len(self._deadlines):
+            self._compact()
+
+    def cancel(self, key: Hashable):
+        """Forget the deadline for ``key`` without firing"""
+        self._deadlines.pop(key, None)
+
+    def pending(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def deadline(self, key: Hashable) -> Optional[float]:
+        """Loop-time deadline for ``key``, or None if it is not pending"""
+        return self._deadlines.get(key)
+
+    async def drain(self):
+        """Wait for the callbacks that are already firing"""
+        while self._running:
+            await asyncio.gather(*list(self._running), return_exceptions=True)
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    @property
+    def firing(self) -> int:
+        """Number of callbacks currently running"""
+        return len(self._running)
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+        heapq.heapify(self._heap)
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) != deadline:
+                # Superseded by a later touch() or cancelled
+                heapq.heappop(self._heap)
+                continue
+
+            timeout = deadline - self._now()
+            if timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            del self._deadlines[key]
+            task = asyncio.create_task(self._fire(key))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, key: Hashable):
+        try:
+            await self.callback(key)
+        except Exception as e:
+            self.logger.error(f"Error in debounce callback for {key}: {str(e)}")
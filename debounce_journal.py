@@ -0,0 +1,84 @@
+import logging
+import time
+from typing import Dict, List
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class DebounceJournal:
+    """SQLite journal of the messages waiting out a chat's quiet window.
+
+    A row is appended for every queued message and the chat's rows are
+    deleted once its queue has been processed, so after a restart the table
+    holds exactly the chats that still owe a triage. Appends go through the
+    coalescing write queue and cost nothing on the message path. Each worker
+    of a multi-account deployment only recovers its own ``owner`` rows.
+    """
+
+    def __init__(self, storage: Storage, max_age: float = 24 * 3600, owner: str = ''):
+        self.storage = storage
+        self.owner = owner
+        self.max_age = max_age
+        self.logger = logger
+
+    async def init(self):
+        await self.storage.execute_schema([
+            '''
+                CREATE TABLE IF NOT EXISTS debounce_journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    owner TEXT NOT NULL DEFAULT '',
+                    chat_id INTEGER NOT NULL,
+                    peer_id INTEGER NOT NULL,  -- marked id, resolvable from the session cache
+                    message_id INTEGER NOT NULL,
+                    sender_id INTEGER NULL,
+                    text TEXT NULL,
+                    mentioned INTEGER NOT NULL DEFAULT 0,
+                    queued_at REAL NOT NULL
+                )
+            ''',
+        ])
+        # Journals from single-account versions predate the owner column
+        await self.storage.ensure_column('debounce_journal', 'owner', "TEXT NOT NULL DEFAULT ''")
+        await self.storage.execute_schema([
+            'CREATE INDEX IF NOT EXISTS idx_debounce_journal_chat ON debounce_journal(owner, chat_id, message_id)',
+        ])
+
+    def append(self, chat_id: int, peer_id: int, message_id: int, sender_id: int, text: str,
+               mentioned: bool, queued_at: float):
+        self.storage.submit('''
+            INSERT INTO debounce_journal (owner, chat_id, peer_id, message_id, sender_id, text, mentioned, queued_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (self.owner, chat_id, peer_id, message_id, sender_id, text, int(mentioned), queued_at))
+
+    def clear(self, chat_id: int, up_to_message_id: int = None):
+        """Forget the chat's journaled messages (up to and including ``up_to_message_id``)"""
+        if up_to_message_id is None:
+            self.storage.submit('DELETE FROM debounce_journal WHERE owner = ? AND chat_id = ?',
+                                (self.owner, chat_id))
+        else:
+            self.storage.submit('DELETE FROM debounce_journal WHERE owner = ? AND chat_id = ? AND message_id <= ?',
+                                (self.owner, chat_id, up_to_message_id))
+
+    async def load(self) -> Dict[int, List[dict]]:
+        """Journaled messages per chat, oldest first; rows older than ``max_age`` are dropped"""
+        cutoff = time.time() - self.max_age
+        stale = await self.storage.fetchone(
+            'SELECT COUNT(*) FROM debounce_journal WHERE owner = ? AND queued_at < ?', (self.owner, cutoff)
+        )
+        if stale and stale[0]:
+            self.logger.warning(f"Dropping {stale[0]} journaled messages older than {self.max_age / 3600:.0f}h")
+            await self.storage.execute('DELETE FROM debounce_journal WHERE owner = ? AND queued_at < ?',
+                                       (self.owner, cutoff))
+        rows = await self.storage.fetchall('''
+            SELECT chat_id, peer_id, message_id, sender_id, text, mentioned, queued_at
+            FROM debounce_journal WHERE owner = ? ORDER BY chat_id, message_id
+        ''', (self.owner,))
+        chats: Dict[int, List[dict]] = {}
+        for chat_id, peer_id, message_id, sender_id, text, mentioned, queued_at in rows:
+            chats.setdefault(chat_id, []).append({
+                'peer_id': peer_id, 'message_id': message_id, 'sender_id': sender_id, 'text': text,
+                'mentioned': bool(mentioned), 'queued_at': queued_at,
+            })
+        return chats
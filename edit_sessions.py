@@ -0,0 +1,68 @@
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class EditSessions:
+    """Which draft each owner is currently editing.
+
+    One row per owner, so starting a new edit replaces the previous one and a
+    reply is routed with a single dict lookup. Sessions expire after ``ttl``
+    seconds and are kept in SQLite so an edit started before a restart can
+    still be finished after it.
+    """
+
+    def __init__(self, storage: Storage, ttl: float = 3600):
+        self.storage = storage
+        self.ttl = ttl
+        self.logger = logger
+        # owner_id -> (message_id, expires_at)
+        self._sessions: Dict[int, Tuple[str, float]] = {}
+
+    async def init(self):
+        await self.storage.execute_schema(['''
+            CREATE TABLE IF NOT EXISTS edit_sessions (
+                owner_id INTEGER PRIMARY KEY,
+                message_id TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        '''])
+        await self.storage.execute('DELETE FROM edit_sessions WHERE expires_at <= ?', (time.time(),))
+        rows = await self.storage.fetchall('SELECT owner_id, message_id, expires_at FROM edit_sessions')
+        self._sessions = {owner_id: (message_id, expires_at) for owner_id, message_id, expires_at in rows}
+        if self._sessions:
+            self.logger.info(f"Resumed {len(self._sessions)} edit session(s)")
+
+    async def start(self, owner_id: int, message_id: str):
+        """Make ``message_id`` the draft the owner's next reply edits"""
+        now = time.time()
+        self._sessions[owner_id] = (message_id, now + self.ttl)
+        await self.storage.execute('''
+            INSERT OR REPLACE INTO edit_sessions (owner_id, message_id, started_at, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', (owner_id, message_id, now, now + self.ttl))
+
+    def active(self, owner_id: int) -> Optional[str]:
+        """The draft being edited, or None if there is no live session"""
+        session = self._sessions.get(owner_id)
+        if session is None:
+            return None
+        message_id, expires_at = session
+        if expires_at <= time.time():
+            del self._sessions[owner_id]
+            self.storage.submit('DELETE FROM edit_sessions WHERE owner_id = ?', (owner_id,))
+            return None
+        return message_id
+
+    async def end(self, owner_id: int, message_id: str = None):
+        """Close the owner's session (only if it is still on ``message_id`` when given)"""
+        session = self._sessions.get(owner_id)
+        if session is None or (message_id is not None and session[0] != message_id):
+            return
+        del self._sessions[owner_id]
+        await self.storage.execute('DELETE FROM edit_sessions WHERE owner_id = ?', (owner_id,))
@@ -0,0 +1,69 @@
+import importlib
+import logging
+import re
+from typing import Dict, Optional
+
+from telethon import utils
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class ChatEligibilityIndex:
+    """Remembers, per chat id, whether a group chat should be processed.
+
+    The decision is computed once from the filters in config.py
+    (CHAT_NAME_FILTER, CHAT_TITLE_BLACKLIST, CHAT_ID_BLACKLIST) and then served
+    from a dict. Title changes update a single entry and reload() rebuilds the
+    whole index from a freshly imported config.
+    """
+
+    def __init__(self):
+        self.logger = logger
+        self._eligible: Dict[int, bool] = {}
+        self._titles: Dict[int, str] = {}
+        self._load_filters()
+
+    @staticmethod
+    def _bare_id(chat_id: int) -> int:
+        # Accept both marked (-100...) and bare ids
+        return utils.resolve_id(chat_id)[0]
+
+    def _load_filters(self):
+        self.name_filter = re.compile(config.CHAT_NAME_FILTER, re.IGNORECASE)
+        self.title_blacklist = frozenset(config.CHAT_TITLE_BLACKLIST)
+        self.id_blacklist = frozenset(self._bare_id(chat_id) for chat_id in getattr(config, 'CHAT_ID_BLACKLIST', []))
+
+    def _compute(self, chat_id: int, title: str) -> bool:
+        if chat_id in self.id_blacklist or title in self.title_blacklist:
+            return False
+        return bool(self.name_filter.search(title or ""))
+
+    def is_eligible(self, chat_id: int, title: str) -> bool:
+        """Whether messages in this chat should be queued for drafting"""
+        eligible = self._eligible.get(chat_id)
+        if eligible is None:
+            eligible = self._compute(chat_id, title)
+            self._eligible[chat_id] = eligible
+            self._titles[chat_id] = title
+        return eligible
+
+    def update_title(self, chat_id: int, title: str):
+        """Re-evaluate a chat after it has been renamed"""
+        chat_id = self._bare_id(chat_id)
+        self._titles[chat_id] = title
+        self._eligible[chat_id] = self._compute(chat_id, title)
+        self.logger.info(f"Chat {chat_id} renamed to {title}, eligible: {self._eligible[chat_id]}")
+
+    def reload(self) -> int:
+        """Re-import config.py and rebuild every known entry; returns the eligible count"""
+        importlib.reload(config)
+        self._load_filters()
+        self._eligible = {chat_id: self._compute(chat_id, title) for chat_id, title in self._titles.items()}
+        eligible = sum(self._eligible.values())
+        self.logger.info(f"Reloaded chat filters: {eligible}/{len(self._eligible)} known chats eligible")
+        return eligible
+
+    def title(self, chat_id: int) -> Optional[str]:
+        return self._titles.get(chat_id)
@@ -0,0 +1,128 @@
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+
+from telethon import TelegramClient
+
+logger = logging.getLogger(__name__)
+
+
+class ChatHistory:
+    """Bounded per-chat ring buffer of recent messages.
+
+    Fed from the NewMessage events the client already receives (incoming and
+    outgoing), backfilled once from Telegram the first time a chat is seen,
+    and only falls back to Telegram when a query needs more than it holds.
+    """
+
+    def __init__(self, client: TelegramClient, maxlen: int = 100, backfill_limit: int = 50):
+        self.client = client
+        self.maxlen = maxlen
+        self.backfill_limit = backfill_limit
+        self.logger = logger
+        self._buffers: Dict[int, Deque[dict]] = {}
+        self._ids: Dict[int, Set[int]] = {}
+        # Chats whose buffer reaches back to the start of the chat
+        self._complete: Set[int] = set()
+        self.stats = {'hits': 0, 'misses': 0, 'backfills': 0}
+
+    @staticmethod
+    def _entry(message, sender=None) -> dict:
+        sender = sender if sender is not None else message.sender
+        return {
+            'id': message.id,
+            'sender_id': message.sender_id,
+            'username': getattr(sender, 'username', None),
+            'text': message.text,
+            'date': message.date,
+            'out': bool(message.out),
+        }
+
+    def _append(self, chat_id: int, entry: dict):
+        buffer = self._buffers.setdefault(chat_id, deque(maxlen=self.maxlen))
+        ids = self._ids.setdefault(chat_id, set())
+        if entry['id'] in ids:
+            return
+        if len(buffer) == buffer.maxlen:
+            ids.discard(buffer[0]['id'])
+            self._complete.discard(chat_id)
+        buffer.append(entry)
+        ids.add(entry['id'])
+
+    def record(self, chat_id: int, message, sender=None):
+        """Add a live message to the chat's buffer"""
+        self._append(chat_id, self._entry(message, sender))
+
+    def is_backfilled(self, chat_id: int) -> bool:
+        return chat_id in self._buffers
+
+    async def ensure_backfilled(self, chat_id: int, chat):
+        """Seed the buffer from Telegram the first time a chat is seen"""
+        if chat_id in self._buffers:
+            return
+        self._buffers[chat_id] = deque(maxlen=self.maxlen)
+        self._ids[chat_id] = set()
+        try:
+            messages = [m async for m in self.client.iter_messages(chat, limit=self.backfill_limit)]
+        except Exception as e:
+            self.logger.error(f"Error backfilling history for chat {chat_id}: {str(e)}")
+            return
+        self.stats['backfills'] += 1
+        # iter_messages yields newest first
+        for message in reversed(messages):
+            self._append(chat_id, self._entry(message))
+        if len(messages) < self.backfill_limit:
+            self._complete.add(chat_id)
+
+    async def last_message(self, chat_id: int, chat) -> Optional[dict]:
+        """Most recent message in the chat"""
+        buffer = self._buffers.get(chat_id)
+        if buffer:
+            self.stats['hits'] += 1
+            return buffer[-1]
+        self.stats['misses'] += 1
+        async for message in self.client.iter_messages(chat, limit=1):
+            return self._entry(message)
+        return None
+
+    async def recent_unique_senders(self, chat_id: int, chat, max_unique_senders: int) -> List[dict]:
+        """Text messages, oldest first, going back until more than
+        ``max_unique_senders`` sender changes have been seen"""
+        buffer = self._buffers.get(chat_id)
+        if buffer is not None:
+            result = self._walk(reversed(buffer), max_unique_senders, partial=chat_id in self._complete)
+            if result is not None:
+                self.stats['hits'] += 1
+                return result
+
+        # Not enough history held in memory, ask Telegram
+        self.stats['misses'] += 1
+        messages = [
+            self._entry(message)
+            async for message in self.client.iter_messages(chat, limit=max(self.backfill_limit, self.maxlen))
+        ]
+        return self._walk(messages, max_unique_senders, partial=True)
+
+    @staticmethod
+    def _walk(entries, max_unique_senders: int, partial: bool = False) -> Optional[List[dict]]:
+        """Collect newest-first entries until the sender limit is exceeded
+
+        Returns None if the entries ran out first, unless ``partial`` is set.
+        """
+        collected = []
+        unique_senders = []
+        for entry in entries:
+            if entry['sender_id'] is None or not entry['text']:
+                continue
+            sender = entry['username'] or str(entry['sender_id'])
+            # Add sender if they're different from the last sender
+            if not unique_senders or sender != unique_senders[-1]:
+                unique_senders.append(sender)
+            if len(unique_senders) > max_unique_senders:
+                collected.reverse()
+                return collected
+            collected.append(entry)
+        if not partial:
+            return None
+        collected.reverse()
+        return collected
@@ -0,0 +1,389 @@
+"""One scheduler for every recurring job.
+
+    python jobs.py    check the cron and missed-run handling against a ManualClock
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple, Union
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+CATCH_UP = 'catch_up'  # a run missed while stopped happens right after start (once, however many were missed)
+SKIP = 'skip'  # missed runs are dropped, the job waits for its next slot
+
+# Longest single sleep, so a wall clock jump (suspend, NTP step) is noticed within this many seconds
+MAX_SLEEP_SECONDS = 60
+
+
+def resolve_timezone(tz: Union[str, tzinfo, None]) -> Optional[tzinfo]:
+    """tzinfo for a name like "UTC" or "Europe/Berlin"; None means the local time zone"""
+    if tz is None or isinstance(tz, tzinfo):
+        return tz
+    if tz.upper() == 'UTC':
+        return timezone.utc
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(tz)
+
+
+class Clock:
+    """Wall clock time and sleeping, for the scheduler to be driven by something else in tests"""
+
+    def now(self) -> float:
+        return time.time()
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+
+class LoopClock(Clock):
+    """Wall clock time advanced by the event loop's clock, e.g. the virtual clock in bench.py"""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._offset = 0.0
+
+    def now(self) -> float:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._offset = time.time() - self._loop.time()
+        return self._offset + self._loop.time()
+
+
+class ManualClock(Clock):
+    """Clock that only moves when advance() is called; sleepers wake as their time is reached"""
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+        self._sleepers: List[Tuple[float, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    def now(self) -> float:
+        return self._now
+
+    async def sleep(self, seconds: float):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self._now + max(seconds, 0), next(self._counter), future))
+        await future
+
+    async def advance(self, seconds: float):
+        """Move time forward, letting every job that comes due along the way run"""
+        target = self._now + seconds
+        await self._settle()
+        while self._sleepers and self._sleepers[0][0] <= target:
+            wake_at, _, future = heapq.heappop(self._sleepers)
+            self._now = max(self._now, wake_at)
+            if not future.done():
+                future.set_result(None)
+            await self._settle()
+        self._now = target
+
+    @staticmethod
+    async def _settle():
+        # Let woken tasks run (and their jobs finish) before time moves on
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+
+class Interval:
+    """Every ``seconds``, counted from the start of the previous run"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def first(self, now: float) -> float:
+        return now
+
+    def next_after(self, t: float) -> float:
+        return t + self.seconds
+
+    def __repr__(self):
+        return f"every {self.seconds:g}s"
+
+
+class Cron:
+    """Standard five field cron expression (minute hour day month weekday) in a time zone.
+
+    Fields take ``*``, numbers, ``a-b`` ranges, ``/step`` and comma lists;
+    weekday 0 and 7 are Sunday. As in cron, when both day of month and
+    weekday are restricted a day matching either one counts.
+    """
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str, tz: Union[str, tzinfo, None] = None):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        minutes, hours, days, months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self._RANGES)
+        )
+        self.expression = expression
+        self.tz = resolve_timezone(tz)
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> FrozenSet[int]:
+        values = set()
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = (int(value) for value in span.split('-', 1))
+            else:
+                start = end = int(span)
+                if step:
+                    end = high
+            step = int(step) if step else 1
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Bad cron field {field!r}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, day) -> bool:
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        # cron counts Sunday as 0, Python as 6
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def first(self, now: float) -> float:
+        return self.next_after(now)
+
+    def next_after(self, t: float) -> float:
+        start = datetime.fromtimestamp(t, self.tz).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.date()
+        for _ in range(366 * 5):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime(day.year, day.month, day.day, hour, minute, tzinfo=self.tz)
+                        if candidate >= start:
+                            return candidate.timestamp()
+            day += timedelta(days=1)
+        raise ValueError(f"Cron expression {self.expression!r} never matches")
+
+    def __repr__(self):
+        return f"cron {self.expression!r}" + (f" {self.tz}" if self.tz else "")
+
+
+class Job:
+    def __init__(self, name: str, schedule, func: Callable[[], Awaitable[None]], missed: str, jitter: float,
+                 on_start: bool):
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.missed = missed
+        self.jitter = jitter
+        self.on_start = on_start
+        self.last_run: Optional[float] = None
+        self.due: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class JobScheduler:
+    """Runs every recurring job off one heap of due times.
+
+    Jobs have an ``Interval`` or ``Cron`` schedule, an optional random
+    ``jitter`` added to each due time and a policy for runs missed while the
+    process was down (``CATCH_UP`` or ``SKIP``), decided from the last run
+    times kept in the ``job_runs`` table. A job never overlaps itself: a run
+    that comes due while the previous one is still going is skipped. Time
+    comes from ``clock``, so a test can step through a day with a
+    ``ManualClock`` in milliseconds.
+    """
+
+    def __init__(self, storage: Storage, clock: Clock = None, owner: str = ''):
+        self.storage = storage
+        self.clock = clock or Clock()
+        self.owner = owner
+        self.logger = logger
+        self.jobs: Dict[str, Job] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._counter = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, name: str, schedule, func: Callable[[], Awaitable[None]], missed: str = SKIP,
+            jitter: float = 0.0, on_start: bool = False):
+        """Register a job; call before init()
+
+        ``on_start`` runs it right after every start whatever its last run,
+        for jobs whose result only lives in memory.
+        """
+        if missed not in (CATCH_UP, SKIP):
+            raise ValueError(f"Unknown missed run policy {missed!r}")
+        self.jobs[name] = Job(name, schedule, func, missed, jitter, on_start)
+
+    async def init(self):
+        await self.storage.execute_schema([
+            '''
+                CREATE TABLE IF NOT EXISTS job_runs (
+                    owner TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    last_run REAL NOT NULL,
+                    duration REAL NULL,
+                    error TEXT NULL,
+                    PRIMARY KEY (owner, name)
+                )
+            ''',
+        ])
+        rows = await self.storage.fetchall('SELECT name, last_run FROM job_runs WHERE owner = ?', (self.owner,))
+        last_runs = dict(rows)
+        now = self.clock.now()
+        for job in self.jobs.values():
+            job.last_run = last_runs.get(job.name)
+            if job.on_start:
+                due = now
+            elif job.last_run is None:
+                due = job.schedule.first(now)
+            else:
+                due = job.schedule.next_after(job.last_run)
+                if due < now:
+                    if job.missed == CATCH_UP:
+                        self.logger.info(f"Job {job.name} missed its run at "
+                                         f"{datetime.fromtimestamp(due):%Y-%m-%d %H:%M}, running it now")
+                        due = now
+                    else:
+                        due = job.schedule.next_after(now)
+            self._push(job, due)
+
+    def _push(self, job: Job, due: float):
+        if job.jitter:
+            due += random.uniform(0, job.jitter)
+        job.due = due
+        heapq.heappush(self._heap, (due, next(self._counter), job.name))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop scheduling and cancel the runs still going"""
+        tasks = [self._task] + [job.task for job in self.jobs.values()]
+        for task in tasks:
+            if task and not task.done():
+                task.cancel()
+        for task in tasks:
+            if task:
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+
+    async def _run(self):
+        while self._heap:
+            due, _, name = self._heap[0]
+            delay = due - self.clock.now()
+            if delay > 0:
+                await self.clock.sleep(min(delay, MAX_SLEEP_SECONDS))
+                continue
+            heapq.heappop(self._heap)
+            job = self.jobs[name]
+            started = self.clock.now()
+            if job.task and not job.task.done():
+                self.logger.warning(f"Job {job.name} is still running, skipping this run")
+            else:
+                job.task = asyncio.create_task(self._execute(job, started))
+            self._push(job, job.schedule.next_after(started))
+
+    async def _execute(self, job: Job, started: float):
+        error = None
+        try:
+            await job.func()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e)
+            self.logger.error(f"Error in job {job.name}: {error}")
+        job.last_run = started
+        self.storage.submit('''
+            INSERT INTO job_runs (owner, name, last_run, duration, error) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (owner, name) DO UPDATE SET
+                last_run = excluded.last_run, duration = excluded.duration, error = excluded.error
+        ''', (self.owner, job.name, started, self.clock.now() - started, error))
+
+
+async def _check():
+    """Step a twice-daily summary across its cron slots and over a missed run, CATCH_UP vs SKIP"""
+    def at(day: int, hour: int, minute: int = 0) -> float:
+        return datetime(2024, 5, day, hour, minute, tzinfo=timezone.utc).timestamp()
+
+    def hours(runs: List[float]) -> List[str]:
+        return [f"{datetime.fromtimestamp(run, timezone.utc):%d %H:%M}" for run in runs]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        storage = Storage(os.path.join(workdir, 'jobs.db'))
+        await storage.open()
+        clock = ManualClock(at(1, 0, 30))
+        runs: Dict[str, List[float]] = {CATCH_UP: [], SKIP: []}
+        trained: Dict[str, List[float]] = {CATCH_UP: [], SKIP: []}
+
+        def scheduler(missed: str) -> JobScheduler:
+            jobs = JobScheduler(storage, clock, owner=missed)
+
+            async def summary():
+                runs[missed].append(clock.now())
+
+            jobs.add('pending_summary', Cron("0 1,13 * * *", "UTC"), summary, missed=missed)
+
+            async def train():
+                trained[missed].append(clock.now())
+
+            jobs.add('prefilter_train', Interval(6 * 3600), train, missed=missed, on_start=True)
+            return jobs
+
+        schedulers = [scheduler(CATCH_UP), scheduler(SKIP)]
+        for jobs in schedulers:
+            await jobs.init()
+            jobs.start()
+        await clock.advance(at(1, 13, 5) - clock.now())
+        for missed in (CATCH_UP, SKIP):
+            assert hours(runs[missed]) == ["01 01:00", "01 13:00"], (missed, hours(runs[missed]))
+        for jobs in schedulers:
+            await jobs.stop()
+        await storage.flush()
+
+        # Down from 13:05 until 02:00 the next day, so the 01:00 run was missed
+        await clock.advance(at(2, 2) - clock.now())
+        schedulers = [scheduler(CATCH_UP), scheduler(SKIP)]
+        for jobs in schedulers:
+            await jobs.init()
+            jobs.start()
+        await clock.advance(at(2, 13, 5) - clock.now())
+        for jobs in schedulers:
+            await jobs.stop()
+        await storage.close()
+
+    assert hours(runs[CATCH_UP])[2:] == ["02 02:00", "02 13:00"], hours(runs[CATCH_UP])
+    assert hours(runs[SKIP])[2:] == ["02 13:00"], hours(runs[SKIP])
+    # An in-memory job runs on every start, then every 6 hours
+    for missed in (CATCH_UP, SKIP):
+        assert hours(trained[missed]) == ["01 00:30", "01 06:30", "01 12:30", "02 02:00", "02 08:00"], \
+            hours(trained[missed])
+    for missed in (CATCH_UP, SKIP):
+        print(f"{missed:<9} ran at {', '.join(hours(runs[missed]))}")
+
+
+if __name__ == "__main__":
+    started = time.perf_counter()
+    asyncio.run(_check())
+    print(f"OK in {(time.perf_counter() - started) * 1000:.0f} ms")
@@ -0,0 +1,267 @@
+import asyncio
+import itertools
+import logging
+import random
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+import jiter
+import openai
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first
+PRIORITY_MENTION = 0
+PRIORITY_PRIVATE = 1
+PRIORITY_AMBIENT = 2
+
+# Rough completion size reserved from the token bucket before a call
+EXPECTED_COMPLETION_TOKENS = 500
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset headers such as '1s', '6m0s' or '120ms' into seconds"""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    """Cheap prompt size estimate (~4 characters per token)"""
+    return sum(len(message.get('content') or '') for message in messages) // 4 + 4 * len(messages)
+
+
+def completion_cost(prices: Optional[tuple], usage) -> float:
+    """USD cost of one call from its usage and (input, cached input, output) prices per 1M tokens"""
+    if not prices or usage is None:
+        return 0.0
+    input_price, cached_price, output_price = prices
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+    return ((usage.prompt_tokens - cached) * input_price + cached * cached_price
+            + usage.completion_tokens * output_price) / 1_000_000
+
+
+class TokenBucket:
+    """Token bucket refilled continuously, corrected by the server's rate limit headers"""
+
+    def __init__(self, capacity: float, per_seconds: float = 60):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = asyncio.get_running_loop().time()
+        if self._updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        """Wait until ``amount`` tokens are available and take them"""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def refund(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def update(self, limit: Optional[float], remaining: Optional[float], reset_seconds: Optional[float]):
+        """Adopt the server's view of the bucket from x-ratelimit-* headers"""
+        if remaining is None:
+            return
+        self._refill()
+        if limit:
+            self.capacity = limit
+        self.tokens = min(self.tokens, remaining)
+        if reset_seconds and self.capacity > remaining:
+            # Headers report how long until the bucket is full again
+            self.rate = (self.capacity - remaining) / reset_seconds
+
+
+class LLMScheduler:
+    """Central dispatch queue for chat completion calls.
+
+    Requests are served by a fixed pool of workers in priority order, gated by
+    request and token buckets that follow the API's rate limit headers, and
+    retried with jittered exponential backoff on rate limit and transient
+    errors.
+    """
+
+    def __init__(self, openai_client: AsyncOpenAI, workers: int = 4, requests_per_minute: int = 500,
+                 tokens_per_minute: int = 30000, max_retries: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        self.openai_client = openai_client
+        self.workers = workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.logger = logger
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._workers: List[asyncio.Task] = []
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'rate_limited': 0}
+
+    def start(self):
+        """Start the worker pool"""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers and fail whatever is still queued"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while not self._queue.empty():
+            *_, future = self._queue.get_nowait()
+            if not future.done():
+                future.cancel()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def parse(self, priority: int = PRIORITY_AMBIENT, **kwargs) -> Any:
+        """Queue a beta.chat.completions.parse call and wait for its completion"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._counter), (kwargs, None), future))
+        return await future
+
+    async def stream(self, on_snapshot: Callable[[dict], Any], priority: int = PRIORITY_AMBIENT, **kwargs) -> Any:
+        """Like parse(), but streams the completion.
+
+        ``on_snapshot`` is awaited with the partially parsed JSON object each
+        time new content arrives. A retried call starts again from an empty
+        snapshot. Returns the final parsed completion.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._counter), (kwargs, on_snapshot), future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            _, _, (kwargs, on_snapshot), future = await self._queue.get()
+            if future.cancelled():
+                continue
+            self.in_flight += 1
+            try:
+                result = await self._call_with_retries(kwargs, on_snapshot)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                self.stats['failures'] += 1
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.in_flight -= 1
+                # Cancelled by stop() mid-call; without this the caller would wait forever
+                if not future.done():
+                    future.cancel()
+
+    def _backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after:
+            return retry_after + random.uniform(0, self.base_delay)
+        # Full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _call_with_retries(self, kwargs: Dict[str, Any], on_snapshot: Callable[[dict], Any] = None) -> Any:
+        estimate = estimate_tokens(kwargs.get('messages', [])) + EXPECTED_COMPLETION_TOKENS
+        attempt = 0
+        while True:
+            try:
+                return await self._attempt(kwargs, on_snapshot, estimate)
+            except RETRYABLE_ERRORS as e:
+                retry_after = None
+                if isinstance(e, openai.RateLimitError):
+                    self.stats['rate_limited'] += 1
+                    self._update_limits(e.response.headers)
+                    retry_after = parse_reset_duration(e.response.headers.get('retry-after'))
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, retry_after)
+                attempt += 1
+                self.stats['retries'] += 1
+                self.logger.warning(f"LLM call failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _attempt(self, kwargs: Dict[str, Any], on_snapshot: Callable[[dict], Any], estimate: int) -> Any:
+        """One API call, paid for from the buckets and settled against the usage it reports"""
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimate)
+        self.stats['requests'] += 1
+        try:
+            if on_snapshot is not None:
+                completion = await self._stream_once(kwargs, on_snapshot)
+            else:
+                raw = await self.openai_client.beta.chat.completions.with_raw_response.parse(**kwargs)
+                completion = raw.parse()
+                self._update_limits(raw.headers)
+        except BaseException:
+            # No usage came back, so the estimate must not hold up the calls after it
+            self.tokens.refund(estimate)
+            raise
+        if completion.usage:
+            self.tokens.refund(max(0, estimate - completion.usage.total_tokens))
+        return completion
+
+    async def _stream_once(self, kwargs: Dict[str, Any], on_snapshot: Callable[[dict], Any]) -> Any:
+        async with self.openai_client.beta.chat.completions.stream(
+            stream_options={"include_usage": True}, **kwargs
+        ) as stream:
+            async for event in stream:
+                if event.type != "content.delta":
+                    continue
+                # event.parsed drops an unfinished trailing string, so the response would only show up whole
+                try:
+                    parsed = jiter.from_json(event.snapshot.encode(), partial_mode="trailing-strings")
+                except ValueError:
+                    continue
+                if isinstance(parsed, dict):
+                    await on_snapshot(parsed)
+            return await stream.get_final_completion()
+
+    def _update_limits(self, headers):
+        def number(name: str) -> Optional[float]:
+            value = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        self.requests.update(
+            number('x-ratelimit-limit-requests'),
+            number('x-ratelimit-remaining-requests'),
+            parse_reset_duration(headers.get('x-ratelimit-reset-requests')),
+        )
+        self.tokens.update(
+            number('x-ratelimit-limit-tokens'),
+            number('x-ratelimit-remaining-tokens'),
+            parse_reset_duration(headers.get('x-ratelimit-reset-tokens')),
+        )
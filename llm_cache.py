@@ -0,0 +1,84 @@
+import hashlib
+import json
+import logging
+import time
+from typing import List, Optional
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class LLMResultCache:
+    """Content-addressed SQLite cache of raw LLM responses.
+
+    Entries are keyed on a hash of the model and the full message list
+    (system prompt included), expire after ``ttl`` seconds and are trimmed to
+    ``max_entries`` by least recent use.
+    """
+
+    def __init__(self, storage: Storage, ttl: float = 24 * 3600, max_entries: int = 5000, evict_every: int = 100):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.logger = logger
+        self._puts = 0
+        self.stats = {'hits': 0, 'misses': 0}
+
+    async def init(self):
+        await self.storage.execute_schema([
+            '''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT,
+                    created_at REAL,
+                    last_hit_at REAL
+                )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_llm_cache_last_hit ON llm_cache(last_hit_at)',
+        ])
+
+    @staticmethod
+    def key(model: str, messages: List[dict]) -> str:
+        payload = json.dumps([model, messages], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Cached response for ``key``, or None on a miss"""
+        now = time.time()
+        row = await self.storage.fetchone(
+            'SELECT response FROM llm_cache WHERE key = ? AND created_at >= ?',
+            (key, now - self.ttl)
+        )
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        await self.storage.execute('UPDATE llm_cache SET last_hit_at = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    async def put(self, key: str, model: str, response: str):
+        now = time.time()
+        await self.storage.execute(
+            'INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, last_hit_at) VALUES (?, ?, ?, ?, ?)',
+            (key, model, response, now, now)
+        )
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            await self.evict()
+
+    async def evict(self):
+        """Drop expired entries and trim the table to max_entries"""
+        await self.storage.execute('DELETE FROM llm_cache WHERE created_at < ?', (time.time() - self.ttl,))
+        await self.storage.execute('''
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
@@ -1,19 +1,41 @@
-from telethon import TelegramClient, events, Button
+from telethon import TelegramClient, events, utils
 from telethon.types import Message
-from typing import Dict, List, Pattern, Tuple
+from typing import Awaitable, Callable, Deque, Dict, Pattern, Tuple
+from collections import deque
 import re
 import asyncio
+import functools
 import logging
+import signal
 import os
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
-from config import SYSTEM_PROMPT, CHAT_NAME_FILTER, CHAT_TITLE_BLACKLIST, GPT_MODEL, GPT_JSON_SCHEMA
-from datetime import datetime, timedelta, time
-import aiosqlite
+from config import SYSTEM_PROMPT, GPT_MODEL, GPT_JSON_SCHEMA, LLM_WORKERS, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_RETRIES, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_ENTRIES, METRICS_HOST, METRICS_PORT, GPT_CONTEXT_TOKEN_BUDGET, GPT_MAX_MESSAGE_TOKENS, GPT_STREAM_DRAFTS, REVIEW_EDIT_INTERVAL, OUTBOX_USER_PER_SECOND, OUTBOX_BOT_PER_SECOND, OUTBOX_PER_CHAT_INTERVAL, OUTBOX_DIGEST_THRESHOLD, APPROVE_SEND_WAIT, MUTE_MATCHING_CHATS, MUTE_DURATION_SECONDS, MUTE_RENEW_BEFORE_SECONDS, MUTE_REQUEST_SPACING_SECONDS, EARLY_EVENT_BUFFER, SHUTDOWN_TIMEOUT_SECONDS, DEBOUNCE_RECOVERY_MAX_AGE_SECONDS, CHAT_LEASE_SECONDS, PREFILTER_MODE, PREFILTER_SKIP_THRESHOLD, PREFILTER_MAX_MISS_RATE, PREFILTER_MIN_SAMPLES, PREFILTER_RETRAIN_SECONDS, GPT_TRIAGE_MODEL, GPT_DRAFT_MODEL, TRIAGE_PROMPT, TRIAGE_JSON_SCHEMA, TRIAGE_MIN_CONFIDENCE, TRIAGE_ON_ERROR, MODEL_PRICES, UNANSWERED_ALERT_SECONDS, STALE_CHAT_SECONDS, STALE_WATCH_CHATS, TEAMMATES_USERNAME_LIST, PENDING_SUMMARY_CRON, PENDING_SUMMARY_TIMEZONE, PENDING_SUMMARY_MISSED, DAILY_STATS_CRON, HISTORY_SUGGEST_MIN_SIMILARITY, HISTORY_FEW_SHOT_EXAMPLES, HISTORY_EXAMPLE_MIN_SIMILARITY, TRACING_ENABLED, TRACE_MAX_BYTES
+from datetime import datetime, timedelta
 import json
-from telethon.tl import functions
-from telethon.tl.types import InputPeerNotifySettings, InputNotifyPeer
-import pickle
+from telethon.tl import types
+from storage import Storage, DB_PATH
+from debounce import DebounceScheduler
+from debounce_journal import DebounceJournal
+from history import ChatHistory
+from cache import EntityCache
+from eligibility import ChatEligibilityIndex
+from llm import LLMScheduler, PRIORITY_MENTION, PRIORITY_AMBIENT, completion_cost
+from llm_cache import LLMResultCache
+from metrics import MonitorMetrics, MetricsServer
+from stats_store import StatsStore
+from pending import PendingStore, URGENCIES, APPROVED, EDITED, REJECTED
+from context_builder import ContextBuilder
+from review_stream import StreamingReviewCard
+from edit_sessions import EditSessions
+from outbox import Outbox, DeliveryUncertain, build_buttons
+from mute import DialogIndex, MuteScheduler
+from shards import ChatShards
+from prefilter import Prefilter
+from activity import ChatActivity, INBOUND, OUTBOUND, TEAMMATE, UNANSWERED
+from jobs import JobScheduler, Clock, Cron, Interval, CATCH_UP
+from reply_index import ReplyIndex
+from tracing import Tracer, traced
 
 load_dotenv()
 
@@ -30,12 +52,15 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+URGENCY_EMOJI = {'high': "🚨", 'medium': "🟠", 'low': "🟢"}
+
 class MessageMonitor:
     async def _init_db(self):
-        """Initialize SQLite database and create necessary tables"""
-        async with aiosqlite.connect('telegram_monitor.db') as db:
+        """Open the shared storage connection and create necessary tables"""
+        await self.storage.open()
+        await self.storage.execute_schema([
             # Existing messages table
-            await db.execute('''
+            '''
                 CREATE TABLE IF NOT EXISTS message_tracking (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -46,68 +71,67 @@ class MessageMonitor:
                     action TEXT DEFAULT 'pending',
                     FOREIGN KEY (chat_id) REFERENCES chats(id)
                 )
-            ''')
-            
-            # New pending messages table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS pending_messages (
-                    message_id TEXT PRIMARY KEY,
-                    chat_id INTEGER,
-                    response TEXT,
-                    context BLOB,  -- Will store pickled context list
-                    confidence INTEGER,
-                    urgency TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            await db.commit()
-
-    async def _save_pending_message(self, message_id: str, message_data: dict):
-        """Save a pending message to the database"""
-        async with aiosqlite.connect('telegram_monitor.db') as db:
-            await db.execute('''
-                INSERT OR REPLACE INTO pending_messages 
-                (message_id, chat_id, response, context, confidence, urgency)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                message_id,
-                message_data['chat_id'],
-                message_data['response'],
-                pickle.dumps(message_data['context']),
-                message_data['confidence'],
-                message_data['urgency']
-            ))
-            await db.commit()
-
-    async def _load_pending_messages(self):
-        """Load all pending messages from the database"""
-        async with aiosqlite.connect('telegram_monitor.db') as db:
-            async with db.execute('SELECT * FROM pending_messages') as cursor:
-                rows = await cursor.fetchall()
-                result = {}
-                for row in rows:
-                    result[row[0]] = {
-                        'chat_id': row[1],
-                        'response': row[2],
-                        'context': pickle.loads(row[3]),
-                        'confidence': row[4],
-                        'urgency': row[5]
-                    }
-                return result
-
-    async def _delete_pending_message(self, message_id: str):
-        """Delete a pending message from the database"""
-        async with aiosqlite.connect('telegram_monitor.db') as db:
-            await db.execute('DELETE FROM pending_messages WHERE message_id = ?', (message_id,))
-            await db.commit()
-
-    def __init__(self, api_id: str,  api_hash: str, phone: str, bot_token: str, openai_api_key: str):
-        self.client = TelegramClient('user_session', api_id, api_hash)
-        self.bot = TelegramClient('bot_session', api_id, api_hash)
+            ''',
+        ])
+        # Link tracking rows to the draft they describe (added after the table shipped)
+        await self.storage.ensure_column('message_tracking', 'message_id', 'TEXT NULL')
+        await self.storage.execute_schema([
+            'CREATE INDEX IF NOT EXISTS idx_message_tracking_message_id ON message_tracking(message_id)',
+        ])
+        await self.replies.init()
+        # Pending drafts (migrates the legacy pickled table on first run)
+        await self.pending.init()
+        await self.edit_sessions.init()
+        await self.user_outbox.init()
+        await self.bot_outbox.init()
+        await self.llm_cache.init()
+        await self.stats.init()
+        await self.journal.init()
+        await self.prefilter.init()
+        await self.activity.init()
+        await self.jobs.init()
+        if self.shards:
+            await self.shards.init()
+
+    async def _track_message(self, message_id: str, message_data: dict):
+        """Record a new draft in the message_tracking history"""
+        await self.storage.execute('''
+            INSERT INTO message_tracking (message_id, chat_id, message_context, gpt_response)
+            VALUES (?, ?, ?, ?)
+        ''', (
+            message_id,
+            message_data['chat_id'],
+            "\n".join(message_data['context']),
+            message_data['response']
+        ))
+
+    async def _update_tracking(self, message_id: str, action: str, edited_text: str = None):
+        """Update the action (and edited text) of a tracked draft"""
+        if edited_text is None:
+            await self.storage.execute(
+                'UPDATE message_tracking SET action = ? WHERE message_id = ?',
+                (action, message_id)
+            )
+        else:
+            await self.storage.execute(
+                'UPDATE message_tracking SET action = ?, edited_text = ? WHERE message_id = ?',
+                (action, edited_text, message_id)
+            )
+
+    def __init__(self, api_id: str,  api_hash: str, phone: str, bot_token: str, openai_api_key: str,
+                 client: TelegramClient = None, bot: TelegramClient = None, openai_client: AsyncOpenAI = None,
+                 db_path: str = DB_PATH, account: str = None, llm_share: float = 1.0,
+                 metrics_port: int = METRICS_PORT, clock: Clock = None):
+        # client/bot/openai_client/db_path/clock can be swapped out, e.g. for the offline harness in bench.py
+        # account names this worker in a multi-account deployment (see supervisor.py); llm_share is the
+        # part of the OpenAI rate limits it may use
+        self.account = account
+        suffix = f'_{account}' if account else ''
+        self.client = client or TelegramClient(f'user_session{suffix}', api_id, api_hash)
+        self.bot = bot or TelegramClient(f'bot_session{suffix}', api_id, api_hash)
         # self.delay_time_seconds = 1 # debug
-        # self.delay_check_interval_seconds = 1 # debug
         self.delay_time_seconds = 120 
-        self.delay_check_interval_seconds = 15 
+        self.typing_delay_seconds = 60  # keep waiting while people are still typing
         self.max_unique_senders = 2
         self.bot_token = bot_token
         self.phone = phone
@@ -115,61 +139,263 @@ class MessageMonitor:
         self.logger = logger
         self.tg_username = None
         self.openai_api_key = openai_api_key
-        self.openai_client = AsyncOpenAI(api_key=openai_api_key)
-        self.pending_messages = {}  # Will be populated after DB initialization
-        self.stats = {
-            'group_chat_replies': 0,
-            'tagged_messages': 0,
-            'private_chats': 0,
-            'total_messages_processed': 0,
-            'absinthe_group_messages': 0
-        }
-        self._schedule_daily_stats_reset()
-        asyncio.create_task(self._init_and_load_db())
-        self.last_message_times = {}  # Store last message time for each chat
+        # Retries are handled by the LLM scheduler so they respect its rate limits
+        self.openai_client = openai_client or AsyncOpenAI(api_key=openai_api_key, max_retries=0)
+        self.llm = LLMScheduler(
+            self.openai_client,
+            workers=LLM_WORKERS,
+            requests_per_minute=LLM_REQUESTS_PER_MINUTE * llm_share,
+            tokens_per_minute=LLM_TOKENS_PER_MINUTE * llm_share,
+            max_retries=LLM_MAX_RETRIES
+        )
+        self.storage = Storage(db_path)
+        self.llm_cache = LLMResultCache(self.storage, ttl=LLM_CACHE_TTL_SECONDS, max_entries=LLM_CACHE_MAX_ENTRIES)
+        self.stream_drafts = GPT_STREAM_DRAFTS
+        # Small model deciding should_respond before GPT_DRAFT_MODEL writes anything (None: one call does both)
+        self.triage_model = GPT_TRIAGE_MODEL
+        # Local classifier trained on past triage decisions; skips GPT for obvious chatter once trusted
+        self.prefilter = Prefilter(self.storage, mode=PREFILTER_MODE, threshold=PREFILTER_SKIP_THRESHOLD,
+                                   min_samples=PREFILTER_MIN_SAMPLES, max_miss_rate=PREFILTER_MAX_MISS_RATE)
+        self.context_builder = ContextBuilder(GPT_MODEL, budget=GPT_CONTEXT_TOKEN_BUDGET,
+                                              max_message_tokens=GPT_MAX_MESSAGE_TOKENS)
+        # Full-text index of the replies I approved, searched for a ready answer before each model call
+        self.replies = ReplyIndex(self.storage)
+        self.pending = PendingStore(self.storage, owner=account)  # Drafts waiting for review, loaded on demand
+        self.edit_sessions = EditSessions(self.storage)  # Which draft my next bot message edits
+        # Rate limited, FloodWait aware send queues; approved replies and review cards are durable
+        # A reply that may or may not have gone out is reported to me instead of risking it twice in a customer chat
+        self.user_outbox = Outbox(self.storage, self.client, f'user:{account}' if account else 'user', per_second=OUTBOX_USER_PER_SECOND,
+                                  per_chat_interval=OUTBOX_PER_CHAT_INTERVAL, on_uncertain=self._report_uncertain_send)
+        self.bot_outbox = Outbox(self.storage, self.bot, f'bot:{account}' if account else 'bot', per_second=OUTBOX_BOT_PER_SECOND,
+                                 per_chat_interval=OUTBOX_PER_CHAT_INTERVAL,
+                                 digest_threshold=OUTBOX_DIGEST_THRESHOLD, digest=self._render_digest)
+        # Durable per-minute/hour/day counters, e.g. total_messages_processed, tagged_messages
+        self.stats = StatsStore(self.storage)
         self.message_queues = {}      # Store queued messages for each chat
-        self.processing_tasks = {}    # Store processing tasks for each chat
-        self.delay_tasks = {}  # Store the delay tasks for each chat
-        # asyncio.create_task(self._mute_matching_chats()) # fixme: for now, turned off
-        self.notification_times = (time(1, 0), time(13, 0)) # in UTC time # 1 AM and 1 PM UTC
-        self._schedule_pending_messages_notifications()
+        # The queued messages are journaled so a restart does not forget chats waiting out their quiet window
+        self.journal = DebounceJournal(self.storage, max_age=DEBOUNCE_RECOVERY_MAX_AGE_SECONDS, owner=account or '')
+        # With several accounts sharing the database, a group we are all in is triaged by one worker only
+        self.shards = ChatShards(self.storage, account, lease=CHAT_LEASE_SECONDS) if account else None
+        self.entities = EntityCache(self.client)  # Owner identity, users and chats
+        self.eligibility = ChatEligibilityIndex()  # chat_id -> should this group be processed
+        # Group chats I'm in, kept current from events, and the mute renewals for the matching ones
+        self.dialogs = DialogIndex(self.client)
+        self.muter = MuteScheduler(self.client, self.dialogs, self.eligibility.is_eligible,
+                                   duration=MUTE_DURATION_SECONDS, renew_before=MUTE_RENEW_BEFORE_SECONDS,
+                                   spacing=MUTE_REQUEST_SPACING_SECONDS)
+        self.history = ChatHistory(self.client)  # Recent messages per chat, fed by NewMessage events
+        # Last inbound/outbound/teammate message per group, alerting on chats left unanswered or gone quiet
+        self.teammates = frozenset(username.lower() for username in TEAMMATES_USERNAME_LIST)
+        self.stale_watch = frozenset(STALE_WATCH_CHATS)
+        self.activity = ChatActivity(self.storage, self._send_activity_alert, stale_after=STALE_CHAT_SECONDS,
+                                     unanswered_after=UNANSWERED_ALERT_SECONDS,
+                                     is_high_value=lambda chat_id, title: bool(self.stale_watch & {chat_id, title}))
+        # Single deadline heap that fires _delayed_processing once a chat goes quiet
+        self.debouncer = DebounceScheduler(self.delay_time_seconds, self._delayed_processing)
+        self.metrics = MonitorMetrics()
+        self.metrics.pending_drafts.set_function(lambda: self.pending.count)
+        self.metrics.active_delays.set_function(lambda: len(self.debouncer) + self.debouncer.firing)
+        self.metrics.llm_queue_depth.set_function(lambda: self.llm.queue_depth)
+        self.metrics.llm_in_flight.set_function(lambda: self.llm.in_flight)
+        self.metrics_server = MetricsServer(self.metrics.registry, METRICS_HOST, metrics_port) if metrics_port else None
+        # Recurring jobs, with their last runs kept in the job_runs table
+        self.jobs = JobScheduler(self.storage, clock, owner=account or '')
+        self.jobs.add('daily_stats', Cron(DAILY_STATS_CRON), self._log_daily_stats, missed=CATCH_UP)
+        self.jobs.add('pending_summary', Cron(PENDING_SUMMARY_CRON, PENDING_SUMMARY_TIMEZONE),
+                      self._send_pending_messages_summary, missed=PENDING_SUMMARY_MISSED)
+        # The model only lives in memory, so it is trained on every start. Jitter keeps the workers of a
+        # multi-account deployment from all retraining at once
+        self.jobs.add('prefilter_train', Interval(PREFILTER_RETRAIN_SECONDS), self.prefilter.train,
+                      missed=CATCH_UP, jitter=60, on_start=True)
+        # Timed spans of each chat round, from the first message through review to the send (see tracing.py)
+        self.tracer = Tracer(f'traces{suffix}.jsonl', max_bytes=TRACE_MAX_BYTES, clock=self.jobs.clock.now,
+                             enabled=TRACING_ENABLED)
+        self._chat_traces: Dict[int, Tuple[str, float]] = {}  # chat_id -> (trace_id, first message received)
+        # Handlers only run once start() is done; events that come in before are held here in order
+        self._ready = asyncio.Event()
+        self._stopping = False
+        self._early_events: Deque[Tuple[Callable[..., Awaitable[None]], object]] = deque()
 
-    async def _init_and_load_db(self):
-        """Initialize database and load pending messages"""
-        await self._init_db()
-        self.pending_messages = await self._load_pending_messages()
+    async def _timed(self, phase: str, coro: Awaitable):
+        """Await one startup phase, logging and exporting how long it took"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await coro
+        elapsed = loop.time() - started
+        self.metrics.startup_seconds.set(elapsed, phase=phase)
+        self.logger.info(f"Startup phase {phase} took {elapsed:.2f}s")
+        return result
 
-    async def start(self):
-        """Start the client and message monitoring"""
-        # start user client
+    async def _start_user_client(self):
         await self.client.start(phone=self.phone)
-        self.logger.info("Client started successfully")
-        me = await self.client.get_me()
+        me = await self.entities.get_me()
         self.tg_username = me.username
+        self.replies.me = me.username
         self.logger.info(f"Logged in as {me.first_name}. Username: {self.tg_username}")
+        if MUTE_MATCHING_CHATS:
+            # Index my group chats now, the muter would otherwise do it once it starts
+            await self._timed('dialogs', self.dialogs.build())
 
-        # start bot client
+    async def _start_bot_client(self):
         await self.bot.start(bot_token=self.bot_token)
-        bot_me = await self.bot.get_me()
+        await self.bot.get_me()
         self.logger.info("Bot client started successfully")
 
+    async def start(self):
+        """Connect both clients and open the database concurrently, then start handling events"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        # Handlers go in first so nothing that arrives while connecting is lost; they hold events until ready
+        self._register_handlers()
+        await asyncio.gather(
+            self._timed('database', self._init_db()),
+            self._timed('user_client', self._start_user_client()),
+            self._timed('bot_client', self._start_bot_client()),
+        )
+        await self._timed('recovery', self._recover_debounced_chats())
+
+        self.debouncer.start()
+        self.llm.start()
+        self.stats.start()
+        self.tracer.start()
+        self.activity.start()
+        if self.shards:
+            self.shards.start()
+        if MUTE_MATCHING_CHATS:
+            self.muter.start()
+        self.user_outbox.start()
+        self.bot_outbox.start()
+        if self.metrics_server:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                self.logger.error(f"Error starting metrics endpoint: {str(e)}")
+        self.jobs.start()
+
+        await self._replay_early_events()
+        self.metrics.startup_seconds.set(loop.time() - started, phase='total')
+        self.logger.info(f"Ready in {loop.time() - started:.2f}s")
+
+    async def _recover_debounced_chats(self):
+        """Re-queue the chats whose quiet window was cut short by the last shutdown.
+
+        Only chats with journaled messages are looked at: their recent history
+        is fetched to catch up on what was said meanwhile, chats I have replied
+        to since are dropped and the rest fire when their window runs out
+        (right away if it already has).
+        """
+        journaled = await self.journal.load()
+        requeued = answered = 0
+        for chat_id, rows in journaled.items():
+            try:
+                if self.shards and not await self.shards.claim(chat_id):
+                    # Taken over by another worker while I was down
+                    self.journal.clear(chat_id)
+                    continue
+                indexed = self.dialogs.chats.get(chat_id)
+                chat = indexed['peer'] if indexed else await self.client.get_input_entity(rows[-1]['peer_id'])
+                await self.history.ensure_backfilled(chat_id, chat)
+                last_message = await self.history.last_message(chat_id, chat)
+                if last_message and (last_message['out'] or last_message['username'] == self.tg_username):
+                    self.journal.clear(chat_id)
+                    answered += 1
+                    continue
+                queue = self.message_queues.setdefault(chat_id, [])
+                for row in rows:
+                    queue.append({
+                        'text': row['text'],
+                        'sender': None,
+                        'timestamp': datetime.fromtimestamp(row['queued_at']),
+                        'chat': chat,
+                        'mentioned': row['mentioned'],
+                        'message_id': row['message_id'],
+                    })
+                last_activity = rows[-1]['queued_at']
+                if last_message:
+                    last_activity = max(last_activity, last_message['date'].timestamp())
+                quiet_left = last_activity + self.delay_time_seconds - datetime.now().timestamp()
+                self.debouncer.touch(chat_id, max(quiet_left, 0.0))
+                requeued += 1
+            except Exception as e:
+                self.logger.error(f"Error recovering queued chat {chat_id}: {str(e)}")
+        if journaled:
+            self.logger.info(f"Recovered {requeued} queued chats from the journal, "
+                             f"{answered} already answered")
+
+    def _gated(self, handler: Callable[..., Awaitable[None]]):
+        """Hold events for ``handler`` until start() is done, drop them once stopping"""
+        @functools.wraps(handler)
+        async def wrapper(event):
+            if self._stopping:
+                return
+            if not self._ready.is_set():
+                if len(self._early_events) >= EARLY_EVENT_BUFFER:
+                    self._early_events.popleft()
+                    self.metrics.early_events.inc(outcome='dropped')
+                self._early_events.append((handler, event))
+                return
+            await handler(event)
+        return wrapper
+
+    async def _replay_early_events(self):
+        """Handle the events held during startup in arrival order, then open the gate"""
+        replayed = 0
+        # Events arriving during the replay queue up behind it; the gate opens once none are left
+        while self._early_events:
+            handler, event = self._early_events.popleft()
+            try:
+                await handler(event)
+            except Exception as e:
+                self.logger.error(f"Error handling early event: {str(e)}")
+            replayed += 1
+        self._ready.set()
+        if replayed:
+            self.metrics.early_events.inc(replayed, outcome='replayed')
+            self.logger.info(f"Handled {replayed} events that arrived during startup")
+
+    def _register_handlers(self):
+        """Attach the client and bot event handlers, all behind the readiness gate"""
          # Set up callback query handler for button clicks
         @self.bot.on(events.CallbackQuery)
+        @self._gated
         async def handle_callback(event):
             await self._handle_button_press(event)
 
         # Add message handler for bot to ignore other users
         @self.bot.on(events.NewMessage)
+        @self._gated
         async def handle_bot_messages(event):
-            me = await self.client.get_me()
+            me = await self.entities.get_me()
             if event.sender_id != me.id:
                     await event.reply("Sorry, I only respond to my owner.")
                     return
 
+            command = event.raw_text.strip().lower()
+            editing = self.edit_sessions.active(me.id)
+            if editing and not command.startswith('/'):
+                await self._handle_edit_reply(event, me, editing)
+            elif command == '/reload':
+                eligible = self.eligibility.reload()
+                self.muter.refresh()
+                await event.reply(f"🔄 Chat filters reloaded, {eligible} known chats eligible")
+            elif command == '/stats':
+                await event.reply(self.metrics.summary())
+            elif command == '/unanswered':
+                await event.reply(self._render_unanswered())
+            elif command == '/cancel' and editing:
+                await self.edit_sessions.end(me.id)
+                await event.reply("Edit cancelled, the draft is still pending")
+            elif command.split(maxsplit=1)[:1] == ['/pending']:
+                args = command.split()[1:]
+                await self._repost_pending(me, args[0] if args and args[0] in URGENCIES else None)
+
         @self.client.on(events.NewMessage)
+        @self._gated
         async def handle_new_message(event: events.NewMessage.Event):
             """Handle incoming messages and check against patterns"""
-            self.stats['total_messages_processed'] += 1
+            stats_chat_id = utils.resolve_id(event.chat_id)[0] if event.chat_id else None
+            self.stats.incr('total_messages_processed', stats_chat_id)
+            self.metrics.messages.inc(kind='group' if event.is_group else 'private')
             
             message_text = event.message.text
             group_chat = event.is_group
@@ -177,31 +403,45 @@ class MessageMonitor:
             is_private_chat = False
 
             if await self._check_mentions(event):
-                self.stats['tagged_messages'] += 1
-                chat = await event.get_chat()
+                self.stats.incr('tagged_messages', stats_chat_id)
+                chat = await self.entities.get_chat(event)
                 chat_name = chat.title if hasattr(chat, 'title') else f"Private chat with {chat.first_name}"
-                sender = await event.get_sender()
+                sender = await self.entities.get_sender(event)
                 sender_name = sender.first_name
                 mentioned = True
                 self.logger.info(f"You were mentioned by {sender_name} in {chat_name}")
                 self.logger.info(f"Message: {message_text}")
 
             if group_chat:
-                chat_from = event.chat if event.chat else (await event.get_chat())
+                chat_from = await self.entities.get_chat(event)
                 chat_title = chat_from.title
                 chat_id = chat_from.id
+                self.dialogs.observe(chat_id, chat_from)
+
+                if self.eligibility.is_eligible(chat_id, chat_title):
+                    if self.shards and not await self.shards.claim(chat_id):
+                        # Another account's worker triages this group
+                        return
+                    received = self.tracer.now()
+                    sender = await self.entities.get_sender(event)
+                    # Keep the in-memory history current, including my own outgoing messages
+                    backfill_started = None if self.history.is_backfilled(chat_id) else self.tracer.now()
+                    await self.history.ensure_backfilled(chat_id, chat_from)
+                    backfill_ended = self.tracer.now()
+                    self.history.record(chat_id, event.message, sender)
+                    self.activity.observe(chat_id, chat_title, self._activity_kind(event, sender),
+                                          event.message.date.timestamp() if event.message.date else None)
 
-                if re.search(CHAT_NAME_FILTER, chat_title, re.IGNORECASE) and chat_title not in CHAT_TITLE_BLACKLIST:
                     # Get the last message sender before processing
-                    async for msg in self.client.iter_messages(chat_from, limit=1):
-                        sender = await msg.get_sender()
-                        if sender and sender.username == self.tg_username:
-                            self.logger.info("Last message was sent by me, ignoring...")
-                            return
+                    last_message = await self.history.last_message(chat_id, chat_from)
+                    if last_message and (last_message['out'] or last_message['username'] == self.tg_username):
+                        self.stats.incr('my_messages', chat_id)
+                        self.logger.info("Last message was sent by me, ignoring...")
+                        return
+
+                    self.stats.incr('absinthe_group_messages', chat_id)
 
-                    # Update last message time
                     current_time = datetime.now()
-                    self.last_message_times[chat_id] = current_time
 
                     # Initialize message queue if needed
                     if chat_id not in self.message_queues:
@@ -210,24 +450,61 @@ class MessageMonitor:
                     # Add message to queue
                     self.message_queues[chat_id].append({
                         'text': event.message.text,
-                        'sender': await event.get_sender(),
+                        'sender': sender,
                         'timestamp': current_time,
-                        'chat': chat_from
+                        'chat': chat_from,
+                        'mentioned': mentioned,
+                        'message_id': event.message.id
                     })
+                    self.journal.append(chat_id, event.chat_id, event.message.id, event.sender_id,
+                                        event.message.text, mentioned, current_time.timestamp())
 
-                    if chat_id in self.delay_tasks:
-                        # Cancel existing delay task
-                        self.delay_tasks[chat_id].cancel()
+                    # (Re)arm the quiet-window deadline for this chat
+                    self.debouncer.touch(chat_id)
 
-                    # Create new delay task
-                    self.delay_tasks[chat_id] = asyncio.create_task(self._delayed_processing(chat_id))
+                    # The messages of one quiet window share a trace, which the draft carries on
+                    trace_id, _ = self._chat_traces.setdefault(chat_id, (self.tracer.new_trace(), received))
+                    if backfill_started is not None:
+                        self.tracer.record(trace_id, 'history_backfill', backfill_started, backfill_ended)
+                    self.tracer.record(trace_id, 'handle_new_message', received, chat_id=chat_id,
+                                       message_id=event.message.id)
             else:
-                self.stats['private_chats'] += 1
+                self.stats.incr('private_chats', stats_chat_id)
                 self.logger.info(f"Private chat with: {event.sender_id}")
 
             for pattern, callback in self.patterns.items():
                 if re.search(pattern, message_text):
                     await callback(event)
+
+        @self.client.on(events.UserUpdate)
+        @self._gated
+        async def handle_typing(event: events.UserUpdate.Event):
+            """Hold back processing while someone is still typing in a queued chat"""
+            if event.typing and event.chat_id is not None:
+                # chat_id is marked (-100...) while the queue is keyed by the bare id
+                chat_id, _ = utils.resolve_id(event.chat_id)
+                self.debouncer.touch(chat_id, self.typing_delay_seconds, extend_only=True)
+
+        @self.client.on(events.ChatAction)
+        @self._gated
+        async def handle_chat_action(event: events.ChatAction.Event):
+            """Drop cached chat entities and re-check eligibility when a chat is renamed"""
+            if event.new_title:
+                self.entities.invalidate_chat(event.chat_id)
+                self.eligibility.update_title(event.chat_id, event.new_title)
+                self.dialogs.rename(event.chat_id, event.new_title)
+            elif (event.user_left or event.user_kicked) and self.entities.me and event.user_id == self.entities.me.id:
+                # I left or was removed: stop keeping the chat muted
+                self.dialogs.remove(event.chat_id)
+
+        @self.client.on(events.Raw(types.UpdateUserName))
+        @self._gated
+        async def handle_username_change(update: types.UpdateUserName):
+            """Drop cached user entities when someone changes their username"""
+            self.entities.invalidate_user(update.user_id)
+            me = await self.entities.get_me()
+            if me.id == update.user_id:
+                self.tg_username = me.username
             
     async def _check_mentions(self, event: events.NewMessage.Event) -> bool:
         """Check if the user was mentioned in the message"""
@@ -245,81 +522,339 @@ class MessageMonitor:
             
         return False
     
-    async def _call_gpt(self, message_contexts: list[str], original_chat_id: int) -> Tuple[str, bool]:
+    @traced('call_gpt')
+    async def _call_gpt(self, message_contexts: list[str], original_chat_id: int, priority: int = PRIORITY_AMBIENT) -> Tuple[str, bool]:
         """Call the GPT API with the message and send to bot for approval"""
+        card = None
+        suggestion = None
         try:
             # Get your user ID first
-            me = await self.client.get_me()
-            
-            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            me = await self.entities.get_me()
+
+            # Mentions always get a GPT decision; everything else may be settled locally
+            context_text = "\n".join(message_contexts)
+            prefilter_score = None if priority == PRIORITY_MENTION else self.prefilter.score(context_text)
+            if self.prefilter.should_skip(prefilter_score):
+                self.logger.info(f"Prefilter skipped {original_chat_id} (reply chance {prefilter_score:.3f})")
+                self.stats.incr('prefilter_skips', original_chat_id)
+                self.metrics.prefilter_skips.inc()
+                self.prefilter.record(original_chat_id, context_text, False, 'prefilter', prefilter_score)
+                return "", False
             
+            turns = []
             for msg in message_contexts:
                 sender, content = msg.split(": ", 1)
                 role = "assistant" if sender == self.tg_username else "user"
-                messages.append({"role": role, "content": content})
+                username = re.search(r"<([^>]*)>", sender)
+                turns.append((role, username.group(1) if username else sender, content))
+
+            # A reply I approved to a very similar conversation goes out for review now; the model refines it
+            with self.tracer.span('history_search') as span:
+                history_matches = await self.replies.search(message_contexts, limit=max(HISTORY_FEW_SHOT_EXAMPLES, 1))
+                span['matches'] = len(history_matches)
+            if history_matches and me and me.id and HISTORY_SUGGEST_MIN_SIMILARITY is not None \
+                    and history_matches[0]['similarity'] >= HISTORY_SUGGEST_MIN_SIMILARITY:
+                suggestion = await self._suggest_from_history(me, history_matches[0], message_contexts,
+                                                              original_chat_id)
+            examples = [match for match in history_matches
+                        if match['similarity'] >= HISTORY_EXAMPLE_MIN_SIMILARITY][:HISTORY_FEW_SHOT_EXAMPLES]
+
+            decoded_gpt_response = None
+            # Cheap triage pass first; mentions always get a draft, so they go straight to the drafting model
+            if self.triage_model and priority != PRIORITY_MENTION:
+                decoded_gpt_response, source = await self._triage(turns, original_chat_id, priority)
+
+            if decoded_gpt_response is None:
+                # SYSTEM_PROMPT stays the first message, byte for byte, so the cached prefix is reused
+                # Examples go after the system prompt, so its cached prefix still matches
+                messages = self._fit_context(SYSTEM_PROMPT, turns, original_chat_id, examples)
+                # With review cards piling up in the outbox, skip streaming so they fold into a digest;
+                # a suggestion from history already has its card
+                if self.stream_drafts and me and me.id and not self.bot_outbox.congested and suggestion is None:
+                    # Post the card as soon as should_respond and urgency are known, then fill it in
+                    card = StreamingReviewCard(
+                        self.bot, me.id,
+                        lambda partial, text: self._render_review(partial, message_contexts, text),
+                        edit_interval=REVIEW_EDIT_INTERVAL,
+                        post=lambda text: self.bot_outbox.send(me.id, text, kind='stream'),
+                    )
+                raw_gpt_response, source = await self._complete(
+                    'draft', GPT_DRAFT_MODEL, GPT_JSON_SCHEMA, messages, original_chat_id, priority,
+                    on_snapshot=card.update if card is not None else None
+                )
+                self.logger.info(f"Raw GPT response: {raw_gpt_response}")
+                decoded_gpt_response = json.loads(raw_gpt_response)
 
-            # call openai api
-            response = await self.openai_client.beta.chat.completions.parse(
-                model=GPT_MODEL,
-                response_format=GPT_JSON_SCHEMA,
-                messages=messages
-            )
-            
-            raw_gpt_response = response.choices[0].message.content
-            self.logger.info(f"Raw GPT response: {raw_gpt_response}")
-            decoded_gpt_response = json.loads(raw_gpt_response)
             gpt_response = decoded_gpt_response['response']
             should_respond = True if decoded_gpt_response['should_respond'] else False
+            message_id = suggestion['message_id'] if suggestion else f"{original_chat_id}_{datetime.now().timestamp()}"
+            self.prefilter.record(original_chat_id, context_text, should_respond, source, prefilter_score,
+                                  message_id if should_respond else None)
+            if prefilter_score is not None:
+                self.metrics.prefilter_shadow.inc(
+                    prefilter='skip' if prefilter_score < self.prefilter.threshold else 'pass',
+                    gpt='respond' if should_respond else 'ignore'
+                )
         
             if not should_respond:
                 self.logger.info(f"Skipping response for {original_chat_id} because: {decoded_gpt_response['reason']}")
+                if card is not None and card.posted:
+                    await card.discard(f"Skipped: {decoded_gpt_response['reason']}")
+                if suggestion is not None:
+                    await self._refine_suggestion(me, suggestion, message_contexts, decoded_gpt_response)
             
             # Only proceed if we're sending to the bot owner
             if me and me.id and should_respond: 
-                message_id = f"{original_chat_id}_{datetime.now().timestamp()}"
-                
                 # Create message data
                 message_data = {
                     'response': gpt_response,
                     'chat_id': original_chat_id,
                     'context': message_contexts,
                     'confidence': decoded_gpt_response['confidence'],
-                    'urgency': decoded_gpt_response['urgency']
+                    'urgency': decoded_gpt_response['urgency'],
+                    'created_at': datetime.now().timestamp()
                 }
                 
-                # Save to database
-                await self._save_pending_message(message_id, message_data)
-                self.pending_messages[message_id] = message_data
+                # Save to database (a suggestion from history already is)
+                if suggestion is None:
+                    await asyncio.gather(
+                        self.pending.add(message_id, message_data),
+                        self._track_message(message_id, message_data)
+                    )
                 
-                # Create inline keyboard
-                buttons = [
-                    [
-                        Button.inline("✅ Approve", f"approve_{message_id}"),
-                        Button.inline("✏️ Edit", f"edit_{message_id}"),
-                        Button.inline("❌ Reject", f"reject_{message_id}")
-                    ]
-                ]
-
                 urgency = decoded_gpt_response['urgency']
-                if urgency == 'high':
-                    urgency_emoji = "🚨"
-                elif urgency == 'medium':
-                    urgency_emoji = "🟠"
-                elif urgency == 'low':
-                    urgency_emoji = "🟢"
-                
-                message = f"{urgency_emoji} New message to review:\n\n"
-                message += "Context:\n"
-                message += "\n".join(message_contexts)
-                message += f"\n\n📤 Proposed Response: confidence <{decoded_gpt_response['confidence']}>\n"
-                message += gpt_response
-                
-                await self.bot.send_message(me.id, message, buttons=buttons)
+                message = self._render_review(decoded_gpt_response, message_contexts, gpt_response)
+
+                if suggestion is not None:
+                    await self._refine_suggestion(me, suggestion, message_contexts, decoded_gpt_response)
+                elif card is None or not await card.finish(message, self._review_buttons(message_id)):
+                    await self.bot_outbox.queue(
+                        me.id, message,
+                        buttons=self._review_button_spec(message_id),
+                        kind='card',
+                        key=f"card:{message_id}",
+                        durable=True,
+                        summary=f"{URGENCY_EMOJI.get(urgency, '🟢')} {message_contexts[-1][:100]}"
+                    )
+                if suggestion is None:
+                    self.tracer.link_draft(message_id)
+                self.metrics.drafts.inc(urgency=urgency)
+                self.stats.incr('drafts_for_review', original_chat_id)
             
             return gpt_response, should_respond
         except Exception as e:
             self.logger.error(f"Error in _call_gpt: {str(e)}")
-            return f"Error generating response: {str(e)}"
+            if suggestion is not None:
+                # The suggestion from history stays up for review
+                return suggestion['response'], True
+            if card is not None and card.posted:
+                await card.discard(f"⚠️ Couldn't draft a reply for chat {original_chat_id}: {str(e)}")
+            else:
+                await self._notify_draft_failure(original_chat_id, e)
+            return f"Error generating response: {str(e)}", False
+
+    def _fit_context(self, system_prompt: str, turns: list, chat_id: int, examples: list = ()) -> list:
+        """Messages for one call, fit into the prompt token budget.
+
+        Past replies in ``examples`` get at most half of what the system prompt
+        leaves, so the conversation itself keeps the rest; the least similar
+        ones are dropped until they fit.
+        """
+        builder = self.context_builder
+        room = (builder.budget - builder.count_messages([{'content': system_prompt}])) // 2
+        examples = list(examples)
+        preamble = None
+        while examples:
+            preamble = self._render_examples(examples)
+            if builder.count_messages([{'content': preamble}]) <= room:
+                break
+            examples.pop()
+            preamble = None
+        messages, context_info = builder.build(system_prompt, turns, preamble)
+        self.metrics.context_tokens.observe(context_info['prompt_tokens'])
+        if context_info['truncated'] or context_info['summarized']:
+            self.metrics.context_trimmed.inc(context_info['truncated'], how='truncated')
+            self.metrics.context_trimmed.inc(context_info['summarized'], how='summarized')
+            self.logger.info(f"Context for {chat_id} fit to {context_info['prompt_tokens']} tokens: "
+                             f"{context_info['truncated']} truncated, {context_info['summarized']} condensed")
+        return messages
+
+    async def _triage(self, turns: list, chat_id: int, priority: int) -> Tuple[dict, str]:
+        """Ask the triage model whether the chat needs me.
+
+        Returns the decision and its source when it settles the chat (a
+        confident no), or (None, None) when the drafting model should take it.
+        """
+        try:
+            messages = self._fit_context(TRIAGE_PROMPT, turns, chat_id)
+            raw_triage, source = await self._complete('triage', self.triage_model, TRIAGE_JSON_SCHEMA, messages,
+                                                      chat_id, priority)
+            triage = json.loads(raw_triage)
+        except Exception as e:
+            self.logger.warning(f"Triage call for {chat_id} failed ({str(e)}), falling back to '{TRIAGE_ON_ERROR}'")
+            self.metrics.triage.inc(verdict='error')
+            if TRIAGE_ON_ERROR == 'skip':
+                return {'should_respond': False, 'reason': f"triage failed: {str(e)}", 'confidence': 0,
+                        'urgency': 'low', 'response': ''}, 'error'
+            return None, None
+        self.logger.info(f"Triage for {chat_id}: {raw_triage}")
+        if triage['should_respond']:
+            self.metrics.triage.inc(verdict='draft')
+            return None, None
+        if triage.get('confidence', 0) < TRIAGE_MIN_CONFIDENCE:
+            # Unsure no: let the drafting model make the call
+            self.metrics.triage.inc(verdict='unsure')
+            return None, None
+        self.metrics.triage.inc(verdict='skip')
+        return {**triage, 'response': ''}, source
+
+    async def _complete(self, tier: str, model: str, schema, messages: list, chat_id: int, priority: int,
+                        on_snapshot=None) -> Tuple[str, str]:
+        """Raw JSON answer of ``model`` and where it came from (cache or api).
+
+        Latency, tokens and cost are recorded under ``tier`` (triage or draft).
+        """
+        # Identical context, prompt and model give the identical result
+        cache_key = self.llm_cache.key(model, messages)
+        raw_response = await self.llm_cache.get(cache_key)
+        if raw_response is not None:
+            self.stats.incr('llm_cache_hits', chat_id)
+            self.metrics.gpt_calls.inc(source='cache')
+            self.logger.info(f"LLM cache hit for {chat_id} ({tier})")
+            return raw_response, 'cache'
+
+        self.stats.incr('llm_cache_misses', chat_id)
+        self.stats.incr('gpt_calls', chat_id)
+        self.stats.incr(f'{tier}_calls', chat_id)
+        self.metrics.gpt_calls.inc(source='api')
+        # call openai api through the shared scheduler
+        started = asyncio.get_running_loop().time()
+        # Includes the wait for a free LLM worker and rate limit capacity
+        with self.tracer.span(f'llm_{tier}', model=model):
+            if on_snapshot is not None:
+                response = await self.llm.stream(on_snapshot, priority=priority, model=model,
+                                                 response_format=schema, messages=messages)
+            else:
+                response = await self.llm.parse(priority=priority, model=model, response_format=schema,
+                                                messages=messages)
+        elapsed = asyncio.get_running_loop().time() - started
+        self.metrics.gpt_latency.observe(elapsed)
+        self.metrics.tier_latency.observe(elapsed, tier=tier)
+        self.stats.incr('gpt_latency_ms', chat_id, int(elapsed * 1000))
+        self.stats.incr(f'{tier}_latency_ms', chat_id, int(elapsed * 1000))
+        if response.usage:
+            self.metrics.gpt_tokens.inc(response.usage.prompt_tokens, kind='prompt')
+            self.metrics.gpt_tokens.inc(response.usage.completion_tokens, kind='completion')
+            self.stats.incr('prompt_tokens', chat_id, response.usage.prompt_tokens)
+            self.stats.incr('completion_tokens', chat_id, response.usage.completion_tokens)
+            cached = getattr(response.usage, 'prompt_tokens_details', None)
+            if cached is not None and getattr(cached, 'cached_tokens', None):
+                self.stats.incr('cached_prompt_tokens', chat_id, cached.cached_tokens)
+            cost = completion_cost(MODEL_PRICES.get(model), response.usage)
+            self.metrics.gpt_cost.inc(cost, tier=tier)
+            self.stats.incr(f'{tier}_cost_microusd', chat_id, int(cost * 1_000_000))
+        else:
+            self.stats.incr('prompt_tokens', chat_id, self.context_builder.count_messages(messages))
+        raw_response = response.choices[0].message.content
+        await self.llm_cache.put(cache_key, model, raw_response)
+        return raw_response, 'api'
+
+    @staticmethod
+    def _render_review(triage: dict, message_contexts: list[str], response_text: str) -> str:
+        """Text of the review card for a (possibly still streaming) triage result"""
+        message = f"{URGENCY_EMOJI.get(triage.get('urgency'), '🟢')} New message to review:\n\n"
+        message += "Context:\n"
+        message += "\n".join(message_contexts)
+        message += f"\n\n📤 Proposed Response: confidence <{triage.get('confidence')}>\n"
+        message += response_text
+        return message
+
+    @staticmethod
+    def _render_history_suggestion(message_contexts: list[str], match: dict, status: str) -> str:
+        """Text of the review card for a reply taken from history"""
+        message = f"📚 Suggested from history ({match['similarity']:.0%} alike), {status}:\n\n"
+        message += "Context:\n"
+        message += "\n".join(message_contexts)
+        message += "\n\n📤 Proposed Response:\n"
+        message += match['reply']
+        return message
+
+    @staticmethod
+    def _render_examples(examples: list[dict]) -> str:
+        """Past approved replies to similar conversations, shown to the drafting model"""
+        parts = ["Replies I sent before in similar conversations. Use them for facts and tone, "
+                 "but answer the conversation at hand:"]
+        for example in examples:
+            # The latest messages are what the reply answered
+            parts.append(f"Conversation:\n{example['context'][-1500:]}\nMy reply:\n{example['reply']}")
+        return "\n\n".join(parts)
+
+    async def _suggest_from_history(self, me, match: dict, message_contexts: list[str], chat_id: int) -> dict:
+        """Queue a past reply to a similar conversation as a draft for review, ahead of the model"""
+        message_id = f"{chat_id}_{datetime.now().timestamp()}"
+        message_data = {
+            'response': match['reply'],
+            'chat_id': chat_id,
+            'context': message_contexts,
+            'confidence': round(match['similarity'] * 100),
+            'urgency': 'medium',
+            'created_at': datetime.now().timestamp()
+        }
+        await asyncio.gather(
+            self.pending.add(message_id, message_data),
+            self._track_message(message_id, message_data)
+        )
+        sent = await self.bot_outbox.queue(
+            me.id, self._render_history_suggestion(message_contexts, match, "checking with the model"),
+            buttons=self._review_button_spec(message_id),
+            kind='card',
+            key=f"card:{message_id}",
+            durable=True,
+            summary=f"📚 {message_contexts[-1][:100]}"
+        )
+        self.tracer.link_draft(message_id)
+        self.logger.info(f"Suggested a past reply for {chat_id} ({match['similarity']:.0%} alike)")
+        self.stats.incr('history_suggestions', chat_id)
+        self.metrics.history_suggestions.inc()
+        return {'message_id': message_id, 'match': match, 'response': match['reply'], 'sent': sent}
+
+    async def _refine_suggestion(self, me, suggestion: dict, message_contexts: list[str], decoded: dict):
+        """Put the model's verdict on a suggestion from history, unless I have already acted on it"""
+        message_id = suggestion['message_id']
+        # A press on the card in the meantime wins
+        if not self.pending.claim(message_id):
+            return
+        try:
+            pending = await self.pending.get(message_id)
+            if pending is None or pending.get('edited_text'):
+                return
+            if decoded['should_respond']:
+                await asyncio.gather(
+                    self.pending.replace_draft(message_id, decoded['response'], decoded['confidence'],
+                                               decoded['urgency']),
+                    self.storage.execute('UPDATE message_tracking SET gpt_response = ? WHERE message_id = ?',
+                                         (decoded['response'], message_id))
+                )
+                text = self._render_review(decoded, message_contexts, decoded['response'])
+            else:
+                text = self._render_history_suggestion(message_contexts, suggestion['match'],
+                                                       f"the model thinks no reply is needed: {decoded['reason']}")
+            # None once folded into a digest; /pending shows the current draft
+            card = await asyncio.shield(suggestion['sent'])
+            if card is not None:
+                await self.bot.edit_message(me.id, card, text, buttons=self._review_buttons(message_id))
+        except Exception as e:
+            self.logger.error(f"Error refining suggestion {message_id}: {str(e)}")
+        finally:
+            self.pending.release(message_id)
+
+    async def _notify_draft_failure(self, chat_id: int, error: Exception):
+        """Tell the owner a draft was lost instead of dropping it silently"""
+        try:
+            me = await self.entities.get_me()
+            await self.bot_outbox.send(me.id, f"⚠️ Couldn't draft a reply for chat {chat_id}: {str(error)}")
+        except Exception as e:
+            self.logger.error(f"Error notifying draft failure: {str(e)}")
 
     def add_pattern(self, pattern: str, callback: callable):
         """Add a new pattern and associated callback"""
@@ -329,247 +864,340 @@ class MessageMonitor:
 
     async def run(self):
         """Run the message monitor"""
-        await self.start()
-        await self.client.run_until_disconnected()
+        try:
+            await self.start()
+            await self.client.run_until_disconnected()
+        finally:
+            await self.stop()
+
+    async def stop(self, timeout: float = SHUTDOWN_TIMEOUT_SECONDS):
+        """Stop taking events, let in-flight drafts finish and flush state, all within ``timeout`` seconds"""
+        if self._stopping:
+            return
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + timeout
+
+        def remaining(share: float = 1.0) -> float:
+            return max(deadline - loop.time(), 0) * share
+
+        await self.jobs.stop()
+        await self.activity.stop()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        # No new chats fire; the ones already firing get most of the budget to finish their draft
+        await self.debouncer.stop()
+        if self.debouncer.firing:
+            self.logger.info(f"Waiting for {self.debouncer.firing} chats being processed")
+            try:
+                await asyncio.wait_for(self.debouncer.drain(), remaining(0.6))
+            except asyncio.TimeoutError:
+                self.logger.warning("Shutdown deadline reached, abandoning drafts still being generated")
+        await self.llm.stop()
+
+        # Unmute what this run muted (anything left over unmutes when its mute expires) while the outboxes empty;
+        # durable messages still queued are sent on the next start
+        async def drain_outboxes():
+            while (self.user_outbox.backlog or self.bot_outbox.backlog) and remaining() > 0:
+                await asyncio.sleep(0.1)
+
+        budget = remaining(0.7)
+        await asyncio.gather(
+            self.muter.stop(unmute=True, timeout=budget),
+            asyncio.wait_for(drain_outboxes(), budget),
+            return_exceptions=True,
+        )
+        await asyncio.gather(self.user_outbox.stop(), self.bot_outbox.stop())
+        if self.shards:
+            await self.shards.stop()
+        # Make sure buffered counters, spans and every queued write are saved before exiting
+        await self.stats.stop()
+        await self.tracer.stop()
+        await self.storage.close()
+        await asyncio.gather(self.client.disconnect(), self.bot.disconnect(), return_exceptions=True)
+        self.logger.info(f"Stopped in {loop.time() - started:.2f}s")
 
     async def _log_daily_stats(self):
-        """Log the daily stats and reset counters"""
-        self.logger.info(f"\n=== {datetime.now().strftime('%B %d %Y')} Daily Statistics ===")
-        for metric, value in self.stats.items():
+        """Log the totals of the day that just ended from the stats store"""
+        await self.stats.flush()
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        yesterday = today - timedelta(days=1)
+        # Hourly buckets line up with local midnight
+        totals = await self.stats.totals(yesterday.timestamp(), today.timestamp(), granularity='hour')
+        self.logger.info(f"\n=== {yesterday.strftime('%B %d %Y')} Daily Statistics ===")
+        for metric, value in totals.items():
             self.logger.info(f"{metric.replace('_', ' ').title()}: {value}")
         self.logger.info("=====================\n")
-        
-        # Reset stats for the next day
-        for key in self.stats:
-            self.stats[key] = 0
-
-    def _schedule_daily_stats_reset(self):
-        """Schedule the daily stats reset at midnight"""
-        async def _daily_stats_job():
-            while True:
-                now = datetime.now()
-                next_midnight = (now + timedelta(days=1)).replace(
-                    hour=0, minute=0, second=0, microsecond=0
-                )
-                seconds_until_midnight = (next_midnight - now).total_seconds()
-                
-                await asyncio.sleep(seconds_until_midnight)
-                await self._log_daily_stats()
-
-        asyncio.create_task(_daily_stats_job())
 
     async def _handle_button_press(self, event):
         """Handle button presses for message approval/rejection/editing"""
         try:
             # Check if the user pressing the button is you
-            me = await self.client.get_me()
+            me = await self.entities.get_me()
             if event.sender_id != me.id:
                 await event.answer("⚠️ You're not authorized to perform this action", alert=True)
                 return
 
             data = event.data.decode()
             action, message_id = data.split('_', 1)
-            
-            if message_id not in self.pending_messages:
-                await event.answer("Message no longer available")
+            trace_id, _ = self.tracer.draft(message_id)
+            self.tracer.activate(trace_id)
+
+            # Loaded on demand; a second press on the same card is turned away by claim()
+            # Edit presses don't claim, so they must not release a claim an approve or reject holds
+            claimed = action in ("approve", "reject")
+            if claimed and not self.pending.claim(message_id):
+                await event.answer("Already being handled")
                 return
-            
-            message_data = self.pending_messages[message_id]
-            
-            if action == "approve":
-                await self.client.send_message(
-                    message_data['chat_id'],
-                    message_data['response']
-                )
-                await event.edit("✅ Message approved and sent!")
-                await self._delete_pending_message(message_id)
-                del self.pending_messages[message_id]
-            
-            elif action == "edit":
-                # Send the original GPT response in a separate message for easy copying
-                await self.bot.send_message(
-                    me.id,
-                    f"EDIT: {message_data['response']}"
-                )
-                # Send the edit instruction message
-                await event.edit("Please reply to this message with your edited version. Start with 'EDIT:' followed by your new message. Proposed response to copy")
-                
-                # Add a message handler for the edit response
-                @self.bot.on(events.NewMessage(from_users=me.id))
-                async def edit_handler(response_event):
-                    if response_event.text.lower().startswith("edit:"):
-                        # Remove the handler after we get our response
-                        self.bot.remove_event_handler(edit_handler)
-                        
-                        # Get the edited message (remove the "EDIT:" prefix)
-                        edited_message = response_event.text[5:].strip()
-                        
-                        # Update the pending message
-                        message_data['response'] = edited_message
-                        
-                        # Show the new version with approve/reject buttons
-                        buttons = [
-                            [
-                                Button.inline("✅ Approve", f"approve_{message_id}"),
-                                Button.inline("✏️ Edit", f"edit_{message_id}"),
-                                Button.inline("❌ Reject", f"reject_{message_id}")
-                            ]
-                        ]
-                        
-                        preview_message = "Updated message to review:\n\n"
-                        preview_message += "Context:\n"
-                        preview_message += "\n".join(message_data['context'])
-                        preview_message += "\n\n📤 Proposed Response:\n"
-                        preview_message += edited_message
-                        
-                        await response_event.delete()
-                        await self.bot.send_message(me.id, preview_message, buttons=buttons)
-            
-            else:  # reject
-                await event.edit("❌ Message rejected")
-                await self._delete_pending_message(message_id)
-                del self.pending_messages[message_id]
+            try:
+                with self.tracer.span('button_press', action=action, message_id=message_id):
+                    await self._apply_review_action(event, me, action, message_id)
+            finally:
+                if claimed:
+                    self.pending.release(message_id)
             
         except Exception as e:
             self.logger.error(f"Error in button handler: {str(e)}")
             await event.answer("An error occurred while processing your request", alert=True)
 
+    async def _apply_review_action(self, event, me, action: str, message_id: str):
+        """Approve, edit or reject a pending draft"""
+        message_data = await self.pending.get(message_id)
+        if message_data is None:
+            await event.answer("Message no longer available")
+            return
+
+        trace_id, sent_for_review = self.tracer.draft(message_id)
+        if sent_for_review is not None and action in ("approve", "reject"):
+            self.tracer.record(trace_id, 'review_wait', sent_for_review, action=action)
+
+        if action == "approve":
+            # Once queued the reply is in the durable outbox, so it is sent even across a FloodWait or restart
+            delivery = await self.user_outbox.queue(
+                message_data['chat_id'],
+                message_data['response'],
+                kind='reply',
+                key=f"reply:{message_id}",
+                durable=True
+            )
+            # Until Telegram has the message, FloodWaits included
+            self.tracer.record_when_done(delivery, 'send', message_id=message_id)
+            try:
+                await asyncio.wait_for(asyncio.shield(delivery), timeout=APPROVE_SEND_WAIT)
+                await event.edit("✅ Message approved and sent!")
+            except asyncio.TimeoutError:
+                await event.edit("✅ Message approved, it goes out as soon as Telegram's rate limit allows")
+            except DeliveryUncertain:
+                # It may have arrived, so it counts as approved; _report_uncertain_send has the details
+                await event.edit("⚠️ Message approved, but the connection dropped while sending it")
+            self._observe_review_turnaround(message_data, APPROVED)
+            self.stats.incr('group_chat_replies', message_data['chat_id'])
+            await asyncio.gather(
+                self.pending.delete(message_id),
+                self._update_tracking(message_id, APPROVED, message_data.get('edited_text'))
+            )
+        
+        elif action == "edit":
+            # My next message to the bot becomes the new version of this draft
+            await self.edit_sessions.start(me.id, message_id)
+            # Send the original GPT response in a separate message for easy copying
+            await self.bot_outbox.send(
+                me.id,
+                f"EDIT: {message_data['response']}"
+            )
+            # Send the edit instruction message
+            await event.edit("Please reply with your edited version (or /cancel). Proposed response to copy")
+        
+        else:  # reject
+            await event.edit("❌ Message rejected")
+            self._observe_review_turnaround(message_data, REJECTED)
+            self.stats.incr('blocked_messages', message_data['chat_id'])
+            await asyncio.gather(
+                self.pending.delete(message_id),
+                self._update_tracking(message_id, REJECTED)
+            )
+
+    async def _handle_edit_reply(self, event, me, message_id: str):
+        """Apply my reply as the edited version of the draft in my edit session"""
+        await self.edit_sessions.end(me.id, message_id)
+        message_data = await self.pending.get(message_id)
+        if message_data is None:
+            await event.reply("That draft is no longer pending, edit discarded")
+            return
+
+        # Get the edited message (the "EDIT:" prefix is optional)
+        edited_message = event.raw_text.strip()
+        if edited_message.lower().startswith("edit:"):
+            edited_message = edited_message[5:].strip()
+        if not edited_message:
+            await self.edit_sessions.start(me.id, message_id)
+            await event.reply("Empty edit, send the new version of the message")
+            return
+
+        # Update the pending message
+        self.stats.incr('edited_messages', message_data['chat_id'])
+        await asyncio.gather(
+            self.pending.update_response(message_id, edited_message),
+            self._update_tracking(message_id, EDITED, edited_message)
+        )
+
+        preview_message = "Updated message to review:\n\n"
+        preview_message += "Context:\n"
+        preview_message += "\n".join(message_data['context'])
+        preview_message += "\n\n📤 Proposed Response:\n"
+        preview_message += edited_message
+
+        await event.delete()
+        await self.bot_outbox.send(me.id, preview_message, buttons=self._review_button_spec(message_id))
+
+    @staticmethod
+    def _review_button_spec(message_id: str) -> list:
+        return [
+            [
+                ("✅ Approve", f"approve_{message_id}"),
+                ("✏️ Edit", f"edit_{message_id}"),
+                ("❌ Reject", f"reject_{message_id}")
+            ]
+        ]
+
+    def _review_buttons(self, message_id: str) -> list:
+        return build_buttons(self._review_button_spec(message_id))
+
+    @staticmethod
+    def _render_digest(summaries: list[str]) -> str:
+        """One message standing in for review cards that piled up in the bot outbox"""
+        message = f"📬 {len(summaries)} new messages to review\n\n"
+        message += "\n".join(summaries)
+        message += "\n\nSend /pending to go through them"
+        return message
+
+    def _observe_review_turnaround(self, message_data: dict, action: str):
+        """Record how long a draft waited for my decision"""
+        created_at = message_data.get('created_at')
+        if created_at:
+            self.metrics.review_turnaround.observe(datetime.now().timestamp() - created_at, action=action)
+
     async def _delayed_processing(self, chat_id: int):
-        """Handle the delayed processing with reset capability"""
+        """Process a chat's queued messages once it has gone quiet"""
         try:
-            while True:
-                current_time = datetime.now()
-                last_message_time = self.last_message_times.get(chat_id)
-                
-                if not last_message_time:
-                    return
-                    
-                time_since_last = (current_time - last_message_time).total_seconds()
+            if chat_id in self.message_queues and self.message_queues[chat_id]:
+                chat = self.message_queues[chat_id][0]['chat']
+                first_queued = self.message_queues[chat_id][0]['timestamp']
+                self.metrics.debounce_wait.observe((datetime.now() - first_queued).total_seconds())
+                # Chats where I was tagged jump ahead of ambient group chatter
+                mentioned = any(item.get('mentioned') for item in self.message_queues[chat_id])
+                priority = PRIORITY_MENTION if mentioned else PRIORITY_AMBIENT
+                last_message_id = self.message_queues[chat_id][-1]['message_id']
+                # Clear the queue up front so messages arriving mid-call queue a new round
+                self.message_queues[chat_id] = []
+                trace_id, first_received = self._chat_traces.pop(chat_id, (self.tracer.new_trace(), None))
+                self.tracer.activate(trace_id)
+                fired = self.tracer.now()
+                if first_received is not None:
+                    self.tracer.record(trace_id, 'debounce_wait', first_received, fired, chat_id=chat_id)
+                formatted_messages = []
                 
-                if time_since_last >= self.delay_time_seconds:
-                    if chat_id in self.message_queues and self.message_queues[chat_id]:
-                        chat = self.message_queues[chat_id][0]['chat']
-                        formatted_messages = []
-                        unique_senders = []  # Changed from set to list
-                        
-                        # Fetch last 50 messages to get better context
-                        async for message in self.client.iter_messages(chat, limit=50):
-                            if message.sender and message.text:  # Only process text messages with senders
-                                sender_username = message.sender.username if message.sender.username else str(message.sender.id)
-                                
-                                # Add sender if they're different from the last sender
-                                if not unique_senders or sender_username != unique_senders[-1]:
-                                    unique_senders.append(sender_username)
-                                
-                                # Include message if we haven't exceeded max unique senders
-                                if len(unique_senders) <= self.max_unique_senders:
-                                    timestamp = message.date.strftime("%Y-%m-%d %H:%M:%S")
-                                    username = f"@{message.sender.username}" if message.sender.username else "no_username"
-                                    formatted_messages.insert(0, f"sender_username <{username}> [{timestamp}]: {message.text}")
-                                else:
-                                    break
-
-                        if formatted_messages:
-                            self.logger.info(f"Formatted messages: {formatted_messages}")
-                            gpt_response, should_respond = await self._call_gpt(formatted_messages, chat_id)
-                            if should_respond:
-                                self.logger.info(f"GPT response: {gpt_response}")
-
-                        # Clear the queue after processing
-                        self.message_queues[chat_id] = []
-                        
-                        # Clean up
-                        if chat_id in self.delay_tasks:
-                            del self.delay_tasks[chat_id]
-                        return
-                    
-                await asyncio.sleep(self.delay_check_interval_seconds)
+                # Context goes back max_unique_senders people, served from the in-memory history
+                started = asyncio.get_running_loop().time()
+                with self.tracer.span('context_fetch'):
+                    context = await self.history.recent_unique_senders(chat_id, chat, self.max_unique_senders)
+                self.metrics.context_fetch.observe(asyncio.get_running_loop().time() - started)
+                for message in context:
+                    timestamp = message['date'].strftime("%Y-%m-%d %H:%M:%S")
+                    username = f"@{message['username']}" if message['username'] else "no_username"
+                    formatted_messages.append(f"sender_username <{username}> [{timestamp}]: {message['text']}")
+
+                if formatted_messages:
+                    self.logger.info(f"Formatted messages: {formatted_messages}")
+                    gpt_response, should_respond = await self._call_gpt(formatted_messages, chat_id, priority)
+                    if should_respond:
+                        self.logger.info(f"GPT response: {gpt_response}")
+                # Handled; a crash before this point replays the chat on the next start
+                self.journal.clear(chat_id, last_message_id)
+                self.tracer.record(trace_id, 'delayed_processing', fired, chat_id=chat_id)
 
-        except asyncio.CancelledError:
-            self.logger.info(f"Delayed processing cancelled for chat {chat_id}")
-            raise
         except Exception as e:
             self.logger.error(f"Error in delayed processing: {str(e)}")
 
-    async def _mute_matching_chats(self):
-        await asyncio.sleep(5)  # Initial delay to let other initialization complete
-        """Continuously mute all chats matching the CHAT_NAME_FILTER pattern"""
+    def _activity_kind(self, event, sender) -> str:
+        """Whether a group message came from me, a teammate or someone outside the team"""
+        username = (getattr(sender, 'username', None) or '').lower()
+        if event.out or (self.tg_username and username == self.tg_username.lower()):
+            return OUTBOUND
+        return TEAMMATE if username in self.teammates else INBOUND
+
+    @staticmethod
+    def _format_wait(seconds: float) -> str:
+        hours, minutes = divmod(int(seconds) // 60, 60)
+        days, hours = divmod(hours, 24)
+        return f"{days}d {hours}h" if days else f"{hours}h {minutes}m"
+
+    def _render_unanswered(self) -> str:
+        waiting = self.activity.unanswered()
+        if not waiting:
+            return "✅ No chats waiting on a reply from our side"
+        now = datetime.now().timestamp()
+        lines = ["⏳ Waiting on our side, longest first:", ""]
+        for chat in waiting:
+            lines.append(f"{chat['title'] or chat['chat_id']}: {self._format_wait(now - chat[INBOUND])}")
+        return "\n".join(lines)
+
+    async def _send_activity_alert(self, kind: str, chat: dict):
+        """Tell the owner a chat has gone unanswered or quiet"""
+        if self.shards and not await self.shards.claim(chat['chat_id']):
+            # The worker holding the chat sends its alerts
+            return
+        me = await self.entities.get_me()
+        if not me:
+            return
+        title = chat['title'] or chat['chat_id']
+        now = datetime.now().timestamp()
+        if kind == UNANSWERED:
+            text = f"⏳ Nobody from our side has replied in {title} for {self._format_wait(now - chat[INBOUND])}"
+        else:
+            text = f"💤 {title} has had no activity for {self._format_wait(now - self.activity.last_activity(chat))}"
+        self.metrics.activity_alerts.inc(kind=kind)
+        await self.bot_outbox.send(me.id, text)
+
+    async def _report_uncertain_send(self, item: dict, error: BaseException):
+        """Tell the owner a reply may or may not have reached its chat; it is not sent again"""
+        me = await self.entities.get_me()
+        if not me:
+            return
+        await self.bot_outbox.queue(
+            me.id,
+            f"⚠️ The connection dropped while sending to chat {item['chat_id']} ({type(error).__name__}), "
+            f"so this reply may or may not have gone out. Check the chat and send it yourself if it is "
+            f"missing:\n\n{item['text']}"
+        )
+
+    async def _repost_pending(self, me, urgency: str = None, limit: int = 10):
+        """Send the oldest pending drafts again as review cards"""
         try:
-            # Get matching chats once
-            matching_chats = []
-            async for dialog in self.client.iter_dialogs():
-                if dialog.is_group and re.search(CHAT_NAME_FILTER, dialog.title, re.IGNORECASE):
-                    matching_chats.append(dialog)
-                    self.logger.info(f"Found matching chat to mute: {dialog.title}")
-
-            while True:
-                for dialog in matching_chats:
-                    try:
-                        # Create notification settings for muting
-                        settings = InputPeerNotifySettings(
-                            show_previews=False,
-                            silent=True,
-                            mute_until=int((datetime.now() + timedelta(seconds=10)).timestamp()),
-                            sound=None
-                        )
-                        
-                        # Create the peer for the notification update
-                        peer = InputNotifyPeer(
-                            peer=dialog.input_entity
-                        )
-                        
-                        # Update notification settings
-                        await self.client(functions.account.UpdateNotifySettingsRequest(
-                            peer=peer,
-                            settings=settings
-                        ))
-                        
-                        self.logger.info(f"Muted chat: {dialog.title}")
-                    except Exception as e:
-                        self.logger.error(f"Error muting chat {dialog.title}: {str(e)}")
-                
-                # Wait before the next muting cycle
-                await asyncio.sleep(30)  # Increased to 30 seconds
-                
+            drafts = await self.pending.list(urgency=urgency, limit=limit)
+            if not drafts:
+                await self.bot_outbox.send(me.id, "No pending messages")
+                return
+            for draft in drafts:
+                message = f"{URGENCY_EMOJI.get(draft['urgency'], '🟢')} Pending message to review:\n\n"
+                message += "Context:\n"
+                message += "\n".join(draft['context'])
+                message += "\n\n📤 Proposed Response:\n"
+                message += draft['response']
+                await self.bot_outbox.send(me.id, message, buttons=self._review_button_spec(draft['message_id']))
         except Exception as e:
-            self.logger.error(f"Error in mute job: {str(e)}")
-            # Restart the task if it fails
-            asyncio.create_task(self._mute_matching_chats())
-
-    def _schedule_pending_messages_notifications(self):
-        """Schedule notifications about pending messages at specified times"""
-        async def _notification_job():
-            while True:
-                now = datetime.now()
-                today_times = [datetime.combine(now.date(), t) for t in self.notification_times]
-                
-                next_time = None
-                for t in today_times:
-                    if now < t:
-                        next_time = t
-                        break
-                if not next_time:
-                    tomorrow = now.date() + timedelta(days=1)
-                    next_time = datetime.combine(tomorrow, self.notification_times[0])
-                
-                seconds_until_next = (next_time - now).total_seconds()
-                await asyncio.sleep(seconds_until_next)
-                await self._send_pending_messages_summary()
-
-        asyncio.create_task(_notification_job())
+            self.logger.error(f"Error reposting pending messages: {str(e)}")
 
     async def _send_pending_messages_summary(self):
         """Send a summary of pending messages grouped by urgency"""
         try:
-            me = await self.client.get_me()
+            me = await self.entities.get_me()
             if not me:
                 return
 
             # Count messages by urgency
-            urgency_counts = {'high': 0, 'medium': 0, 'low': 0}
-            for msg_data in self.pending_messages.values():
-                urgency = msg_data.get('urgency', 'low')
-                urgency_counts[urgency] += 1
+            urgency_counts = await self.pending.counts_by_urgency()
 
             # Create summary message
             current_time = datetime.now().strftime('%I:%M %p')
@@ -582,20 +1210,32 @@ class MessageMonitor:
             summary += f"\nTotal pending: {total}"
 
             if total > 0:
-                await self.bot.send_message(me.id, summary)
+                await self.bot_outbox.send(me.id, summary)
             
         except Exception as e:
             self.logger.error(f"Error sending pending messages summary: {str(e)}")
 
-async def main():
+async def main(account: str = None, llm_share: float = 1.0, metrics_port: int = METRICS_PORT):
+    # A named account reads its own tg_phone_<account> and tg_bot_token_<account>
+    suffix = f'_{account}' if account else ''
     monitor = MessageMonitor(
         api_id=os.getenv('tg_app_id'),
         api_hash=os.getenv('tg_api_hash'),
-        phone=os.getenv('tg_phone'),
-        bot_token=os.getenv('tg_bot_token'),
-        openai_api_key=os.getenv('openai_api_key')
+        phone=os.getenv(f'tg_phone{suffix}'),
+        bot_token=os.getenv(f'tg_bot_token{suffix}'),
+        openai_api_key=os.getenv('openai_api_key'),
+        account=account,
+        llm_share=llm_share,
+        metrics_port=metrics_port
     )
 
+    # SIGTERM (e.g. from systemd or docker stop) disconnects, which lets run() shut down gracefully
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.create_task(monitor.client.disconnect()))
+    except NotImplementedError:  # Windows
+        pass
+
     # Run the monitor
     await monitor.run()
 
@@ -0,0 +1,309 @@
+import asyncio
+import bisect
+import logging
+import math
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+WAIT_BUCKETS = (1, 5, 15, 30, 60, 90, 120, 150, 180, 240, 300, 600, 1800, 3600)
+TOKEN_BUCKETS = (250, 500, 1000, 1500, 2000, 2500, 3000, 4000, 6000, 8000, 16000)
+REVIEW_BUCKETS = (10, 30, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 43200, 86400)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + list(self._samples())
+
+    def _samples(self) -> Iterable[str]:
+        return []
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def _samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the value from ``function`` at scrape time"""
+        self._function = function
+
+    def value(self, **labels) -> float:
+        if self._function is not None:
+            return self._function()
+        return self.values.get(self._key(labels), 0)
+
+    def _samples(self):
+        if self._function is not None:
+            yield f"{self.name} {_format_value(self._function())}"
+            return
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * len(self.buckets)
+            self.sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def count(self, **labels) -> int:
+        if labels:
+            return sum(self.counts.get(self._key(labels), []))
+        return sum(sum(counts) for counts in self.counts.values())
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Estimate a quantile by linear interpolation inside the buckets"""
+        if labels:
+            counts = self.counts.get(self._key(labels))
+            if not counts:
+                return None
+        else:
+            counts = [sum(column) for column in zip(*self.counts.values())]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, counts):
+            if seen + count >= rank and count:
+                if upper == math.inf:
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper if upper != math.inf else lower
+        return lower
+
+    def _samples(self):
+        for key in sorted(self.counts):
+            cumulative = 0
+            for upper, count in zip(self.buckets, self.counts[key]):
+                cumulative += count
+                le = f'le="{_format_value(upper)}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(self.sums[key])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MonitorMetrics:
+    """The metrics MessageMonitor records, on their own registry"""
+
+    def __init__(self, registry: Registry = None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.messages = r.counter('tg_persona_messages_total', 'Messages seen by the user client', ['kind'])
+        self.debounce_wait = r.histogram('tg_persona_debounce_wait_seconds',
+                                         'Time from first queued message until the chat is processed',
+                                         buckets=WAIT_BUCKETS)
+        self.context_fetch = r.histogram('tg_persona_context_fetch_seconds', 'Time to build the GPT context')
+        self.context_tokens = r.histogram('tg_persona_context_tokens', 'Estimated prompt tokens per triage call',
+                                          buckets=TOKEN_BUCKETS)
+        self.context_trimmed = r.counter('tg_persona_context_trimmed_total',
+                                         'Context turns cut to fit the token budget', ['how'])
+        self.gpt_latency = r.histogram('tg_persona_gpt_latency_seconds', 'OpenAI call latency including queueing')
+        self.tier_latency = r.histogram('tg_persona_gpt_tier_latency_seconds',
+                                        'OpenAI call latency per pipeline tier (triage, draft)', ['tier'])
+        self.gpt_cost = r.counter('tg_persona_gpt_cost_usd_total', 'Estimated OpenAI spend per pipeline tier', ['tier'])
+        self.triage = r.counter('tg_persona_triage_total',
+                                'Triage tier verdicts: skip, draft, unsure (drafted anyway) or error', ['verdict'])
+        self.gpt_tokens = r.counter('tg_persona_gpt_tokens_total', 'Tokens used by OpenAI calls', ['kind'])
+        self.gpt_calls = r.counter('tg_persona_gpt_calls_total', 'Triage results by source', ['source'])
+        self.drafts = r.counter('tg_persona_drafts_total', 'Drafts sent for review', ['urgency'])
+        self.review_turnaround = r.histogram('tg_persona_review_turnaround_seconds',
+                                             'Time from draft sent for review until approve/reject',
+                                             ['action'], buckets=REVIEW_BUCKETS)
+        self.pending_drafts = r.gauge('tg_persona_pending_drafts', 'Drafts waiting for review')
+        self.active_delays = r.gauge('tg_persona_active_delay_tasks', 'Chats waiting out their quiet window')
+        self.llm_queue_depth = r.gauge('tg_persona_llm_queue_depth', 'LLM requests waiting for a worker')
+        self.llm_in_flight = r.gauge('tg_persona_llm_in_flight', 'LLM requests being served')
+        self.prefilter_skips = r.counter('tg_persona_prefilter_skips_total', 'GPT calls skipped by the local prefilter')
+        self.prefilter_shadow = r.counter('tg_persona_prefilter_shadow_total',
+                                          'Prefilter verdicts next to the GPT decision', ['prefilter', 'gpt'])
+        self.history_suggestions = r.counter('tg_persona_history_suggestions_total',
+                                             'Review cards posted from past approved replies')
+        self.activity_alerts = r.counter('tg_persona_activity_alerts_total',
+                                         'Unanswered and stale chat alerts sent', ['kind'])
+        self.startup_seconds = r.gauge('tg_persona_startup_seconds', 'Duration of each startup phase', ['phase'])
+        self.early_events = r.counter('tg_persona_early_events_total',
+                                      'Events that arrived before the bot was ready', ['outcome'])
+
+    def summary(self) -> str:
+        """Short human readable digest for the bot /stats command"""
+        def seconds(histogram: Histogram, q: float, **labels) -> str:
+            value = histogram.quantile(q, **labels)
+            return "-" if value is None else f"{value:.1f}s"
+
+        lines = [
+            "📈 Live stats",
+            "",
+            f"Messages: {int(self.messages.total())}",
+            f"Pending drafts: {int(self.pending_drafts.value())}",
+            f"Chats in quiet window: {int(self.active_delays.value())}",
+            f"LLM queue: {int(self.llm_queue_depth.value())} waiting, {int(self.llm_in_flight.value())} in flight",
+            "",
+            f"Debounce wait p50/p90: {seconds(self.debounce_wait, 0.5)} / {seconds(self.debounce_wait, 0.9)}",
+            f"Context fetch p50/p90: {seconds(self.context_fetch, 0.5)} / {seconds(self.context_fetch, 0.9)}",
+            f"GPT latency p50/p90: {seconds(self.gpt_latency, 0.5)} / {seconds(self.gpt_latency, 0.9)}",
+            f"GPT tokens: {int(self.gpt_tokens.value(kind='prompt'))} prompt, "
+            f"{int(self.gpt_tokens.value(kind='completion'))} completion",
+            f"GPT spend: ${self.gpt_cost.value(tier='triage'):.3f} triage, ${self.gpt_cost.value(tier='draft'):.3f} draft "
+            f"(p50 {seconds(self.tier_latency, 0.5, tier='triage')} / {seconds(self.tier_latency, 0.5, tier='draft')})",
+            f"Drafts: 🚨 {int(self.drafts.value(urgency='high'))} 🟠 {int(self.drafts.value(urgency='medium'))} "
+            f"🟢 {int(self.drafts.value(urgency='low'))}",
+            f"Review turnaround p50: {seconds(self.review_turnaround, 0.5)}",
+        ]
+        scored = self.prefilter_shadow.total()
+        if scored or self.prefilter_skips.total():
+            agree = self.prefilter_shadow.value(prefilter='skip', gpt='ignore') + \
+                self.prefilter_shadow.value(prefilter='pass', gpt='respond')
+            lines.append(
+                f"Prefilter: {int(self.prefilter_skips.total())} calls skipped"
+                + (f", agrees with GPT on {agree / scored:.0%} of {int(scored)}, "
+                   f"{int(self.prefilter_shadow.value(prefilter='skip', gpt='respond'))} would have been missed"
+                   if scored else "")
+            )
+        return "\n".join(lines)
+
+
+class MetricsServer:
+    """Serves a registry at GET /metrics in Prometheus text format"""
+
+    def __init__(self, registry: Registry, host: str = "127.0.0.1", port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.logger.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Drain the headers
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+                body = self.registry.render().encode()
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body = b"not found\n"
+                status = "404 Not Found"
+                content_type = "text/plain"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            self.logger.error(f"Error serving metrics: {str(e)}")
+        finally:
+            writer.close()
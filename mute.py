@@ -0,0 +1,236 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telethon import errors, utils
+from telethon.tl import functions
+from telethon.tl.types import InputNotifyPeer, InputPeerNotifySettings
+
+logger = logging.getLogger(__name__)
+
+
+class DialogIndex:
+    """Group chats I am in, by bare chat id.
+
+    Built with one ``iter_dialogs()`` pass and then kept current from chat
+    events: new messages add chats that were not known yet, renames update the
+    title and leaving a chat removes it. ``on_change`` is called with the chat
+    id after every change.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.logger = logger
+        self.on_change: Optional[Callable[[int], Any]] = None
+        # chat_id -> {'title', 'peer', 'mute_until'}
+        self.chats: Dict[int, dict] = {}
+        self.built = False
+
+    @staticmethod
+    def _bare_id(chat_id: int) -> int:
+        return utils.resolve_id(chat_id)[0]
+
+    async def build(self):
+        async for dialog in self.client.iter_dialogs():
+            if not dialog.is_group:
+                continue
+            settings = getattr(getattr(dialog, 'dialog', None), 'notify_settings', None)
+            self.chats[self._bare_id(dialog.id)] = {
+                'title': dialog.title,
+                'peer': dialog.input_entity,
+                'mute_until': getattr(settings, 'mute_until', None) or 0,
+            }
+        self.built = True
+        self.logger.info(f"Indexed {len(self.chats)} group chats")
+
+    def _changed(self, chat_id: int):
+        if self.on_change is not None:
+            self.on_change(chat_id)
+
+    def observe(self, chat_id: int, chat):
+        """Add a group chat seen in an update if it is not indexed yet"""
+        if chat_id in self.chats or not self.built:
+            return
+        self.chats[chat_id] = {'title': getattr(chat, 'title', None), 'peer': chat, 'mute_until': 0}
+        self._changed(chat_id)
+
+    def rename(self, chat_id: int, title: str):
+        chat_id = self._bare_id(chat_id)
+        if chat_id in self.chats:
+            self.chats[chat_id]['title'] = title
+            self._changed(chat_id)
+
+    def remove(self, chat_id: int):
+        chat_id = self._bare_id(chat_id)
+        if self.chats.pop(chat_id, None) is not None:
+            self._changed(chat_id)
+
+
+class MuteScheduler:
+    """Keeps matching group chats muted with as few requests as possible.
+
+    Each chat is muted for ``duration`` seconds and only renewed when its mute
+    is within ``renew_before`` seconds of running out, so when the bot stops
+    the chats unmute on their own shortly after. Renewals come off a min-heap
+    keyed on their due time, at most one request every ``spacing`` seconds,
+    and a FloodWait pauses the whole queue for as long as Telegram asks.
+    """
+
+    def __init__(self, client, index: DialogIndex, should_mute: Callable[[int, str], bool],
+                 duration: float = 1800, renew_before: float = 300, spacing: float = 2.0):
+        self.client = client
+        self.index = index
+        self.should_mute = should_mute
+        self.duration = duration
+        self.renew_before = renew_before
+        self.spacing = spacing
+        self.logger = logger
+        # (due in loop time, chat_id); entries whose due no longer matches _due are stale
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+        self._muted: Dict[int, float] = {}  # chat_id -> unix mute_until I set
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {'mutes': 0, 'unmutes': 0, 'flood_waits': 0, 'errors': 0}
+        index.on_change = self.refresh
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, unmute: bool = True, timeout: float = 30):
+        """Stop renewing and, when asked, unmute every chat muted by this run"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if unmute and self._muted:
+            try:
+                await asyncio.wait_for(self._unmute_all(), timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(f"Unmute timed out, {len(self._muted)} chats unmute when their mute expires")
+
+    def refresh(self, chat_id: int = None):
+        """Re-check one chat (or every indexed chat) against the filters"""
+        chat_ids = [chat_id] if chat_id is not None else list(set(self.index.chats) | set(self._muted))
+        now = asyncio.get_running_loop().time()
+        for chat_id in chat_ids:
+            chat = self.index.chats.get(chat_id)
+            wanted = chat is not None and self.should_mute(chat_id, chat['title'])
+            if wanted and chat_id not in self._due:
+                # Already muted long enough (by me or by hand): only come back near expiry
+                remaining = max(chat['mute_until'], self._muted.get(chat_id, 0)) - time.time()
+                self._schedule(chat_id, now + max(0.0, remaining - self.renew_before))
+            elif not wanted and chat_id in self._due:
+                del self._due[chat_id]
+                if chat_id in self._muted:
+                    # Filters no longer match: unmute through the queue
+                    heapq.heappush(self._heap, (now, chat_id))
+                    self._wakeup.set()
+
+    def _schedule(self, chat_id: int, due: float):
+        self._due[chat_id] = due
+        heapq.heappush(self._heap, (due, chat_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        try:
+            if not self.index.built:
+                await self.index.build()
+            self.refresh()
+            loop = asyncio.get_running_loop()
+            while True:
+                while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0] \
+                        and not self._needs_unmute(self._heap[0][1]):
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                due, chat_id = self._heap[0]
+                delay = due - loop.time()
+                if delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self._heap)
+                await self._process(chat_id)
+                await asyncio.sleep(self.spacing)
+        except Exception as e:
+            self.logger.error(f"Error in mute scheduler: {str(e)}")
+
+    def _needs_unmute(self, chat_id: int) -> bool:
+        return chat_id not in self._due and chat_id in self._muted
+
+    async def _process(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        unmute = self._needs_unmute(chat_id)
+        mute_until = 0 if unmute else int(time.time() + self.duration)
+        try:
+            await self._set_mute(chat_id, mute_until)
+        except errors.FloodWaitError as e:
+            self.stats['flood_waits'] += 1
+            self.logger.warning(f"Mute FloodWait, pausing {e.seconds}s")
+            await asyncio.sleep(e.seconds)
+            self._requeue(chat_id, loop.time(), unmute)
+            return
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"Error muting chat {chat_id}: {str(e)}")
+            self._requeue(chat_id, loop.time() + self.renew_before, unmute)
+            return
+        if unmute:
+            self._muted.pop(chat_id, None)
+            self.stats['unmutes'] += 1
+            return
+        self._muted[chat_id] = mute_until
+        self.stats['mutes'] += 1
+        # Jitter the renewal so chats muted together do not all come due together
+        renew_at = loop.time() + self.duration - self.renew_before * random.uniform(0.5, 1.0)
+        self._schedule(chat_id, renew_at)
+
+    def _requeue(self, chat_id: int, due: float, unmute: bool):
+        if unmute:
+            heapq.heappush(self._heap, (due, chat_id))
+        elif chat_id in self._due:
+            self._schedule(chat_id, due)
+
+    async def _set_mute(self, chat_id: int, mute_until: int):
+        chat = self.index.chats.get(chat_id)
+        peer = chat['peer'] if chat else chat_id
+        settings = InputPeerNotifySettings(
+            show_previews=not mute_until,
+            silent=bool(mute_until),
+            mute_until=mute_until,
+            sound=None
+        )
+        await self.client(functions.account.UpdateNotifySettingsRequest(
+            peer=InputNotifyPeer(peer=await self.client.get_input_entity(peer)),
+            settings=settings
+        ))
+        if chat:
+            chat['mute_until'] = mute_until
+
+    async def _unmute_all(self):
+        for chat_id in list(self._muted):
+            try:
+                await self._set_mute(chat_id, 0)
+            except errors.FloodWaitError:
+                self.logger.warning(f"FloodWait while unmuting, {len(self._muted)} chats unmute "
+                                    f"when their mute expires")
+                return
+            except Exception as e:
+                self.logger.error(f"Error unmuting chat {chat_id}: {str(e)}")
+            self._muted.pop(chat_id, None)
+            self.stats['unmutes'] += 1
+            await asyncio.sleep(min(self.spacing, 0.5))
+        self.logger.info("Unmuted all muted chats")
@@ -0,0 +1,322 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from telethon import Button, errors
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Errors worth trying again: Telegram answered with an error, so the message was not delivered
+RETRYABLE_ERRORS = (errors.ServerError,)
+# Errors that leave open whether Telegram got the message: the connection dropped or timed out mid-send
+UNCERTAIN_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError, errors.TimedOutError)
+
+
+class DeliveryUncertain(Exception):
+    """A send failed in a way that does not tell whether the message went out"""
+
+    def __init__(self, error: BaseException):
+        super().__init__(f"{type(error).__name__}: {str(error)}")
+        self.error = error
+
+
+# Inline keyboard as plain data: rows of (label, callback data)
+ButtonSpec = Sequence[Sequence[Tuple[str, str]]]
+
+
+def build_buttons(spec: Optional[ButtonSpec]):
+    if not spec:
+        return None
+    return [[Button.inline(label, data) for label, data in row] for row in spec]
+
+
+class Outbox:
+    """Rate limited send queue for one Telegram client.
+
+    Messages leave in order, at most ``per_second`` in total and one per
+    ``per_chat_interval`` seconds to the same chat. A FloodWait pauses the whole
+    client for the time Telegram asks for and the message is sent afterwards.
+    Durable messages are written to the ``outbox`` table before they are
+    queued and reloaded on start, and a ``key`` makes repeated sends of the
+    same thing (a second Approve press, a replay after restart) a no-op.
+
+    When ``digest_threshold`` or more messages of kind ``card`` are waiting,
+    they are folded into one digest that ``digest`` builds from their summaries.
+
+    A send that fails without telling whether it went out (connection lost,
+    timeout) is retried, unless ``on_uncertain`` is set: then it is marked
+    ``uncertain``, its future fails with ``DeliveryUncertain`` and
+    ``on_uncertain(item, error)`` is awaited, so nothing reaches a chat twice.
+    """
+
+    def __init__(self, storage: Storage, client, name: str, per_second: float = 1.0,
+                 per_chat_interval: float = 1.0, max_attempts: int = 5,
+                 digest_threshold: int = 5, digest: Callable[[List[str]], str] = None,
+                 on_uncertain: Callable[[dict, BaseException], Awaitable[None]] = None):
+        self.storage = storage
+        self.client = client
+        self.name = name
+        self.per_second = per_second
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.digest_threshold = digest_threshold
+        self.digest = digest
+        self.on_uncertain = on_uncertain
+        self.logger = logger
+        self._queue: Deque[dict] = deque()
+        self._by_key: Dict[str, dict] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_send = 0.0
+        self._chat_last_send: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self.stats = {'sent': 0, 'flood_waits': 0, 'retries': 0, 'failed': 0, 'uncertain': 0, 'coalesced': 0,
+                      'duplicates': 0}
+
+    async def init(self):
+        """Create the outbox table and requeue durable messages left from the last run"""
+        await self.storage.execute_schema([
+            '''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT NOT NULL,  -- which client sends it: user or bot
+                    chat_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    buttons TEXT NULL,  -- JSON rows of [label, callback data]
+                    kind TEXT NOT NULL,
+                    summary TEXT NULL,  -- one line used when the message is folded into a digest
+                    dedupe_key TEXT UNIQUE,
+                    status TEXT NOT NULL DEFAULT 'queued',  -- queued, sent, coalesced, failed, uncertain
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    sent_at REAL NULL,
+                    sent_message_id INTEGER NULL,
+                    error TEXT NULL
+                )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(sender, status, id)',
+        ])
+        # Delivered rows are only kept around for a week
+        await self.storage.execute('''
+            DELETE FROM outbox WHERE sender = ? AND status IN ('sent', 'coalesced') AND created_at < ?
+        ''', (self.name, time.time() - 7 * 86400))
+        rows = await self.storage.fetchall('''
+            SELECT id, chat_id, text, buttons, kind, summary, dedupe_key, attempts FROM outbox
+            WHERE sender = ? AND status = 'queued' ORDER BY id
+        ''', (self.name,))
+        for row_id, chat_id, text, buttons, kind, summary, key, attempts in rows:
+            self._enqueue(self._item(chat_id, text, json.loads(buttons) if buttons else None, kind, key,
+                                     summary=summary, row_id=row_id, attempts=attempts))
+        if rows:
+            self.logger.info(f"Requeued {len(rows)} unsent {self.name} messages from the outbox")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._send_loop())
+
+    async def stop(self):
+        """Stop sending; durable messages still queued are sent on the next start"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def backlog(self) -> int:
+        return len(self._queue)
+
+    @property
+    def congested(self) -> bool:
+        """True when new review cards would be folded into a digest"""
+        return sum(1 for item in self._queue if item['kind'] == 'card') >= self.digest_threshold
+
+    async def send(self, chat_id: int, text: str, buttons: ButtonSpec = None, kind: str = 'message',
+                   key: str = None, durable: bool = False, summary: str = None) -> Any:
+        """Queue a message and wait until it is sent; returns the Message (None if folded into a digest)"""
+        future = await self.queue(chat_id, text, buttons, kind, key, durable, summary)
+        return await asyncio.shield(future)
+
+    async def queue(self, chat_id: int, text: str, buttons: ButtonSpec = None, kind: str = 'message',
+                    key: str = None, durable: bool = False, summary: str = None) -> asyncio.Future:
+        """Queue a message; once this returns a durable message is safely in the outbox table.
+
+        The returned future resolves when the message is sent.
+        """
+        if key is not None and key in self._by_key:
+            self.stats['duplicates'] += 1
+            return self._by_key[key]['future']
+        row_id = None
+        if durable:
+            row_id = await self._persist(chat_id, text, buttons, kind, key, summary)
+            if row_id is None:
+                self.stats['duplicates'] += 1
+                self.logger.info(f"Skipping duplicate {self.name} send {key}")
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(None)
+                return future
+        item = self._item(chat_id, text, buttons, kind, key, summary=summary, row_id=row_id)
+        self._enqueue(item)
+        return item['future']
+
+    def _item(self, chat_id: int, text: str, buttons, kind: str, key: Optional[str], summary: str = None,
+              row_id: int = None, attempts: int = 0) -> dict:
+        return {
+            'row_id': row_id, 'chat_id': chat_id, 'text': text, 'buttons': buttons, 'kind': kind, 'key': key,
+            'summary': summary, 'attempts': attempts, 'future': asyncio.get_running_loop().create_future(),
+        }
+
+    def _enqueue(self, item: dict):
+        # Nobody may be waiting on the result (queued without waiting, requeued rows)
+        item['future'].add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._queue.append(item)
+        if item['key'] is not None:
+            self._by_key[item['key']] = item
+        self._wakeup.set()
+
+    async def _persist(self, chat_id: int, text: str, buttons, kind: str, key: Optional[str],
+                       summary: Optional[str]) -> Optional[int]:
+        """Write the message to the outbox; None if ``key`` was queued or sent before"""
+        if key is not None:
+            existing = await self.storage.fetchone('SELECT status FROM outbox WHERE dedupe_key = ?', (key,))
+            if existing is not None and existing[0] != 'failed':
+                return None
+            if existing is not None:
+                await self.storage.execute('DELETE FROM outbox WHERE dedupe_key = ?', (key,))
+        async with self.storage.transaction() as db:
+            cursor = await db.execute('''
+                INSERT INTO outbox (sender, chat_id, text, buttons, kind, summary, dedupe_key, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (self.name, chat_id, text, json.dumps(buttons, ensure_ascii=False) if buttons else None,
+                  kind, summary, key, time.time()))
+            return cursor.lastrowid
+
+    def _mark(self, item: dict, status: str, message_id: int = None, error: str = None):
+        if item['row_id'] is None:
+            return
+        self.storage.submit('''
+            UPDATE outbox SET status = ?, attempts = ?, sent_at = ?, sent_message_id = ?, error = ? WHERE id = ?
+        ''', (status, item['attempts'], time.time() if status == 'sent' else None, message_id, error,
+              item['row_id']))
+
+    def _finish(self, item: dict, result: Any = None, error: BaseException = None):
+        if item['key'] is not None and self._by_key.get(item['key']) is item:
+            del self._by_key[item['key']]
+        if item['future'].done():
+            return
+        if error is not None:
+            item['future'].set_exception(error)
+        else:
+            item['future'].set_result(result)
+
+    def _next_ready(self, now: float) -> Tuple[Optional[dict], float]:
+        """First queued message whose chat may be sent to now, else how long until one is"""
+        wait = None
+        for item in self._queue:
+            ready_at = self._chat_last_send.get(item['chat_id'], 0.0) + self.per_chat_interval
+            if ready_at <= now:
+                return item, 0.0
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait if wait is not None else 0.0
+
+    async def _send_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            pause = max(self._paused_until - now, self._last_send + 1 / self.per_second - now)
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.digest is not None and self.congested:
+                self._coalesce()
+            item, wait = self._next_ready(now)
+            if item is None:
+                await asyncio.sleep(wait)
+                continue
+            self._queue.remove(item)
+            await self._deliver(item)
+
+    async def _deliver(self, item: dict):
+        loop = asyncio.get_running_loop()
+        item['attempts'] += 1
+        try:
+            sent = await self.client.send_message(item['chat_id'], item['text'],
+                                                  buttons=build_buttons(item['buttons']))
+        except (errors.FloodWaitError, errors.SlowModeWaitError) as e:
+            self.stats['flood_waits'] += 1
+            self.logger.warning(f"{self.name} outbox: {type(e).__name__}, pausing {e.seconds}s")
+            if isinstance(e, errors.FloodWaitError):
+                self._paused_until = loop.time() + e.seconds
+            else:
+                self._chat_last_send[item['chat_id']] = loop.time() + e.seconds
+            item['attempts'] -= 1  # not the message's fault
+            self._queue.appendleft(item)
+            return
+        except UNCERTAIN_ERRORS + RETRYABLE_ERRORS as e:
+            if self.on_uncertain is not None and isinstance(e, UNCERTAIN_ERRORS):
+                await self._uncertain(item, e)
+                return
+            if item['attempts'] < self.max_attempts:
+                self.stats['retries'] += 1
+                delay = random.uniform(0, min(60, 2 ** item['attempts']))
+                self.logger.warning(f"{self.name} outbox: send to {item['chat_id']} failed ({str(e)}), "
+                                    f"retry {item['attempts']}/{self.max_attempts} in {delay:.1f}s")
+                self._mark(item, 'queued', error=str(e))
+                self._chat_last_send[item['chat_id']] = loop.time() + delay
+                self._queue.appendleft(item)
+                return
+            self._fail(item, e)
+            return
+        except Exception as e:
+            self._fail(item, e)
+            return
+        finally:
+            self._last_send = loop.time()
+            self._chat_last_send[item['chat_id']] = max(self._chat_last_send.get(item['chat_id'], 0.0),
+                                                        self._last_send)
+        self.stats['sent'] += 1
+        self._mark(item, 'sent', message_id=getattr(sent, 'id', None))
+        self._finish(item, sent)
+
+    def _fail(self, item: dict, error: Exception):
+        self.stats['failed'] += 1
+        self.logger.error(f"{self.name} outbox: giving up on message to {item['chat_id']}: {str(error)}")
+        self._mark(item, 'failed', error=str(error))
+        self._finish(item, error=error)
+
+    async def _uncertain(self, item: dict, error: BaseException):
+        self.stats['uncertain'] += 1
+        self.logger.error(f"{self.name} outbox: send to {item['chat_id']} may or may not have gone out, "
+                          f"not retrying: {str(error)}")
+        self._mark(item, 'uncertain', error=str(error))
+        self._finish(item, error=DeliveryUncertain(error))
+        try:
+            await self.on_uncertain(item, error)
+        except Exception as e:
+            self.logger.error(f"Error reporting uncertain {self.name} send: {str(e)}")
+
+    def _coalesce(self):
+        """Replace the queued review cards with a single digest message"""
+        cards = [item for item in self._queue if item['kind'] == 'card']
+        for item in cards:
+            self._queue.remove(item)
+        text = self.digest([item['summary'] or item['text'].split('\n', 1)[0] for item in cards])
+        digest = self._item(cards[0]['chat_id'], text, None, 'digest', None)
+        self._queue.appendleft(digest)
+        self.stats['coalesced'] += len(cards)
+        self.logger.info(f"{self.name} outbox: folded {len(cards)} review cards into a digest")
+        for item in cards:
+            self._mark(item, 'coalesced')
+            self._finish(item, None)
@@ -0,0 +1,225 @@
+import io
+import json
+import logging
+import pickle
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Version of the row layout written by PendingStore
+ROW_FORMAT = 2
+
+URGENCIES = ('high', 'medium', 'low')
+
+# message_tracking.action once I have reviewed a draft
+APPROVED = 'approved'
+EDITED = 'edited'
+REJECTED = 'rejected'
+
+_COLUMNS = 'message_id, chat_id, response, context, confidence, urgency, created_at, edited_text'
+
+
+class _ContextUnpickler(pickle.Unpickler):
+    """Only lets plain builtins (the legacy list of strings) through"""
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"refusing to load {module}.{name} from pending_messages")
+
+
+def _legacy_context(blob) -> List[str]:
+    if blob is None:
+        return []
+    try:
+        return list(_ContextUnpickler(io.BytesIO(blob)).load())
+    except Exception as e:
+        logger.error(f"Dropping unreadable legacy context: {str(e)}")
+        return []
+
+
+def _legacy_timestamp(value) -> float:
+    # CURRENT_TIMESTAMP is stored as UTC text
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+
+class PendingStore:
+    """Drafts waiting for review, kept in SQLite and read on demand.
+
+    Rows hold the context as JSON next to normalized columns, indexed on
+    urgency, chat_id and creation time so summaries and filtered listings are
+    answered by the database instead of a resident dict.
+
+    With ``owner`` set (one account of a multi-account deployment sharing the
+    database) new drafts are tagged with it and listings only see its own.
+    """
+
+    def __init__(self, storage: Storage, owner: str = None):
+        self.storage = storage
+        self.owner = owner
+        self.logger = logger
+        self.count = 0
+        # Drafts an approve/reject is currently acting on
+        self._claimed: Set[str] = set()
+
+    async def init(self):
+        columns = {row[1]: row[2] for row in await self.storage.fetchall('PRAGMA table_info(pending_messages)')}
+        if columns and 'format_version' not in columns:
+            await self._migrate_legacy()
+        await self.storage.execute_schema([
+            self._create_table('pending_messages'),
+            'CREATE INDEX IF NOT EXISTS idx_pending_urgency ON pending_messages(urgency, created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_pending_chat ON pending_messages(chat_id, created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_pending_created ON pending_messages(created_at)',
+        ])
+        await self.storage.ensure_column('pending_messages', 'owner', 'TEXT NULL')
+        await self._recount()
+
+    async def _recount(self):
+        # Read back rather than +1/-1: a REPLACE or a delete of a handled draft leaves the size unchanged
+        where, params = self._owner_clause()
+        row = await self.storage.fetchone(f'SELECT COUNT(*) FROM pending_messages{where}', params)
+        self.count = row[0]
+
+    def _owner_clause(self, joiner: str = ' WHERE ') -> tuple:
+        if self.owner is None:
+            return '', ()
+        return f'{joiner}owner = ?', (self.owner,)
+
+    @staticmethod
+    def _create_table(name: str) -> str:
+        return f'''
+            CREATE TABLE IF NOT EXISTS {name} (
+                message_id TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                context TEXT NOT NULL,  -- JSON array of formatted context lines
+                confidence INTEGER,
+                urgency TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                edited_text TEXT NULL,
+                format_version INTEGER NOT NULL DEFAULT {ROW_FORMAT}
+            )
+        '''
+
+    async def _migrate_legacy(self):
+        """Rewrite the pickled v1 table into the JSON row format in one transaction"""
+        rows = await self.storage.fetchall(
+            'SELECT message_id, chat_id, response, context, confidence, urgency, timestamp FROM pending_messages'
+        )
+        async with self.storage.transaction() as db:
+            await db.execute(self._create_table('pending_messages_v2'))
+            await db.executemany(f'''
+                INSERT OR REPLACE INTO pending_messages_v2 ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, NULL)
+            ''', [
+                (
+                    message_id, chat_id, response or "",
+                    json.dumps(_legacy_context(context), ensure_ascii=False),
+                    confidence, urgency if urgency in URGENCIES else 'low',
+                    _legacy_timestamp(timestamp),
+                )
+                for message_id, chat_id, response, context, confidence, urgency, timestamp in rows
+            ])
+            await db.execute('DROP TABLE pending_messages')
+            await db.execute('ALTER TABLE pending_messages_v2 RENAME TO pending_messages')
+        self.logger.info(f"Migrated {len(rows)} pending messages to row format {ROW_FORMAT}")
+
+    @staticmethod
+    def _row_to_data(row) -> dict:
+        message_id, chat_id, response, context, confidence, urgency, created_at, edited_text = row
+        return {
+            'message_id': message_id,
+            'chat_id': chat_id,
+            'response': response,
+            'context': json.loads(context),
+            'confidence': confidence,
+            'urgency': urgency,
+            'created_at': created_at,
+            'edited_text': edited_text,
+        }
+
+    async def add(self, message_id: str, message_data: dict):
+        """Save a new draft"""
+        await self.storage.execute(f'''
+            INSERT OR REPLACE INTO pending_messages ({_COLUMNS}, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            message_id,
+            message_data['chat_id'],
+            message_data['response'],
+            json.dumps(message_data['context'], ensure_ascii=False),
+            message_data['confidence'],
+            message_data['urgency'],
+            message_data.get('created_at') or time.time(),
+            message_data.get('edited_text'),
+            self.owner,
+        ))
+        await self._recount()
+
+    async def get(self, message_id: str) -> Optional[dict]:
+        """Load a single draft, or None if it has been handled already"""
+        row = await self.storage.fetchone(
+            f'SELECT {_COLUMNS} FROM pending_messages WHERE message_id = ?', (message_id,)
+        )
+        return self._row_to_data(row) if row else None
+
+    async def update_response(self, message_id: str, response: str):
+        """Replace the proposed response with my edited version"""
+        await self.storage.execute(
+            'UPDATE pending_messages SET response = ?, edited_text = ? WHERE message_id = ?',
+            (response, response, message_id)
+        )
+
+    async def replace_draft(self, message_id: str, response: str, confidence: int, urgency: str):
+        """Put a newer draft in place of the proposed one, e.g. the model's take on a reply from history"""
+        await self.storage.execute(
+            'UPDATE pending_messages SET response = ?, confidence = ?, urgency = ? WHERE message_id = ?',
+            (response, confidence, urgency, message_id)
+        )
+
+    async def delete(self, message_id: str):
+        await self.storage.execute('DELETE FROM pending_messages WHERE message_id = ?', (message_id,))
+        await self._recount()
+
+    def claim(self, message_id: str) -> bool:
+        """Mark a draft as being acted on; False if another press already has it"""
+        if message_id in self._claimed:
+            return False
+        self._claimed.add(message_id)
+        return True
+
+    def release(self, message_id: str):
+        self._claimed.discard(message_id)
+
+    async def counts_by_urgency(self) -> Dict[str, int]:
+        counts = {urgency: 0 for urgency in URGENCIES}
+        where, params = self._owner_clause()
+        rows = await self.storage.fetchall(
+            f'SELECT urgency, COUNT(*) FROM pending_messages{where} GROUP BY urgency', params
+        )
+        for urgency, count in rows:
+            counts[urgency if urgency in counts else 'low'] += count
+        return counts
+
+    async def list(self, urgency: str = None, chat_id: int = None, limit: int = 10) -> List[dict]:
+        """Oldest drafts first, optionally filtered by urgency and/or chat"""
+        sql = f'SELECT {_COLUMNS} FROM pending_messages'
+        clauses, params = [], []
+        if self.owner is not None:
+            clauses.append('owner = ?')
+            params.append(self.owner)
+        if urgency:
+            clauses.append('urgency = ?')
+            params.append(urgency)
+        if chat_id is not None:
+            clauses.append('chat_id = ?')
+            params.append(chat_id)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY created_at LIMIT ?'
+        params.append(limit)
+        return [self._row_to_data(row) for row in await self.storage.fetchall(sql, params)]
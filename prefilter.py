@@ -0,0 +1,276 @@
+"""Local should_respond classifier that lets obvious chatter skip the GPT call.
+
+    python prefilter.py            train on the logged triage decisions and print how it would do
+    python prefilter.py --check    check how review outcomes turn into training labels
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+from pending import REJECTED
+from storage import Storage, DB_PATH
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:  # optional, without it every chat goes to GPT
+    np = None
+
+# "sender_username <@alice> [2024-05-01 12:00:00]: " prefixes; the timestamp is noise for the classifier
+_TIMESTAMP = re.compile(r'\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\]')
+_TOKEN = re.compile(r"[\w@']+|[?!]")
+
+MODES = ('off', 'shadow', 'enforce')
+
+
+def features(text: str, n_features: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Hashed word uni- and bigrams of ``text`` as (indices, L2-normalized counts)"""
+    tokens = _TOKEN.findall(_TIMESTAMP.sub(' ', text.lower()))
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    # crc32 rather than hash(): str hashes are salted per process
+    indices = np.fromiter((zlib.crc32(gram.encode('utf-8')) % n_features for gram in grams),
+                          dtype=np.int64, count=len(grams))
+    indices, counts = np.unique(indices, return_counts=True)
+    values = counts.astype(np.float32)
+    norm = np.sqrt((values * values).sum())
+    return indices, values / norm if norm else values
+
+
+class HashedLogisticRegression:
+    """Logistic regression over hashed n-grams, trained with plain SGD"""
+
+    def __init__(self, n_features: int = 2 ** 18, epochs: int = 8, learning_rate: float = 0.5,
+                 l2: float = 1e-5, seed: int = 0):
+        self.n_features = n_features
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.l2 = l2
+        self.seed = seed
+        self.weights = np.zeros(n_features, dtype=np.float32)
+        self.bias = 0.0
+
+    def predict(self, text: str) -> float:
+        """Probability that the chat needs a response"""
+        indices, values = features(text, self.n_features)
+        z = self.bias + float(self.weights[indices] @ values)
+        return 1.0 / (1.0 + np.exp(-max(min(z, 30.0), -30.0)))
+
+    def fit(self, texts: Sequence[str], labels: Sequence[int]) -> "HashedLogisticRegression":
+        samples = [features(text, self.n_features) for text in texts]
+        labels = np.asarray(labels, dtype=np.float32)
+        # Balance the classes: most chatter needs no reply
+        positives = max(float(labels.sum()), 1.0)
+        negatives = max(float(len(labels) - labels.sum()), 1.0)
+        class_weight = {1.0: len(labels) / (2 * positives), 0.0: len(labels) / (2 * negatives)}
+        order = list(range(len(samples)))
+        rng = random.Random(self.seed)
+        for epoch in range(self.epochs):
+            rng.shuffle(order)
+            rate = self.learning_rate / (1 + epoch)
+            for i in order:
+                indices, values = samples[i]
+                z = self.bias + float(self.weights[indices] @ values)
+                p = 1.0 / (1.0 + np.exp(-max(min(z, 30.0), -30.0)))
+                gradient = (p - labels[i]) * class_weight[float(labels[i])]
+                self.weights[indices] -= rate * (gradient * values + self.l2 * self.weights[indices])
+                self.bias -= rate * gradient
+        return self
+
+
+class Prefilter:
+    """Decides from the chat context alone when a GPT triage call is not needed.
+
+    Every triage decision is written to the ``triage_log`` table. The model
+    is trained from those rows: GPT's should_respond, with rejected drafts
+    counted as "no reply needed". A chat is skipped only when the model puts
+    the chance of it needing a reply under ``threshold``, and only after the
+    held-out check shows that threshold misses at most ``max_miss_rate`` of
+    the chats that did need one.
+
+    In ``shadow`` mode the score is only logged next to GPT's answer, so you
+    can see how often the two agree before switching to ``enforce``.
+    """
+
+    def __init__(self, storage: Storage, mode: str = 'shadow', threshold: float = 0.05,
+                 min_samples: int = 200, max_samples: int = 20000, max_miss_rate: float = 0.02):
+        self.storage = storage
+        self.mode = mode if mode in MODES else 'off'
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.max_miss_rate = max_miss_rate
+        self.logger = logger
+        self.model: Optional[HashedLogisticRegression] = None
+        # Whether the held-out check allows skipping at the threshold
+        self.trusted = False
+        self.evaluation: dict = {}
+        if np is None and self.mode != 'off':
+            self.logger.info("numpy not installed, the prefilter is off")
+            self.mode = 'off'
+
+    async def init(self):
+        await self.storage.execute_schema([
+            '''
+                CREATE TABLE IF NOT EXISTS triage_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    message_id TEXT NULL,  -- the draft, when one was made
+                    context TEXT NOT NULL,
+                    should_respond INTEGER NOT NULL,
+                    source TEXT NOT NULL,  -- api, cache or prefilter
+                    prefilter_score REAL NULL,
+                    created_at REAL NOT NULL
+                )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_triage_log_message_id ON triage_log(message_id)',
+        ])
+        await self.storage.execute('DELETE FROM triage_log WHERE created_at < ?', (time.time() - 90 * 86400,))
+
+    def record(self, chat_id: int, context: str, should_respond: bool, source: str,
+               score: Optional[float] = None, message_id: str = None):
+        self.storage.submit('''
+            INSERT INTO triage_log (chat_id, message_id, context, should_respond, source, prefilter_score, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (chat_id, message_id, context, int(should_respond), source, score, time.time()))
+
+    def score(self, context: str) -> Optional[float]:
+        """Chance the chat needs a reply, or None while there is no model"""
+        if self.mode == 'off' or self.model is None:
+            return None
+        return self.model.predict(context)
+
+    def should_skip(self, score: Optional[float]) -> bool:
+        """True if the GPT call can be skipped for this score"""
+        return self.mode == 'enforce' and self.trusted and score is not None and score < self.threshold
+
+    async def load_samples(self) -> Tuple[List[str], List[int]]:
+        """Contexts and labels of GPT decisions, oldest first"""
+        rows = await self.storage.fetchall('''
+            SELECT l.context, l.should_respond, t.action
+            FROM triage_log l LEFT JOIN message_tracking t ON t.message_id = l.message_id
+            WHERE l.source IN ('api', 'cache')
+            ORDER BY l.id DESC LIMIT ?
+        ''', (self.max_samples,))
+        rows.reverse()
+        texts = [context for context, _, _ in rows]
+        # GPT's call, overruled when I rejected the draft in review
+        labels = [1 if should_respond and action != REJECTED else 0 for _, should_respond, action in rows]
+        return texts, labels
+
+    async def train(self) -> bool:
+        """Retrain from the triage log; False if there is not enough data yet"""
+        if self.mode == 'off':
+            return False
+        texts, labels = await self.load_samples()
+        if len(texts) < self.min_samples or len(set(labels)) < 2:
+            self.logger.info(f"Prefilter has {len(texts)} labelled chats, waiting for {self.min_samples}")
+            return False
+        self.model, self.evaluation = await asyncio.to_thread(self._fit, texts, labels)
+        self.trusted = self.evaluation['miss_rate'] <= self.max_miss_rate
+        self.logger.info(
+            f"Prefilter trained on {len(texts)} chats: would skip {self.evaluation['skip_rate']:.0%}, "
+            f"missing {self.evaluation['miss_rate']:.1%} of needed replies on held-out data"
+            + ("" if self.trusted else " (too many, not skipping)")
+        )
+        return True
+
+    def _fit(self, texts: List[str], labels: List[int]) -> Tuple[HashedLogisticRegression, dict]:
+        # Hold out the newest fifth to check the threshold, then refit on everything
+        split = int(len(texts) * 0.8)
+        held_out = HashedLogisticRegression().fit(texts[:split], labels[:split])
+        evaluation = self._evaluate(held_out, texts[split:], labels[split:])
+        return HashedLogisticRegression().fit(texts, labels), evaluation
+
+    def _evaluate(self, model: HashedLogisticRegression, texts: List[str], labels: List[int]) -> dict:
+        scores = np.array([model.predict(text) for text in texts])
+        labels = np.asarray(labels)
+        skipped = scores < self.threshold
+        positives = max(int(labels.sum()), 1)
+        return {
+            'samples': len(texts),
+            'skip_rate': float(skipped.mean()) if len(texts) else 0.0,
+            'miss_rate': float((skipped & (labels == 1)).sum() / positives),
+            'accuracy': float(((scores >= 0.5) == (labels == 1)).mean()) if len(texts) else 0.0,
+        }
+
+    async def shadow_report(self, since: float = 0) -> dict:
+        """How the logged prefilter scores compare with GPT's answers"""
+        rows = await self.storage.fetchall('''
+            SELECT prefilter_score < ?, should_respond, COUNT(*) FROM triage_log
+            WHERE source IN ('api', 'cache') AND prefilter_score IS NOT NULL AND created_at >= ?
+            GROUP BY 1, 2
+        ''', (self.threshold, since))
+        counts = {(bool(skip), bool(respond)): count for skip, respond, count in rows}
+        total = sum(counts.values())
+        agree = counts.get((True, False), 0) + counts.get((False, True), 0)
+        return {
+            'scored': total,
+            'would_skip': counts.get((True, False), 0) + counts.get((True, True), 0),
+            'missed': counts.get((True, True), 0),
+            'agreement': agree / total if total else None,
+        }
+
+
+async def _main():
+    from config import PREFILTER_SKIP_THRESHOLD, PREFILTER_MIN_SAMPLES, PREFILTER_MAX_MISS_RATE
+
+    storage = Storage(DB_PATH)
+    await storage.open()
+    try:
+        prefilter = Prefilter(storage, mode='shadow', threshold=PREFILTER_SKIP_THRESHOLD,
+                              min_samples=PREFILTER_MIN_SAMPLES, max_miss_rate=PREFILTER_MAX_MISS_RATE)
+        await prefilter.init()
+        if await prefilter.train():
+            evaluation = prefilter.evaluation
+            print(f"Held-out chats: {evaluation['samples']}")
+            print(f"Would skip: {evaluation['skip_rate']:.1%}  Missed replies: {evaluation['miss_rate']:.1%}  "
+                  f"Accuracy at 0.5: {evaluation['accuracy']:.1%}")
+            print("Safe to enforce" if prefilter.trusted else "Not safe to enforce at this threshold")
+        report = await prefilter.shadow_report()
+        if report['scored']:
+            print(f"Shadow mode: {report['scored']} scored, would skip {report['would_skip']}, "
+                  f"{report['missed']} of those needed a reply, agreement {report['agreement']:.1%}")
+    finally:
+        await storage.close()
+
+
+async def _check():
+    """A draft GPT wanted to send but I rejected is labelled as needing no reply"""
+    with tempfile.TemporaryDirectory() as workdir:
+        storage = Storage(os.path.join(workdir, 'prefilter.db'))
+        await storage.open()
+        try:
+            await storage.execute_schema([
+                'CREATE TABLE message_tracking (id INTEGER PRIMARY KEY, message_id TEXT, action TEXT)',
+            ])
+            prefilter = Prefilter(storage, mode='shadow')
+            await prefilter.init()
+            cases = [('approved', True, 'approved', 1), ('rejected', True, REJECTED, 0),
+                     ('pending', True, 'pending', 1), ('not asked', False, None, 0)]
+            for message_id, should_respond, action, _ in cases:
+                prefilter.record(1, message_id, should_respond, 'api', message_id=message_id)
+                if action is not None:
+                    storage.submit('INSERT INTO message_tracking (message_id, action) VALUES (?, ?)',
+                                   (message_id, action))
+            await storage.flush()
+            texts, labels = await prefilter.load_samples()
+        finally:
+            await storage.close()
+    assert dict(zip(texts, labels)) == {message_id: label for message_id, *_, label in cases}, labels
+    print("OK: " + ", ".join(f"{text} -> {label}" for text, label in zip(texts, labels)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--check", action="store_true", help="check the labels derived from review outcomes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_check() if args.check else _main())
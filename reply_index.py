@@ -0,0 +1,124 @@
+import logging
+import re
+import sqlite3
+from typing import List, Sequence
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# "sender_username <@alice> [2024-05-01 12:00:00]: text" lines of message_tracking.message_context
+_PREFIX = re.compile(r'^[^<:]*<@?(?P<sender>[^>]*)>\s*(?:\[[^\]]*\])?:\s')
+_WORD = re.compile(r"[^\W\d_]{3,}")
+_STOPWORDS = frozenset('''
+    the and for are but not you all any can had her was one our out has him his how its may new now old see
+    two way who did get got let put say she too use that this with have from they will would there their what
+    about which when make like time just know take into your some could them than then look only come over
+    also back after want because these give most thanks thank hey hello please yeah yes okay
+'''.split())
+
+
+def _lines(context: str) -> List[str]:
+    return [line for line in context.split('\n') if line.strip()]
+
+
+def terms(lines: Sequence[str], exclude_sender: str = None, last: int = 3) -> List[str]:
+    """Distinct content words of the last ``last`` messages not sent by ``exclude_sender``"""
+    picked = []
+    for line in reversed(lines):
+        match = _PREFIX.match(line)
+        sender, text = (match.group('sender'), line[match.end():]) if match else ('', line)
+        if exclude_sender and sender == exclude_sender:
+            continue
+        picked.append(text)
+        if len(picked) == last:
+            break
+    words = []
+    for word in _WORD.findall(" ".join(reversed(picked)).lower()):
+        if word not in _STOPWORDS and word not in words:
+            words.append(word)
+    return words
+
+
+class ReplyIndex:
+    """FTS5 index of the replies I approved or edited, searched before a chat goes to the model.
+
+    Rows come from ``message_tracking``: triggers add a draft's context and
+    final text (my edit if there is one) when it is approved or edited, and
+    take it out again if it is rejected afterwards. ``search`` ranks by BM25
+    over the contexts. BM25 scores are not comparable between queries, so
+    whether a hit is close enough to suggest is judged by the Jaccard
+    similarity of the latest messages' words on both sides.
+
+    Needs SQLite built with FTS5; without it ``enabled`` is False and
+    ``search`` returns nothing.
+    """
+
+    def __init__(self, storage: Storage, me: str = None, candidates: int = 5):
+        self.storage = storage
+        self.me = me  # my username, whose lines are not part of the question
+        self.candidates = candidates
+        self.enabled = False
+        self.logger = logger
+
+    async def init(self):
+        try:
+            await self.storage.execute_schema([
+                '''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS reply_index USING fts5(
+                        context, reply, tokenize = 'porter unicode61 remove_diacritics 2'
+                    )
+                ''',
+                # rowid is message_tracking.id
+                '''
+                    CREATE TRIGGER IF NOT EXISTS reply_index_review AFTER UPDATE OF action, edited_text
+                    ON message_tracking BEGIN
+                        DELETE FROM reply_index WHERE rowid = new.id;
+                        INSERT INTO reply_index (rowid, context, reply)
+                        SELECT new.id, new.message_context, COALESCE(new.edited_text, new.gpt_response)
+                        WHERE new.action IN ('approved', 'edited');
+                    END
+                ''',
+                '''
+                    CREATE TRIGGER IF NOT EXISTS reply_index_delete AFTER DELETE ON message_tracking BEGIN
+                        DELETE FROM reply_index WHERE rowid = old.id;
+                    END
+                ''',
+            ])
+        except sqlite3.OperationalError as e:
+            self.logger.info(f"Reply history search is off, SQLite has no FTS5: {str(e)}")
+            return
+        # Reviews from before the index existed
+        await self.storage.execute('''
+            INSERT INTO reply_index (rowid, context, reply)
+            SELECT id, message_context, COALESCE(edited_text, gpt_response) FROM message_tracking
+            WHERE action IN ('approved', 'edited') AND id NOT IN (SELECT rowid FROM reply_index)
+        ''')
+        self.enabled = True
+
+    async def search(self, message_contexts: List[str], limit: int = 3) -> List[dict]:
+        """Past replies to conversations like this one, most similar first"""
+        if not self.enabled:
+            return []
+        query_terms = terms(message_contexts, self.me)
+        if not query_terms:
+            return []
+        query = " OR ".join(f'"{term}"' for term in query_terms)
+        rows = await self.storage.fetchall('''
+            SELECT rowid, context, reply, bm25(reply_index, 1.0, 0.25) AS rank
+            FROM reply_index WHERE reply_index MATCH ? ORDER BY rank LIMIT ?
+        ''', (query, self.candidates))
+        wanted = set(query_terms)
+        matches = []
+        for rowid, context, reply, rank in rows:
+            found = set(terms(_lines(context), self.me))
+            union = wanted | found
+            matches.append({
+                'tracking_id': rowid,
+                'context': context,
+                'reply': reply,
+                'bm25': -rank,
+                'similarity': len(wanted & found) / len(union) if union else 0.0,
+            })
+        matches.sort(key=lambda match: (match['similarity'], match['bm25']), reverse=True)
+        return matches[:limit]
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from telethon import errors
+
+logger = logging.getLogger(__name__)
+
+# Shown after the partial draft while tokens are still arriving
+CURSOR = " ▌"
+
+
+class StreamingReviewCard:
+    """Review card that is posted early and filled in as the draft streams.
+
+    The card goes out as soon as the partial triage result says the draft
+    should be sent and its urgency is settled. The response text is then
+    edited in at most once per ``edit_interval`` seconds (Telegram rate limits
+    edits per chat), and ``finish`` writes the final text with the review
+    buttons.
+    """
+
+    def __init__(self, bot, recipient, render: Callable[[dict, str], str], edit_interval: float = 1.5,
+                 post: Callable[[str], Awaitable[Any]] = None):
+        self.bot = bot
+        self.post = post or (lambda text: bot.send_message(recipient, text))
+        self.recipient = recipient
+        self.render = render
+        self.edit_interval = edit_interval
+        self.logger = logger
+        self.message = None
+        self._text = None
+        self._shown = None
+        self._last_edit = 0.0
+        self._edit_task: Optional[asyncio.Task] = None
+        self._post_task: Optional[asyncio.Task] = None
+
+    @property
+    def posted(self) -> bool:
+        """True once the card has been (or is being) posted"""
+        return self._post_task is not None
+
+    async def update(self, snapshot: dict):
+        """Take a partially parsed triage result"""
+        if not snapshot.get('should_respond'):
+            return
+        # Wait for the urgency string before 'response' to close, so the card doesn't show a half word
+        if 'response' not in snapshot or not snapshot.get('urgency'):
+            return
+        self._text = self.render(snapshot, (snapshot.get('response') or '') + CURSOR)
+        if self.message is None:
+            if self._post_task is None:
+                # Posting may sit in the outbox behind a FloodWait; keep reading the stream meanwhile
+                self._post_task = asyncio.create_task(self._post(self._text))
+            return
+        # Never block the stream on Telegram; the next delta picks up what was skipped
+        now = asyncio.get_running_loop().time()
+        if self._edit_task is None and now - self._last_edit >= self.edit_interval:
+            self._last_edit = now
+            self._edit_task = asyncio.create_task(self._edit(self._text))
+
+    async def _post(self, text: str):
+        try:
+            self.message = await self.post(text)
+            self._shown = text
+        except Exception as e:
+            self.logger.error(f"Error posting review card: {str(e)}")
+        self._last_edit = asyncio.get_running_loop().time()
+
+    async def _edit(self, text: str, buttons=None):
+        try:
+            if text != self._shown or buttons:
+                await self.bot.edit_message(self.recipient, self.message, text, buttons=buttons)
+                self._shown = text
+        except Exception as e:
+            self.logger.error(f"Error editing review card: {str(e)}")
+        finally:
+            self._edit_task = None
+
+    async def _settle(self):
+        if self._post_task is not None:
+            await asyncio.gather(self._post_task, return_exceptions=True)
+        if self._edit_task is not None:
+            await asyncio.gather(self._edit_task, return_exceptions=True)
+
+    async def finish(self, text: str, buttons) -> bool:
+        """Write the complete draft and attach the review buttons; False if the card never got posted"""
+        await self._settle()
+        if self.message is None:
+            return False
+        try:
+            await self.bot.edit_message(self.recipient, self.message, text, buttons=buttons)
+        except errors.FloodWaitError as e:
+            # Without this edit the card has no buttons, so wait it out once
+            await asyncio.sleep(e.seconds)
+            await self.bot.edit_message(self.recipient, self.message, text, buttons=buttons)
+        self._shown = text
+        return True
+
+    async def discard(self, text: str):
+        """Replace the card when the final result does not need a review"""
+        await self._settle()
+        if self.message is not None:
+            try:
+                await self.bot.edit_message(self.recipient, self.message, text)
+            except Exception as e:
+                self.logger.error(f"Error replacing review card: {str(e)}")
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class ChatShards:
+    """Which worker triages each group chat when several accounts are in it.
+
+    The first worker to see a chat takes a lease on it in the shared
+    ``chat_shards`` table and keeps renewing it while it runs; every other
+    worker leaves the chat alone until that lease runs out. Answers are
+    cached in memory, so the message path only touches SQLite the first time
+    a chat shows up and after a foreign lease has expired.
+    """
+
+    def __init__(self, storage: Storage, owner: str, lease: float = 300):
+        self.storage = storage
+        self.owner = owner
+        self.lease = lease
+        self.logger = logger
+        self._owned: Dict[int, float] = {}  # chat_id -> lease_until
+        self._others: Dict[int, float] = {}  # chat_id -> lease_until of whoever holds it
+        self._task: Optional[asyncio.Task] = None
+
+    async def init(self):
+        await self.storage.execute_schema([
+            '''
+                CREATE TABLE IF NOT EXISTS chat_shards (
+                    chat_id INTEGER PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    lease_until REAL NOT NULL
+                )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_chat_shards_owner ON chat_shards(owner)',
+        ])
+        # Leases from my previous run are still mine
+        await self._renew()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._renew_loop())
+
+    async def stop(self):
+        """Stop renewing and hand my chats back so other workers pick them up right away"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.storage.execute('DELETE FROM chat_shards WHERE owner = ?', (self.owner,))
+        except Exception as e:
+            self.logger.error(f"Error releasing chat leases: {str(e)}")
+        self._owned.clear()
+
+    async def claim(self, chat_id: int) -> bool:
+        """True if this worker triages ``chat_id``, taking the chat if nobody holds it"""
+        now = time.time()
+        if self._owned.get(chat_id, 0) > now:
+            return True
+        if self._others.get(chat_id, 0) > now:
+            return False
+        async with self.storage.transaction(immediate=True) as db:
+            await db.execute('''
+                INSERT INTO chat_shards (chat_id, owner, lease_until) VALUES (?, ?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until
+                WHERE chat_shards.owner = excluded.owner OR chat_shards.lease_until < ?
+            ''', (chat_id, self.owner, now + self.lease, now))
+            async with db.execute('SELECT owner, lease_until FROM chat_shards WHERE chat_id = ?',
+                                  (chat_id,)) as cursor:
+                owner, lease_until = await cursor.fetchone()
+        if owner == self.owner:
+            self._owned[chat_id] = lease_until
+            self._others.pop(chat_id, None)
+            return True
+        self._owned.pop(chat_id, None)
+        self._others[chat_id] = lease_until
+        return False
+
+    async def _renew(self):
+        await self.storage.execute('UPDATE chat_shards SET lease_until = ? WHERE owner = ?',
+                                   (time.time() + self.lease, self.owner))
+        # Re-read rather than assume: a lease that lapsed while I was stalled may have been taken
+        rows = await self.storage.fetchall('SELECT chat_id, lease_until FROM chat_shards WHERE owner = ?',
+                                           (self.owner,))
+        self._owned = dict(rows)
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self._renew()
+            except Exception as e:
+                self.logger.error(f"Error renewing chat leases: {str(e)}")
@@ -0,0 +1,176 @@
+"""Durable counters bucketed per minute, hour and day in SQLite.
+
+    python stats_store.py                  # per-day totals for the last 7 days
+    python stats_store.py --days 30 --granularity hour --chat 123456
+"""
+import argparse
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from storage import Storage, DB_PATH
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = {
+    'minute': ('stats_minute', 60),
+    'hour': ('stats_hourly', 3600),
+    'day': ('stats_daily', 86400),
+}
+
+# How long each granularity is kept
+RETENTION_SECONDS = {
+    'minute': 2 * 86400,
+    'hour': 90 * 86400,
+    'day': None,
+}
+
+# chat_id used for counters that are not tied to a chat
+GLOBAL = 0
+
+
+class StatsStore:
+    """Counters buffered in memory and flushed incrementally into bucketed tables.
+
+    Every flush adds the buffered increments to the minute, hourly and daily
+    tables at once, so rollups are always current and a restart loses at most
+    one flush interval.
+    """
+
+    def __init__(self, storage: Storage, flush_interval: float = 10.0):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.logger = logger
+        self._pending: Dict[Tuple[int, int, str], int] = defaultdict(int)
+        self._task: Optional[asyncio.Task] = None
+
+    async def init(self):
+        statements = []
+        for table, _ in GRANULARITIES.values():
+            statements.append(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    bucket INTEGER NOT NULL,   -- unix seconds, UTC, start of the bucket
+                    chat_id INTEGER NOT NULL,  -- 0 for counters not tied to a chat
+                    metric TEXT NOT NULL,
+                    value INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (bucket, chat_id, metric)
+                ) WITHOUT ROWID
+            ''')
+            statements.append(f'CREATE INDEX IF NOT EXISTS idx_{table}_metric ON {table}(metric, bucket)')
+        await self.storage.execute_schema(statements)
+
+    def start(self):
+        """Start the periodic flush"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop the periodic flush and write out what is buffered"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def incr(self, metric: str, chat_id: int = GLOBAL, amount: int = 1):
+        """Count ``amount`` towards ``metric`` in the current minute"""
+        minute = int(time.time()) // 60 * 60
+        self._pending[(minute, chat_id or GLOBAL, metric)] += amount
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, defaultdict(int)
+        writes = []
+        for table, size in GRANULARITIES.values():
+            rows = defaultdict(int)
+            for (minute, chat_id, metric), value in pending.items():
+                rows[(minute // size * size, chat_id, metric)] += value
+            writes.append(self.storage.executemany(f'''
+                INSERT INTO {table} (bucket, chat_id, metric, value) VALUES (?, ?, ?, ?)
+                ON CONFLICT (bucket, chat_id, metric) DO UPDATE SET value = value + excluded.value
+            ''', [(bucket, chat_id, metric, value) for (bucket, chat_id, metric), value in rows.items()]))
+        # All three granularities land in the same batched transaction
+        await asyncio.gather(*writes)
+
+    async def prune(self):
+        """Drop fine-grained buckets past their retention"""
+        now = int(time.time())
+        for granularity, retention in RETENTION_SECONDS.items():
+            if retention:
+                table, _ = GRANULARITIES[granularity]
+                await self.storage.execute(f'DELETE FROM {table} WHERE bucket < ?', (now - retention,))
+
+    async def totals(self, since: float, until: float = None, chat_id: int = None,
+                     granularity: str = 'day') -> Dict[str, int]:
+        """Sum of each metric over [since, until)"""
+        table, _ = GRANULARITIES[granularity]
+        sql = f'SELECT metric, SUM(value) FROM {table} WHERE bucket >= ? AND bucket < ?'
+        params = [int(since), int(until if until is not None else time.time() + 86400)]
+        if chat_id is not None:
+            sql += ' AND chat_id = ?'
+            params.append(chat_id)
+        rows = await self.storage.fetchall(sql + ' GROUP BY metric ORDER BY metric', params)
+        return {metric: value for metric, value in rows}
+
+    async def series(self, since: float, until: float = None, chat_id: int = None,
+                     granularity: str = 'day') -> List[Tuple[int, str, int]]:
+        """(bucket, metric, value) rows over [since, until), oldest first"""
+        table, _ = GRANULARITIES[granularity]
+        sql = f'SELECT bucket, metric, SUM(value) FROM {table} WHERE bucket >= ? AND bucket < ?'
+        params = [int(since), int(until if until is not None else time.time() + 86400)]
+        if chat_id is not None:
+            sql += ' AND chat_id = ?'
+            params.append(chat_id)
+        return await self.storage.fetchall(sql + ' GROUP BY bucket, metric ORDER BY bucket, metric', params)
+
+    async def _flush_loop(self):
+        flushes = 0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                flushes += 1
+                if flushes % 360 == 0:
+                    await self.prune()
+            except Exception as e:
+                self.logger.error(f"Error flushing stats: {str(e)}")
+
+
+async def _print_report(args: argparse.Namespace):
+    storage = Storage(args.db)
+    await storage.open()
+    try:
+        store = StatsStore(storage)
+        _, size = GRANULARITIES[args.granularity]
+        since = (int(time.time()) // size * size) - (args.days - 1) * 86400
+        rows = await store.series(since, chat_id=args.chat, granularity=args.granularity)
+        by_bucket: Dict[int, Dict[str, int]] = defaultdict(dict)
+        for bucket, metric, value in rows:
+            by_bucket[bucket][metric] = value
+        fmt = "%Y-%m-%d" if args.granularity == 'day' else "%Y-%m-%d %H:%M"
+        for bucket, metrics in by_bucket.items():
+            print(f"=== {datetime.fromtimestamp(bucket, timezone.utc).strftime(fmt)} UTC ===")
+            for metric, value in metrics.items():
+                print(f"{metric.replace('_', ' ').title()}: {value}")
+        totals = await store.totals(since, chat_id=args.chat, granularity=args.granularity)
+        print(f"=== Total, last {args.days} days ===")
+        for metric, value in totals.items():
+            print(f"{metric.replace('_', ' ').title()}: {value}")
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print stats recorded by the monitor")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--granularity", choices=list(GRANULARITIES), default='day')
+    parser.add_argument("--chat", type=int, help="only this chat id")
+    parser.add_argument("--db", default=DB_PATH)
+    asyncio.run(_print_report(parser.parse_args()))
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'telegram_monitor.db'
+
+
+class Storage:
+    """Single long-lived SQLite connection with WAL mode and coalesced writes.
+
+    Writes are queued and applied by one background flusher, which groups
+    everything that arrives within ``flush_interval`` seconds into a single
+    transaction. Reads go straight to the shared connection.
+    """
+
+    def __init__(self, path: str = DB_PATH, flush_interval: float = 0.005, max_batch: int = 500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.db: Optional[aiosqlite.Connection] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+        # Serializes explicit transactions on the shared connection
+        self._tx_lock = asyncio.Lock()
+        self.logger = logger
+
+    async def open(self):
+        """Open the connection and start the write flusher"""
+        if self.db is not None:
+            return
+        # isolation_level=None: transactions are opened explicitly by the flusher.
+        # cached_statements keeps the prepared statements for our fixed SQL around.
+        self.db = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=256)
+        await self.db.execute('PRAGMA journal_mode=WAL')
+        await self.db.execute('PRAGMA synchronous=NORMAL')
+        await self.db.execute('PRAGMA busy_timeout=5000')
+        await self.db.execute('PRAGMA foreign_keys=OFF')
+        self._closing = False
+        self._flusher = asyncio.create_task(self._flush_loop())
+        self.logger.info(f"Storage opened at {self.path} (WAL)")
+
+    async def close(self):
+        """Flush every queued write, then close the connection"""
+        if self.db is None:
+            return
+        self._closing = True
+        await self._queue.put(None)  # wake the flusher so it drains and exits
+        if self._flusher:
+            await self._flusher
+            self._flusher = None
+        await self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        await self.db.close()
+        self.db = None
+        self.logger.info("Storage flushed and closed")
+
+    @asynccontextmanager
+    async def transaction(self, immediate: bool = False):
+        """Run statements on the connection in one transaction, bypassing the write queue
+
+        ``immediate`` takes the write lock up front, for read-then-write
+        transactions that other processes sharing the database may race.
+        """
+        async with self._tx_lock:
+            await self.db.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield self.db
+            except BaseException:
+                await self.db.execute('ROLLBACK')
+                raise
+            await self.db.execute('COMMIT')
+
+    async def execute_schema(self, statements: Iterable[str]):
+        """Run DDL statements in one transaction, bypassing the write queue"""
+        async with self.transaction() as db:
+            for statement in statements:
+                await db.execute(statement)
+
+    async def ensure_column(self, table: str, column: str, definition: str):
+        """Add a column to an existing table if it is missing"""
+        async with self.db.execute(f'PRAGMA table_info({table})') as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if column not in columns:
+            await self.db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def submit(self, sql: str, params: Sequence[Any] = (), many: bool = False) -> asyncio.Future:
+        """Queue a write without waiting for it to commit"""
+        if self._closing or self.db is None:
+            raise RuntimeError("Storage is closed")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((sql, params, many, future))
+        return future
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()):
+        """Queue a write and wait until its batch has been committed"""
+        await self.submit(sql, params)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]):
+        """Queue a multi-row write and wait until its batch has been committed"""
+        await self.submit(sql, list(seq_of_params), many=True)
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[Tuple]:
+        async with self.db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[Tuple]:
+        async with self.db.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+    async def flush(self):
+        """Wait until everything queued so far has been committed"""
+        if self.db is None or self._closing:
+            return
+        await self.submit('SELECT 1')
+
+    async def _flush_loop(self):
+        while True:
+            item = await self._queue.get()
+            batch = [] if item is None else [item]
+            if item is not None and not self._closing:
+                # Give concurrent writers a few milliseconds to join this transaction
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.max_batch:
+                try:
+                    queued = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if queued is not None:
+                    batch.append(queued)
+            if batch:
+                await self._write_batch(batch)
+            if self._closing and self._queue.empty():
+                return
+
+    async def _write_batch(self, batch: list):
+        try:
+            async with self.transaction() as db:
+                for sql, params, many, _ in batch:
+                    if many:
+                        await db.executemany(sql, params)
+                    else:
+                        await db.execute(sql, params)
+        except Exception as e:
+            self.logger.error(f"Error in batched write, retrying {len(batch)} statements one by one: {str(e)}")
+            async with self._tx_lock:
+                await self._write_individually(batch)
+            return
+
+        for *_, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def _write_individually(self, batch: list):
+        """Fallback so one bad statement does not fail the whole batch"""
+        for sql, params, many, future in batch:
+            try:
+                if many:
+                    await self.db.executemany(sql, params)
+                else:
+                    await self.db.execute(sql, params)
+                if not future.done():
+                    future.set_result(None)
+            except Exception as e:
+                self.logger.error(f"Error in write: {str(e)}")
+                if not future.done():
+                    future.set_exception(e)
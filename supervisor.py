@@ -0,0 +1,142 @@
+"""Run one MessageMonitor worker process per account in config.ACCOUNTS.
+
+    python supervisor.py                 start a worker per account and restart any that exits
+    python supervisor.py --login NAME    log NAME's user and bot sessions in (asks for the OTP once)
+
+Workers share telegram_monitor.db. Each one gets an equal part of the OpenAI
+rate limits and its own metrics port (METRICS_PORT + its position in ACCOUNTS).
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+from config import ACCOUNTS, METRICS_PORT, SHUTDOWN_TIMEOUT_SECONDS, WORKER_RESTART_MAX_BACKOFF_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def _run_worker(account: str, llm_share: float, metrics_port: int):
+    # Imported in the worker process: main sets up logging and reads .env
+    import main
+    try:
+        asyncio.run(main.main(account, llm_share, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """Keeps a worker process running for every account.
+
+    A worker that exits is started again after an exponential backoff, which
+    starts over once a worker has stayed up longer than ``max_backoff``. On
+    SIGTERM or Ctrl+C every worker is asked to stop (they shut down gracefully
+    on SIGTERM) and killed if it is still running after ``shutdown_timeout``.
+    """
+
+    def __init__(self, accounts: List[str], max_backoff: float = 60,
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT_SECONDS):
+        self.accounts = list(accounts)
+        self.max_backoff = max_backoff
+        self.shutdown_timeout = shutdown_timeout
+        self.logger = logger
+        # spawn: workers start from a clean interpreter, not a fork of this one
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: Dict[str, multiprocessing.process.BaseProcess] = {}
+        self._started_at: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self._restart_at: Dict[str, float] = {}
+        self._stopping = False
+
+    def _spawn(self, account: str):
+        index = self.accounts.index(account)
+        process = self._context.Process(
+            target=_run_worker,
+            name=f"worker-{account}",
+            args=(account, 1 / len(self.accounts), METRICS_PORT + index if METRICS_PORT else None),
+        )
+        process.start()
+        self._processes[account] = process
+        self._started_at[account] = time.monotonic()
+        self.logger.info(f"Started worker for {account} (pid {process.pid})")
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        for account in self.accounts:
+            self._spawn(account)
+        while not self._stopping:
+            time.sleep(1)
+            now = time.monotonic()
+            for account, process in list(self._processes.items()):
+                if process.is_alive():
+                    continue
+                if account not in self._restart_at:
+                    if now - self._started_at[account] > self.max_backoff:
+                        self._failures[account] = 0
+                    self._failures[account] = self._failures.get(account, 0) + 1
+                    delay = min(self.max_backoff, 2 ** (self._failures[account] - 1))
+                    self.logger.warning(f"Worker for {account} exited with code {process.exitcode}, "
+                                        f"restarting in {delay}s")
+                    self._restart_at[account] = now + delay
+                elif now >= self._restart_at[account]:
+                    del self._restart_at[account]
+                    self._spawn(account)
+        self._shutdown()
+
+    def _shutdown(self):
+        running = [process for process in self._processes.values() if process.is_alive()]
+        self.logger.info(f"Stopping {len(running)} workers")
+        for process in running:
+            process.terminate()
+        # Workers have their own shutdown deadline; allow a little on top of it
+        deadline = time.monotonic() + self.shutdown_timeout + 5
+        for process in running:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                self.logger.warning(f"{process.name} did not stop in time, killing it")
+                process.kill()
+                process.join()
+
+
+async def login(account: str):
+    """Create an account's session files interactively, before running it under the supervisor"""
+    from telethon import TelegramClient
+
+    api_id, api_hash = os.getenv('tg_app_id'), os.getenv('tg_api_hash')
+    client = TelegramClient(f'user_session_{account}', api_id, api_hash)
+    bot = TelegramClient(f'bot_session_{account}', api_id, api_hash)
+    await client.start(phone=os.getenv(f'tg_phone_{account}'))
+    await bot.start(bot_token=os.getenv(f'tg_bot_token_{account}'))
+    me = await client.get_me()
+    bot_me = await bot.get_me()
+    print(f"{account}: logged in as {me.first_name} (@{me.username}), reviews go through @{bot_me.username}")
+    await asyncio.gather(client.disconnect(), bot.disconnect())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--login", metavar="NAME", help="log an account in interactively and exit")
+    args = parser.parse_args()
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.login:
+        asyncio.run(login(args.login))
+        return
+    if not ACCOUNTS:
+        parser.error("ACCOUNTS in config.py is empty; run main.py for a single account")
+    Supervisor(ACCOUNTS, max_backoff=WORKER_RESTART_MAX_BACKOFF_SECONDS).run()
+
+
+if __name__ == "__main__":
+    main()
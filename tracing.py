@@ -0,0 +1,253 @@
+"""Per-message lifecycle traces: where the time went between a message arriving and the reply going out.
+
+    python tracing.py                        slowest traces and a per-stage breakdown of traces.jsonl
+    python tracing.py --slowest 20 --hours 24
+    python tracing.py --trace 3f2a9c0d1e4b5a6f  every span of one trace
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TRACE_PATH = "traces.jsonl"
+
+# Trace of the chat round the running task works on
+current_trace: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('current_trace', default=None)
+
+
+class Tracer:
+    """Records timed spans and appends them to a JSONL file.
+
+    A trace covers one chat round: the messages that arrived during a quiet
+    window, the triage and draft calls, the review card waiting for me, the
+    button press and the send. Spans are buffered in memory and written by a
+    background task every ``flush_interval`` seconds. Once the file is over
+    ``max_bytes`` it is moved to ``<path>.1``, replacing the previous one, so
+    at most twice that is kept on disk.
+    """
+
+    def __init__(self, path: str = TRACE_PATH, max_bytes: int = 20 * 1024 * 1024, flush_interval: float = 2.0,
+                 clock: Callable[[], float] = time.time, enabled: bool = True, max_buffered: int = 10000,
+                 max_drafts: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.now = clock
+        self.enabled = enabled
+        self.logger = logger
+        self._buffer: Deque[dict] = deque(maxlen=max_buffered)
+        # message_id -> (trace_id, time the draft was sent for review)
+        self._drafts: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._max_drafts = max_drafts
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def new_trace() -> str:
+        return uuid.uuid4().hex[:16]
+
+    @staticmethod
+    def activate(trace_id: Optional[str]):
+        """Make later spans of the running task part of ``trace_id``"""
+        current_trace.set(trace_id)
+
+    def record(self, trace_id: Optional[str], name: str, start: float, end: float = None, **attrs):
+        """Add a span that has already finished"""
+        if not self.enabled or trace_id is None:
+            return
+        end = self.now() if end is None else end
+        span = {'trace': trace_id, 'name': name, 'start': round(start, 3),
+                'duration': round(max(end - start, 0.0), 3)}
+        if attrs:
+            span['attrs'] = attrs
+        self._buffer.append(span)
+
+    @contextmanager
+    def span(self, name: str, trace_id: str = None, **attrs):
+        """Time the block as a span of ``trace_id`` (default: the current trace); yields its attrs to add to"""
+        trace_id = trace_id or current_trace.get()
+        token = current_trace.set(trace_id)
+        start = self.now()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs['error'] = type(e).__name__
+            raise
+        finally:
+            current_trace.reset(token)
+            self.record(trace_id, name, start, **attrs)
+
+    def record_when_done(self, future: asyncio.Future, name: str, **attrs):
+        """Record a span from now until ``future`` resolves, e.g. a message sitting in the outbox"""
+        trace_id, start = current_trace.get(), self.now()
+
+        def done(completed: asyncio.Future):
+            if completed.cancelled() or completed.exception() is not None:
+                attrs['error'] = 'cancelled' if completed.cancelled() else type(completed.exception()).__name__
+            self.record(trace_id, name, start, **attrs)
+
+        future.add_done_callback(done)
+
+    def link_draft(self, message_id: str):
+        """Tie a draft to the current trace so its review and send join it"""
+        trace_id = current_trace.get()
+        if trace_id is None:
+            return
+        now = self.now()
+        self._drafts[message_id] = (trace_id, now)
+        while len(self._drafts) > self._max_drafts:
+            self._drafts.popitem(last=False)
+        # Written out as well, so a review after a restart can still be joined up by message_id
+        self.record(trace_id, 'draft', now, now, message_id=message_id)
+
+    def draft(self, message_id: str) -> Tuple[str, Optional[float]]:
+        """Trace of a draft and when it was sent for review (None once forgotten, e.g. after a restart)"""
+        trace_id, sent_at = self._drafts.get(message_id, (None, None))
+        return trace_id or f"draft-{message_id}", sent_at
+
+    def start(self):
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        spans = list(self._buffer)
+        self._buffer.clear()
+        try:
+            await asyncio.to_thread(self._write, spans)
+        except Exception as e:
+            self.logger.error(f"Error writing traces: {str(e)}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _write(self, spans: List[dict]):
+        try:
+            if os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, f"{self.path}.1")
+        except FileNotFoundError:
+            pass
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for span in spans:
+                f.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+
+def traced(name: str):
+    """Time an async method as a span of the current trace, using the instance's ``tracer``"""
+    def decorate(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return await method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def load_spans(paths: Iterable[str], since: float = 0) -> Dict[str, List[dict]]:
+    """Spans per trace from the JSONL files (and their rotated copies)"""
+    spans = []
+    for path in paths:
+        for candidate in (f"{path}.1", path):
+            if not os.path.exists(candidate):
+                continue
+            with open(candidate, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    if span['start'] >= since:
+                        spans.append(span)
+    # Reviews after a restart were recorded under draft-<message_id>; move them to the draft's trace
+    drafts = {span['attrs']['message_id']: span['trace'] for span in spans if span['name'] == 'draft'}
+    traces: Dict[str, List[dict]] = defaultdict(list)
+    for span in spans:
+        trace_id = span['trace']
+        if trace_id.startswith('draft-'):
+            trace_id = drafts.get(trace_id[len('draft-'):], trace_id)
+        traces[trace_id].append(span)
+    for trace_spans in traces.values():
+        trace_spans.sort(key=lambda span: span['start'])
+    return traces
+
+
+def _total(trace_spans: List[dict]) -> float:
+    return max(span['start'] + span['duration'] for span in trace_spans) - trace_spans[0]['start']
+
+
+def _quantile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", default=[TRACE_PATH], help="trace files (default: traces.jsonl)")
+    parser.add_argument("--slowest", type=int, default=10, help="how many of the slowest traces to list")
+    parser.add_argument("--hours", type=float, help="only traces that started in the last HOURS")
+    parser.add_argument("--trace", help="print every span of one trace")
+    args = parser.parse_args()
+
+    since = time.time() - args.hours * 3600 if args.hours else 0
+    traces = load_spans(args.paths, since)
+    if not traces:
+        print("No traces found")
+        return
+
+    if args.trace:
+        trace_spans = traces.get(args.trace)
+        if not trace_spans:
+            print(f"Trace {args.trace} not found")
+            return
+        origin = trace_spans[0]['start']
+        for span in trace_spans:
+            attrs = " ".join(f"{key}={value}" for key, value in span.get('attrs', {}).items())
+            print(f"+{span['start'] - origin:9.2f}s  {span['duration']:9.2f}s  {span['name']:<20} {attrs}")
+        return
+
+    print(f"{len(traces)} traces")
+    print(f"\nSlowest {min(args.slowest, len(traces))}:")
+    print(f"{'trace':<18}{'started':<21}{'total':>10}  slowest stages")
+    slowest = sorted(traces.items(), key=lambda item: _total(item[1]), reverse=True)[:args.slowest]
+    for trace_id, trace_spans in slowest:
+        stages = sorted(trace_spans, key=lambda span: span['duration'], reverse=True)[:3]
+        started = datetime.fromtimestamp(trace_spans[0]['start']).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{trace_id:<18}{started:<21}{_total(trace_spans):>9.1f}s  "
+              + ", ".join(f"{span['name']} {span['duration']:.1f}s" for span in stages))
+
+    durations: Dict[str, List[float]] = defaultdict(list)
+    for trace_spans in traces.values():
+        for span in trace_spans:
+            if span['name'] != 'draft':
+                durations[span['name']].append(span['duration'])
+    print(f"\n{'stage':<22}{'count':>7}{'p50':>10}{'p90':>10}{'max':>10}{'total':>12}")
+    for name, values in sorted(durations.items(), key=lambda item: sum(item[1]), reverse=True):
+        print(f"{name:<22}{len(values):>7}{_quantile(values, 0.5):>9.2f}s{_quantile(values, 0.9):>9.2f}s"
+              f"{max(values):>9.2f}s{sum(values):>11.1f}s")
+
+
+if __name__ == "__main__":
+    _main()